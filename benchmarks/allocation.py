@@ -0,0 +1,77 @@
+"""
+Compares the write throughput of the file allocation modes.
+
+The pieces of a synthetic torrent are written in a random order, like the
+rarest-first picking verifies them, through the FileManager of each
+allocation mode, then the files are synced. The time to open (and so
+allocate) the files is reported apart, as is the number of extents of the
+result when `filefrag` is available.
+
+Run from the repository root:
+    python -m benchmarks.allocation
+"""
+import argparse
+import os
+import random
+import subprocess
+import tempfile
+import time
+
+from benchmarks.piece_manager import SyntheticInfo
+from src.file_manager import FileManager
+
+
+class SyntheticPiece:
+    def __init__(self, index, data):
+        self.index = index
+        self.data = data
+
+
+def extents(path):
+    try:
+        output = subprocess.run(['filefrag', path], capture_output=True,
+                                text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return int(output.rsplit(':', 1)[1].split()[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--pieces', type=int, default=1024)
+    parser.add_argument('--piece-length', type=int, default=2 ** 18)
+    parser.add_argument('--dir', default=None,
+                        help='Where the files are written (default a '
+                             'temporary directory)')
+    args = parser.parse_args()
+
+    info = SyntheticInfo(args.pieces, args.piece_length)
+    size = args.pieces * args.piece_length / 2 ** 20
+    order = list(range(args.pieces))
+    random.Random(0).shuffle(order)
+    data = memoryview(os.urandom(args.piece_length))
+    for allocation in FileManager.ALLOCATIONS:
+        with tempfile.TemporaryDirectory(dir=args.dir) as work_path:
+            file_manager = FileManager(info, [0], work_path + '/',
+                                       allocation)
+            start = time.perf_counter()
+            file_manager.open()
+            open_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for index in order:
+                file_manager.write(SyntheticPiece(index, data))
+            file_manager.sync()
+            write_time = time.perf_counter() - start
+            count = extents(file_manager.path(0))
+            file_manager.close()
+
+        print('{allocation}: open {open:.3f} s, write {write:.0f} MiB/s, '
+              '{extents} extents'.format(
+                  allocation=allocation, open=open_time,
+                  write=size / write_time,
+                  extents='?' if count is None else count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Measures how fast `PeerStreamIterator` frames and parses Piece messages.
+
+The stream is fed from memory in `PeerStreamIterator.CHUNK_SIZE` reads, so
+the result is the parsing throughput without any network involved.
+
+Run from the repository root:
+    python -m benchmarks.peer_stream_iterator
+"""
+import argparse
+import asyncio
+import time
+
+from src.peer_protocol import Piece
+from src.peer_streem_iterator import PeerStreamIterator
+
+BLOCK_SIZE = 2 ** 14
+
+
+class MemoryReader:
+    """
+    Stream reader stand-in serving a bytes object in fixed size reads.
+    """
+
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._position = 0
+
+    async def read(self, size):
+        chunk = self._data[self._position:self._position + size]
+        self._position += len(chunk)
+        return bytes(chunk)
+
+
+async def parse_all(data, placement=None):
+    count = 0
+    async for message in PeerStreamIterator(MemoryReader(data),
+                                            placement=placement):
+        if type(message) is Piece:
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--blocks', type=int, default=20000,
+                        help='Number of 16 KiB Piece messages to parse')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--placement', action='store_true',
+                        help='Receive blocks directly into a piece buffer')
+    args = parser.parse_args()
+
+    piece_buffer = memoryview(bytearray(16 * BLOCK_SIZE))
+
+    def placement(index, begin, length):
+        return piece_buffer[begin:begin + length]
+
+    block = bytes(BLOCK_SIZE)
+    data = b''.join(Piece(i // 16, (i % 16) * BLOCK_SIZE, block).encode()
+                    for i in range(args.blocks))
+
+    loop = asyncio.new_event_loop()
+    best = None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        count = loop.run_until_complete(parse_all(
+            data, placement if args.placement else None))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        assert count == args.blocks
+    loop.close()
+
+    print('Parsed {count} Piece messages ({size:.1f} MB) in {time:.3f} s: '
+          '{speed:.1f} MB/s'.format(count=args.blocks,
+                                    size=len(data) / 2 ** 20,
+                                    time=best,
+                                    speed=len(data) / 2 ** 20 / best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Measures the PieceManager bookkeeping with synthetic peers.
+
+A synthetic single-file torrent with all-zero pieces is downloaded from
+`--peers` seeds that each keep `--depth` requests in flight. Blocks are
+delivered in random order, so thousands of blocks are pending at any time.
+With `--memory` the pieces are kept in a `MemoryStorage`, leaving the disks
+out of the measure.
+
+Run from the repository root:
+    python -m benchmarks.piece_manager
+"""
+import argparse
+import hashlib
+import random
+import tempfile
+import time
+
+from bitstring import BitArray
+
+from src.storage import MemoryStorage
+from src.torrent_client import PieceManager, REQUEST_SIZE
+
+
+class SyntheticInfo:
+    """
+    The parts of `Info` the PieceManager uses, for a single file torrent
+    whose pieces are all zeros.
+    """
+    is_multi_file = False
+    name = 'synthetic'
+
+    def __init__(self, pieces_number, piece_length):
+        self.piece_length = piece_length
+        self.length = pieces_number * piece_length
+        self.pieces = [hashlib.sha1(bytes(piece_length)).digest()] \
+            * pieces_number
+
+
+def download(piece_manager, peers, depth):
+    block = bytes(REQUEST_SIZE)
+    requested = 0
+    request_time = 0
+    receive_time = 0
+    while True:
+        start = time.perf_counter()
+        pending = []
+        for peer_id in peers:
+            for _ in range(depth):
+                request = piece_manager.next_request(peer_id)
+                if request is None:
+                    break
+                pending.append((peer_id, request.piece, request.offset,
+                                request.length))
+        request_time += time.perf_counter() - start
+        if not pending:
+            return requested, request_time, receive_time
+
+        random.shuffle(pending)
+        requested += len(pending)
+        start = time.perf_counter()
+        for peer_id, index, offset, length in pending:
+            # Endgame duplicates of a received block count as cancelled
+            if (index, offset) in piece_manager.pending_blocks:
+                piece_manager.block_received(peer_id, index, offset,
+                                             block[:length])
+        receive_time += time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--pieces', type=int, default=2048)
+    parser.add_argument('--piece-length', type=int, default=2 ** 18)
+    parser.add_argument('--peers', type=int, default=35)
+    parser.add_argument('--depth', type=int, default=64)
+    parser.add_argument('--memory', action='store_true',
+                        help='Keep the pieces in memory')
+    args = parser.parse_args()
+
+    random.seed(0)
+    info = SyntheticInfo(args.pieces, args.piece_length)
+    with tempfile.TemporaryDirectory() as work_path:
+        start = time.perf_counter()
+        storage = MemoryStorage(info, [0]) if args.memory else 'file'
+        piece_manager = PieceManager(info, [0], work_path + '/',
+                                     storage=storage)
+        setup_time = time.perf_counter() - start
+
+        bitfield = bytes([0xff]) * ((args.pieces + 7) // 8)
+        peers = [str(i).encode() for i in range(args.peers)]
+        for peer_id in peers:
+            piece_manager.add_peer(peer_id, BitArray(bitfield))
+
+        start = time.perf_counter()
+        blocks, request_time, receive_time = download(
+            piece_manager, peers, args.depth)
+        elapsed = time.perf_counter() - start
+        piece_manager.close()
+
+    assert len(piece_manager.have_pieces) == args.pieces
+    print('Setup of {pieces} pieces: {setup:.3f} s'.format(
+        pieces=args.pieces, setup=setup_time))
+    print('{blocks} blocks in {time:.3f} s: {rate:.0f} blocks/s, '
+          'next_request {request:.1f} us, block_received {receive:.1f} us'
+          .format(blocks=blocks, time=elapsed, rate=blocks / elapsed,
+                  request=request_time / blocks * 1e6,
+                  receive=receive_time / blocks * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Measures the memory and startup time of the PieceManager bookkeeping.
+
+A synthetic single-file torrent of `--pieces` pieces is set up, then a seed
+connects and `--started` pieces are started. Each step is timed, then run
+again with `tracemalloc` to measure the memory it allocates.
+
+Run from the repository root:
+    python -m benchmarks.piece_state
+"""
+import argparse
+import tempfile
+import time
+import tracemalloc
+
+from bitstring import BitArray
+
+from benchmarks.piece_manager import SyntheticInfo
+from src.torrent_client import PieceManager
+
+
+def timed(step):
+    start = time.perf_counter()
+    step()
+    return time.perf_counter() - start
+
+
+def traced(step):
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    step()
+    current, peak = tracemalloc.get_traced_memory()
+    return current - before, peak - before
+
+
+def run(info, bitfield, started, measure):
+    """
+    Runs the steps of the benchmark, passing each one to `measure`.
+
+    :return: The step names and the results of `measure`
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as work_path:
+        piece_managers = []
+
+        def setup():
+            piece_managers.append(PieceManager(info, [0], work_path + '/'))
+
+        def start_pieces():
+            for _ in range(started):
+                piece_managers[0].next_request(b'seed')
+                piece_managers[0].open_pieces.clear()
+
+        results.append(('Setup of {} pieces'.format(len(info.pieces)),
+                        measure(setup)))
+        results.append(('Seed connected', measure(
+            lambda: piece_managers[0].add_peer(b'seed', bitfield))))
+        results.append(('{} pieces started'.format(started),
+                        measure(start_pieces)))
+        piece_managers[0].close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--pieces', type=int, default=10 ** 6)
+    parser.add_argument('--piece-length', type=int, default=2 ** 18)
+    parser.add_argument('--started', type=int, default=100)
+    args = parser.parse_args()
+
+    info = SyntheticInfo(args.pieces, args.piece_length)
+    bitfield = BitArray(bytes([0xff]) * ((args.pieces + 7) // 8))
+    times = run(info, bitfield, args.started, timed)
+    # Tracing slows everything down, so memory is measured in a second run
+    tracemalloc.start()
+    sizes = run(info, bitfield, args.started, traced)
+    tracemalloc.stop()
+    for (name, elapsed), (_, (size, peak)) in zip(times, sizes):
+        print('{name}: {time:.3f} s, {size:.1f} MiB (peak {peak:.1f} MiB)'
+              .format(name=name, time=elapsed, size=size / 2 ** 20,
+                      peak=peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
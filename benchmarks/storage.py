@@ -0,0 +1,75 @@
+"""
+Compares the storage backends of the PieceManager.
+
+A synthetic single-file torrent with all-zero pieces is downloaded from one
+seed, every block being copied into the buffer returned by `block_buffer`
+like the PeerStreamIterator does, then hashed and written. Afterwards every
+block is read back like it is for uploads.
+
+Run from the repository root:
+    python -m benchmarks.storage
+"""
+import argparse
+import tempfile
+import time
+
+from bitstring import BitArray
+
+from benchmarks.piece_manager import SyntheticInfo
+from src.torrent_client import PieceManager, REQUEST_SIZE
+
+
+def download(piece_manager):
+    block = bytes(REQUEST_SIZE)
+    while True:
+        request = piece_manager.next_request(b'seed')
+        if request is None:
+            return
+        target = piece_manager.block_buffer(request.piece, request.offset,
+                                            request.length)
+        target[:] = block[:request.length]
+        piece_manager.block_received(b'seed', request.piece, request.offset,
+                                     target)
+
+
+def upload(file_manager, pieces_number, piece_length):
+    for index in range(pieces_number):
+        for offset in range(0, piece_length, REQUEST_SIZE):
+            data = file_manager.read(index, offset, REQUEST_SIZE)
+            assert len(data) == REQUEST_SIZE
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--pieces', type=int, default=1024)
+    parser.add_argument('--piece-length', type=int, default=2 ** 18)
+    args = parser.parse_args()
+
+    info = SyntheticInfo(args.pieces, args.piece_length)
+    size = args.pieces * args.piece_length / 2 ** 20
+    for storage in PieceManager.STORAGES:
+        with tempfile.TemporaryDirectory() as work_path:
+            piece_manager = PieceManager(info, [0], work_path + '/',
+                                         storage=storage)
+            piece_manager.add_peer(
+                b'seed', BitArray(bytes([0xff]) * ((args.pieces + 7) // 8)))
+
+            start = time.perf_counter()
+            download(piece_manager)
+            download_time = time.perf_counter() - start
+            assert len(piece_manager.have_pieces) == args.pieces
+
+            start = time.perf_counter()
+            upload(piece_manager.file_manager, args.pieces,
+                   args.piece_length)
+            upload_time = time.perf_counter() - start
+            piece_manager.close()
+
+        print('{storage}: download {down:.0f} MiB/s, upload reads '
+              '{up:.0f} MiB/s'.format(storage=storage,
+                                      down=size / download_time,
+                                      up=size / upload_time))
+
+
+if __name__ == '__main__':
+    main()
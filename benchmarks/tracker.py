@@ -0,0 +1,105 @@
+"""
+Compares the announce latency of the UDP and HTTP tracker protocols.
+
+Minimal UDP and HTTP trackers answering every announce with the same
+compact peers run in process on the loopback interface, and `--announces`
+announces are made to each through `Tracker`. The UDP client reuses its
+connection ID like it does between periodic announces, the HTTP client its
+keep-alive connection.
+
+Run from the repository root:
+    python -m benchmarks.tracker
+"""
+import argparse
+import asyncio
+import struct
+import time
+
+from src.bencoding import Encoder
+from src.tracker import Tracker
+
+PEERS = bytes(6 * 50)
+
+
+class UdpTrackerStandIn(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        _, action, transaction_id = struct.unpack_from('>QII', data)
+        if action == 0:
+            response = struct.pack('>IIQ', 0, transaction_id, 1)
+        else:
+            response = struct.pack('>IIIII', 1, transaction_id, 1800, 0,
+                                   50) + PEERS
+        self.transport.sendto(response, addr)
+
+
+async def http_tracker(reader, writer):
+    body = Encoder({b'interval': 1800, b'complete': 50, b'incomplete': 0,
+                    b'peers': PEERS}).encode()
+    response = b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) \
+        + body
+    try:
+        while await reader.readuntil(b'\r\n\r\n'):
+            writer.write(response)
+    except asyncio.IncompleteReadError:
+        writer.close()
+
+
+class SyntheticInfo:
+    hash20 = bytes(20)
+    peer_id = '-PC0001-000000000000'
+    length = 2 ** 30
+
+    def __init__(self, announce):
+        self.announce = announce
+        self.announce_tiers = [[announce]]
+
+
+async def measure(url, announces):
+    tracker = Tracker(SyntheticInfo(url))
+    latencies = []
+    for i in range(announces):
+        start = time.perf_counter()
+        response = await tracker.connect(first=i == 0)
+        latencies.append(time.perf_counter() - start)
+        assert len(response.peers) == 50
+    await tracker.close()
+    return latencies
+
+
+async def run(announces):
+    loop = asyncio.get_running_loop()
+    udp, _ = await loop.create_datagram_endpoint(
+        UdpTrackerStandIn, local_addr=('127.0.0.1', 0))
+    http = await asyncio.start_server(http_tracker, '127.0.0.1', 0)
+    urls = {
+        'udp': 'udp://127.0.0.1:{port}/announce'.format(
+            port=udp.get_extra_info('sockname')[1]),
+        'http': 'http://127.0.0.1:{port}/announce'.format(
+            port=http.sockets[0].getsockname()[1])}
+    for protocol, url in urls.items():
+        latencies = await measure(url, announces)
+        # The first announce includes the connect request or TCP handshake
+        first = latencies[0]
+        latencies.sort()
+        print('{protocol}: first {first:.0f} us, median {median:.0f} us, '
+              'p99 {p99:.0f} us'.format(
+                  protocol=protocol, first=first * 1e6,
+                  median=latencies[len(latencies) // 2] * 1e6,
+                  p99=latencies[int(len(latencies) * 0.99)] * 1e6))
+    udp.close()
+    http.close()
+    await http.wait_closed()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--announces', type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(run(args.announces))
+
+
+if __name__ == '__main__':
+    main()
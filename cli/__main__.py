@@ -15,12 +15,14 @@ client = None
 info = None
 
 
-async def start(file, work_path):
+async def start(file, work_path, recheck=False, allocation='compact',
+                sendfile=False):
     global info
     global client
     info = Info(file)
     files = [i for i in range(len(info.files))] if info.is_multi_file else [0]
-    client = TorrentClient(info, files, work_path)
+    client = TorrentClient(info, files, work_path, recheck=recheck,
+                           allocation=allocation, sendfile=sendfile)
     client.piece_manager.bytes_downloaded_changed = bytes_downloaded_changed
     await client.start()
 
@@ -47,14 +49,23 @@ def signal_handler(sig, frame):
 @click.command()
 @click.option('--file', help='.torrent file for download')
 @click.option('--path', help='Path for download')
-def main(file, path):
+@click.option('--recheck', is_flag=True,
+              help='Verify the data already downloaded if there is no resume '
+                   'file')
+@click.option('--allocation', default='compact',
+              type=click.Choice(['compact', 'sparse', 'full']),
+              help='How the files are allocated')
+@click.option('--sendfile', is_flag=True,
+              help='Upload blocks straight from the files with sendfile')
+def main(file, path, recheck, allocation, sendfile):
     """Simple torrent client"""
     if file is None or path in None:
         with click.Context(main) as ctx:
             click.echo(main.get_help(ctx))
         return
     loop = asyncio.new_event_loop()
-    loop.run_until_complete(start(file, path))
+    loop.run_until_complete(start(file, path, recheck, allocation,
+                                  sendfile))
     loop.close()
 
 
@@ -0,0 +1,149 @@
+import asyncio
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LatencyHistogram:
+    """
+    Counts latencies in buckets growing by powers of two: bucket `i` holds
+    the latencies of less than 2^i microseconds (and at least half that).
+    """
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * LatencyHistogram.BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, seconds: float):
+        bucket = int(seconds * 1e6).bit_length()
+        self.counts[min(bucket, LatencyHistogram.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, percent: float) -> float:
+        """
+        Get the upper bound of the bucket holding the given percentile.
+
+        :return: The latency in seconds
+        """
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return (1 << bucket) / 1e6
+        return 0
+
+    def __str__(self):
+        return '{count} ops, mean {mean:.2f} ms, p50 < {p50:.2f} ms, ' \
+               'p99 < {p99:.2f} ms, max {max:.2f} ms'.format(
+                   count=self.count, mean=self.mean * 1e3,
+                   p50=self.percentile(50) * 1e3,
+                   p99=self.percentile(99) * 1e3, max=self.max * 1e3)
+
+
+class DiskIO:
+    """
+    Runs the blocking reads and writes of a `Storage` on a dedicated
+    thread pool, so a slow disk does not stall the peer connections served by
+    the event loop.
+
+    At most `max_queued` operations are queued or running at once, further
+    callers wait for a slot. While the queue is full `is_backlogged` is set,
+    the PieceManager then stops starting new pieces so the memory held by
+    pieces waiting to be written stays bounded.
+
+    The time every operation spends on the pool is recorded in a histogram
+    per operation, the time spent waiting for a slot is recorded as `wait`.
+    """
+    WORKERS = 4
+    MAX_QUEUED = 32
+
+    def __init__(self, storage, workers=None, max_queued=None):
+        """
+        :param storage: The opened Storage doing the actual I/O
+        :param workers: The number of I/O threads (default `WORKERS`)
+        :param max_queued: The number of operations queued or running at
+                           once (default `MAX_QUEUED`)
+        """
+        self.storage = storage
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers or DiskIO.WORKERS,
+            thread_name_prefix='disk-io')
+        self.max_queued = max_queued or DiskIO.MAX_QUEUED
+        self.slots = asyncio.Semaphore(self.max_queued)
+        # The operations submitted and not finished yet, including the ones
+        # waiting for a slot
+        self.queued = 0
+        self.histograms = {'read': LatencyHistogram(),
+                           'write': LatencyHistogram(),
+                           'sync': LatencyHistogram(),
+                           'wait': LatencyHistogram()}
+
+    @property
+    def is_backlogged(self) -> bool:
+        return self.queued >= self.max_queued
+
+    async def write(self, pieces):
+        """
+        Writes the data of consecutive verified pieces.
+        """
+        await self._run('write', self.storage.write_pieces, pieces)
+
+    async def sync(self):
+        """
+        Flushes the written data to the disks.
+        """
+        await self._run('sync', self.storage.sync)
+
+    async def read(self, index: int, offset: int, length: int) -> bytes:
+        """
+        Reads a block of a piece.
+        """
+        return await self._run('read', self.storage.read,
+                               index, offset, length)
+
+    async def _run(self, operation, function, *args):
+        self.queued += 1
+        try:
+            start = time.perf_counter()
+            async with self.slots:
+                self.histograms['wait'].add(time.perf_counter() - start)
+                result, elapsed = await asyncio.get_running_loop() \
+                    .run_in_executor(self.executor, self._timed,
+                                     function, args)
+                self.histograms[operation].add(elapsed)
+                return result
+        finally:
+            self.queued -= 1
+
+    @staticmethod
+    def _timed(function, args):
+        """
+        Runs on the I/O thread pool.
+
+        :return: The result of the function and the seconds it took
+        """
+        start = time.perf_counter()
+        result = function(*args)
+        return result, time.perf_counter() - start
+
+    def stats(self) -> str:
+        return '; '.join('{operation}: {histogram}'.format(
+            operation=operation, histogram=histogram)
+            for operation, histogram in self.histograms.items())
+
+    def close(self):
+        """
+        Waits for the running operations and closes the files.
+        """
+        self.executor.shutdown(wait=True)
+        self.storage.close()
@@ -0,0 +1,118 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class FdPool:
+    """
+    A least recently used pool of file descriptors, shared by the file
+    managers of all torrents so the number of open files stays under a
+    global cap whatever the number of files.
+
+    Files are opened on first use and closed again when more than
+    `max_open` are open, least recently used first. A descriptor in use by
+    a read or write is pinned and never closed under it; if every open
+    descriptor is pinned the cap is exceeded until they are released.
+
+    The pool is used from the disk I/O threads, all its state is guarded by
+    a lock.
+    """
+    MAX_OPEN = 256
+
+    def __init__(self, max_open=None):
+        """
+        :param max_open: The number of files kept open at most (default
+                         `MAX_OPEN`)
+        """
+        self.max_open = max_open or FdPool.MAX_OPEN
+        self.lock = threading.Lock()
+        # [descriptor, pins] by path, least recently used first
+        self.fds = OrderedDict()
+        # The paths that were opened once, to count the reopens
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+        self.reopens = 0
+
+    @contextmanager
+    def use(self, path):
+        """
+        Get the descriptor of a file, opened for reading and writing and
+        created if missing, pinned for the duration of the block.
+        """
+        fd = self.acquire(path)
+        try:
+            yield fd
+        finally:
+            self.release(path)
+
+    def acquire(self, path) -> int:
+        with self.lock:
+            entry = self.fds.get(path)
+            if entry is not None:
+                self.hits += 1
+                self.fds.move_to_end(path)
+            else:
+                self.misses += 1
+                if path in self.seen:
+                    self.reopens += 1
+                self._evict(self.max_open - 1)
+                entry = [os.open(path, os.O_RDWR | os.O_CREAT), 0]
+                self.fds[path] = entry
+                self.seen.add(path)
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, path):
+        with self.lock:
+            self.fds[path][1] -= 1
+            self._evict(self.max_open)
+
+    def close(self, path):
+        """
+        Closes the descriptor of a file if it is open and not in use.
+        """
+        with self.lock:
+            entry = self.fds.get(path)
+            if entry is not None and not entry[1]:
+                del self.fds[path]
+                os.close(entry[0])
+            self.seen.discard(path)
+
+    def _evict(self, size):
+        # Closes unpinned descriptors, least recently used first, until at
+        # most `size` are open
+        if len(self.fds) <= size:
+            return
+        for path, (fd, pins) in list(self.fds.items()):
+            if not pins:
+                del self.fds[path]
+                os.close(fd)
+                if len(self.fds) <= size:
+                    return
+
+    @property
+    def hit_rate(self) -> float:
+        uses = self.hits + self.misses
+        return self.hits / uses if uses else 0
+
+    def stats(self) -> str:
+        return '{open} files open, {rate:.1%} hit rate, {reopens} ' \
+               'reopens'.format(open=len(self.fds), rate=self.hit_rate,
+                                reopens=self.reopens)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_pool() -> FdPool:
+    """
+    Get the pool shared by all file managers not given one of their own.
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = FdPool()
+        return _shared
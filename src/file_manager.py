@@ -1,102 +1,296 @@
+import logging
+import mmap
 import os
+from contextlib import contextmanager
 
+from src.fd_pool import shared_pool
+from src.storage import Storage
 
-class FileManager:
-    def __init__(self, info, files, work_path):
+
+class FileManager(Storage):
+    """
+    Maps the pieces of a torrent onto the downloaded files.
+
+    Each part of a file a range of a piece falls into (see `spans`) is read
+    or written with positional I/O (`os.preadv` and `os.pwritev`) - there
+    are no seeks, so several threads may share the file descriptors.
+
+    The descriptors are taken from an `FdPool`, by default the one shared by
+    all torrents: a file is opened on its first read or write and may be
+    closed again while other files are used.
+    """
+    # The most buffers passed to a single `os.pwritev` call
+    IOV_MAX = 1024
+    # How the space of the selected files is allocated when they are opened:
+    #     - 'compact': not at all, the files grow as pieces are written
+    #     - 'sparse': the files are truncated to their final size, without
+    #                 allocating the blocks
+    #     - 'full': all blocks are allocated with `posix_fallocate`, so the
+    #               file system can lay them out contiguously
+    ALLOCATIONS = ('compact', 'sparse', 'full')
+    persistent = True
+
+    def __init__(self, info, files, work_path, allocation='compact',
+                 fd_pool=None):
         """
         Args:
             info: Torrent info dictionary.
             files: List of indices required for downloading files.
                    File order as in info.
             work_path: Folder for downloading files.
+            allocation: One of `ALLOCATIONS`.
+            fd_pool: The FdPool the files are opened through (default the
+                     shared one).
         """
-        self.info = info
-        self.files = files
+        if allocation not in FileManager.ALLOCATIONS:
+            raise ValueError('Unknown allocation mode {allocation}'.format(
+                allocation=allocation))
+        super().__init__(info, files)
+        self.allocation = allocation
+        self.fd_pool = fd_pool or shared_pool()
         self.work_path = work_path
         if self.info.is_multi_file:
-            self.fd = []
+            self.paths = [file['path'] for file in self.info.files]
         else:
-            self.fd = None
+            self.paths = [[self.info.name]]
+        # The indices of the files created by `open`
+        self.opened = set()
+        # The indices of the files written since the last sync
+        self.dirty = set()
 
-    def need_piece(self, piece):
-        if not self.info.is_multi_file:
-            return True
-        else:
-            offset = 0
-            for i, file in enumerate(self.info.files):
-                if offset < self.info.piece_length * piece.index:
-                    if i in self.files:
-                        return True
-                    offset += file['length']
-        return False
+    def block_file(self, index: int, offset: int, length: int):
+        """
+        Get the file a range of a piece is stored in, so it can be sent with
+        `sendfile` without reading it.
+
+        :return: A context manager giving an unbuffered binary file object
+                 and the offset of the range in it, or None if the range
+                 spans several files or is not downloaded
+        """
+        spans = self.spans(index, offset, length)
+        if len(spans) != 1 or spans[0][2] != length or \
+                spans[0][0] not in self.opened:
+            return None
+        return self._block_file(*spans[0][:2])
+
+    @contextmanager
+    def _block_file(self, file_index, file_offset):
+        # The descriptor stays pinned in the pool while the file is used
+        with self.fd_pool.use(self.path(file_index)) as fd, \
+                open(fd, 'rb', buffering=0, closefd=False) as file:
+            yield file, file_offset
+
+    def path(self, file_index: int) -> str:
+        return os.path.join(self.work_path, *self.paths[file_index])
 
     def open(self):
-        if self.info.is_multi_file:
-            for i in self.files:
-                directory = ""
-                for subdir in self.info.files[i]['path'][:-1]:
-                    directory += subdir
-                    if not os.path.exists(self.work_path + directory):
-                        os.makedirs(self.work_path + directory)
-                self.fd.append(
-                    os.open(self.work_path
-                            + directory
-                            + self.info.files[i]['path'][-1],
-                            os.O_RDWR | os.O_CREAT))
-        else:
-            self.fd = os.open(self.work_path + self.info.name,
-                              os.O_RDWR | os.O_CREAT)
+        for i in sorted(self.files):
+            path = self.path(i)
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # The files are created and allocated now, their descriptor is
+            # opened again on first use
+            fd = os.open(path, os.O_RDWR | os.O_CREAT)
+            try:
+                self._allocate(fd, self.offsets[i + 1] - self.offsets[i])
+            finally:
+                os.close(fd)
+            self.opened.add(i)
+
+    def _allocate(self, fd, length):
+        # Files already allocated are left alone, so their mtime is kept
+        stat = os.fstat(fd)
+        if self.allocation == 'full' and stat.st_blocks * 512 < length and \
+                hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, length)
+        elif self.allocation != 'compact' and stat.st_size < length:
+            os.ftruncate(fd, length)
 
     def write(self, piece):
-        if self.info.is_multi_file:
-            begin = []
-            offset = 0
-            for i, file in enumerate(self.info.files):
-                if offset < self.info.piece_length * piece.index:
-                    begin.append(
-                        (i, self.info.piece_length * piece.index - offset))
-                    if self.info.piece_length * \
-                            (piece.index + 1) < offset + file['length']:
-                        break
+        self.write_pieces([piece])
+
+    def write_pieces(self, pieces):
+        """
+        Writes consecutive pieces, the part of each file they cover with a
+        single `os.pwritev` call taking the views of all the pieces.
+        """
+        views = [piece.data for piece in pieces]
+        length = sum(len(view) for view in views)
+        # The view the next span starts in
+        position = 0
+        for file_index, file_offset, size in self.spans(pieces[0].index, 0,
+                                                        length):
+            buffers = []
+            while size:
+                view = views[position]
+                if len(view) <= size:
+                    buffers.append(view)
+                    size -= len(view)
+                    position += 1
                 else:
-                    offset += file['length']
-            piece_offset = 0
-            for file in begin:
-                os.lseek(self.fd[file[0]], file[1], os.SEEK_SET)
-                os.write(self.fd[file[0]],
-                         piece.data[piece_offset:min(
-                             piece_offset + self.info.files[file[0]],
-                             len(piece.data) - piece_offset)])
-                piece_offset = min(piece_offset + self.info.files[file[0]],
-                                   len(piece.data) - piece_offset)
-        else:
-            pos = piece.index * self.info.piece_length
-            os.lseek(self.fd, pos, os.SEEK_SET)
-            os.write(self.fd, piece.data)
+                    buffers.append(view[:size])
+                    views[position] = view[size:]
+                    size = 0
+            # Parts of files that are not downloaded are dropped
+            if file_index in self.opened:
+                self.dirty.add(file_index)
+                with self.fd_pool.use(self.path(file_index)) as fd:
+                    self._write(fd, buffers, file_offset)
 
     def read(self, index, offset, length):
-        if self.info.is_multi_file:
-            data = b''
-            files_offset = 0
-            for i, file in enumerate(self.info.files):
-                if files_offset < self.info.piece_length * index + offset:
-                    os.lseek(self.fd[i], index
-                             * self.info.piece_length + offset, os.SEEK_SET)
-                    data += os.read(self.fd[i], length)
-                    if self.info.piece_length * index + offset + \
-                            length < files_offset + file['length']:
-                        break
-                else:
-                    offset += file['length']
-            return data
-        else:
-            os.lseek(self.fd, index * self.info.piece_length
-                     + offset, os.SEEK_SET)
-            return os.read(self.fd, length)
+        """
+        Reads a range of a piece.
+
+        :return: The data or None if the range is not within the torrent or
+                 touches a file that is not downloaded
+        """
+        spans = self.spans(index, offset, length)
+        if sum(size for _, _, size in spans) != length or \
+                any(file_index not in self.opened
+                    for file_index, _, _ in spans):
+            return None
+        data = bytearray(length)
+        with memoryview(data) as view:
+            position = 0
+            for file_index, file_offset, size in spans:
+                with self.fd_pool.use(self.path(file_index)) as fd:
+                    self._read(fd, view[position:position + size],
+                               file_offset)
+                position += size
+        return data
+
+    @staticmethod
+    def _write(fd, buffers, offset):
+        while buffers:
+            written = os.pwritev(fd, buffers[:FileManager.IOV_MAX], offset)
+            offset += written
+            # Drop the buffers written, keep the rest of a partly written one
+            done = 0
+            while done < len(buffers) and written >= len(buffers[done]):
+                written -= len(buffers[done])
+                done += 1
+            buffers = buffers[done:]
+            if written:
+                buffers[0] = buffers[0][written:]
+
+    @staticmethod
+    def _read(fd, view, offset):
+        # Bytes past the end of the file are left as zeros
+        while view:
+            read = os.preadv(fd, [view], offset)
+            if not read:
+                break
+            view = view[read:]
+            offset += read
+
+    def sync(self):
+        """
+        Flushes the written data to the disks.
+
+        Files closed by the pool since they were written are opened again:
+        `os.fsync` flushes all the data of a file, whatever the descriptor
+        it was written through.
+        """
+        dirty, self.dirty = self.dirty, set()
+        for file_index in sorted(dirty):
+            with self.fd_pool.use(self.path(file_index)) as fd:
+                os.fsync(fd)
 
     def close(self):
-        if self.info.is_multi_file:
-            for file in self.fd:
-                os.close(file)
-        else:
-            os.close(self.fd)
+        for file_index in self.opened:
+            self.fd_pool.close(self.path(file_index))
+        self.opened = set()
+
+    def stats(self) -> str:
+        return 'file descriptors: ' + self.fd_pool.stats()
+
+
+class MmapFileManager(FileManager):
+    """
+    A FileManager that maps the selected files into memory.
+
+    A piece lying within a single file is received straight into the
+    mapping (see `piece_buffer`), so it is hashed in place and writing it
+    costs nothing more. Pieces spanning several files are still assembled in
+    a buffer of their own and copied into the mappings. Reads return views
+    of the mappings without a read syscall.
+
+    The files are extended to their full length when opened. Every mapping
+    holds a descriptor of its own, not counted by the pool.
+    """
+
+    def __init__(self, info, files, work_path, allocation='compact',
+                 fd_pool=None):
+        super().__init__(info, files, work_path, allocation, fd_pool)
+        # The mappings of the non-empty opened files by file index
+        self.maps = {}
+
+    def open(self):
+        super().open()
+        for i in self.opened:
+            length = self.offsets[i + 1] - self.offsets[i]
+            if length:
+                # The mapping keeps a descriptor of its own
+                with self.fd_pool.use(self.path(i)) as fd:
+                    if os.fstat(fd).st_size < length:
+                        os.ftruncate(fd, length)
+                    self.maps[i] = mmap.mmap(fd, length)
+
+    def piece_buffer(self, index: int, length: int):
+        spans = self.spans(index, 0, length)
+        if len(spans) == 1 and spans[0][0] in self.maps:
+            return self._view(*spans[0])
+        return None
+
+    def write(self, piece):
+        data = piece.data
+        position = 0
+        for file_index, file_offset, size in self.spans(piece.index, 0,
+                                                        len(data)):
+            if file_index in self.maps:
+                target = self._view(file_index, file_offset, size)
+                # A piece received into the mapping is already in place
+                if target.obj is not data.obj:
+                    target[:] = data[position:position + size]
+            position += size
+
+    def write_pieces(self, pieces):
+        for piece in pieces:
+            self.write(piece)
+
+    def sync(self):
+        for mapping in self.maps.values():
+            mapping.flush()
+        super().sync()
+
+    def read(self, index, offset, length):
+        """
+        Reads a range of a piece.
+
+        :return: A view of the mapping, a copy if the range spans several
+                 files, or None like `FileManager.read`
+        """
+        spans = self.spans(index, offset, length)
+        if sum(size for _, _, size in spans) != length or \
+                any(file_index not in self.maps for file_index, _, _ in spans):
+            return None
+        if len(spans) == 1:
+            return self._view(*spans[0])
+        return b''.join(self._view(*span) for span in spans)
+
+    def _view(self, file_index, file_offset, size):
+        return memoryview(self.maps[file_index])[file_offset:
+                                                 file_offset + size]
+
+    def close(self):
+        for mapping in self.maps.values():
+            mapping.flush()
+            try:
+                mapping.close()
+            except BufferError:
+                # Views of a piece are still around, the mapping is closed
+                # once they are collected
+                logging.debug('Mapping still in use on close')
+        self.maps = {}
+        super().close()
@@ -12,6 +12,27 @@ PREFIX = '-DR'
 VERSION = '0001'
 
 
+class PieceHashes(object):
+    """
+    A read-only sequence of the 20 byte SHA1 hashes of the pieces, sliced
+    out of the `pieces` string of the meta-info on access instead of being
+    copied into a list up front.
+    """
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+
+    def __len__(self):
+        return len(self.raw) // 20
+
+    def __getitem__(self, index: int) -> bytes:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('piece index out of range')
+        return self.raw[index * 20:index * 20 + 20]
+
+
 class Info(object):
     """
 
@@ -71,6 +92,16 @@ class Info(object):
     def announce_list(self) -> str:
         return [i[0].decode('utf-8') for i in self.data.get(b'announce-list')]
 
+    @property
+    def announce_tiers(self) -> list:
+        """
+        The tiers of announce URLs (BEP 12), or the announce URL alone if
+        there is no announce-list.
+        """
+        tiers = [[url.decode('utf-8') for url in tier]
+                 for tier in self.data.get(b'announce-list', []) if tier]
+        return tiers or [[self.announce]]
+
     @property
     def comment(self) -> str:
         return self.data.get(b'comment').decode('utf-8')
@@ -97,9 +128,8 @@ class Info(object):
         return self.__metainfo__[b'piece length']
 
     @property
-    def pieces(self) -> list:
-        return [self.__metainfo__[b'pieces'][i:i + 20]
-                for i in range(0, len(self.__metainfo__[b'pieces']), 20)]
+    def pieces(self) -> PieceHashes:
+        return PieceHashes(self.__metainfo__[b'pieces'])
 
     @property
     def private(self) -> bool:
@@ -1,5 +1,7 @@
 import asyncio
 import logging
+import math
+import time
 from asyncio import Queue
 from concurrent.futures import CancelledError
 
@@ -30,6 +32,100 @@ class PeerState:
     Stopped = 4
 
 
+class RequestPipeline:
+    """
+    The block requests sent to one remote peer that are not answered yet.
+
+    Several requests are kept in flight so the peer always has a block to
+    send. The number of requests allowed in flight (the queue depth) follows
+    the bandwidth-delay product of the connection: the measured download
+    rate from the peer times the lowest observed request round trip time,
+    with some headroom so the depth can grow while the rate keeps growing.
+    """
+    MIN_DEPTH = 2
+    MAX_DEPTH = 256
+    INITIAL_DEPTH = 4
+    # Extra depth on top of the bandwidth-delay product
+    DEPTH_FACTOR = 1.5
+    DEPTH_SLACK = 2
+    # Interval in seconds the download rate is measured over
+    RATE_INTERVAL = 1
+    # Requests that are not answered in this many seconds are given up
+    REQUEST_TIMEOUT = 30
+
+    def __init__(self):
+        # (piece index, block offset) -> time the request was sent
+        self.pending = {}
+        self.depth = RequestPipeline.INITIAL_DEPTH
+        self.rate = 0
+        self.rtt = None
+        self._rate_start = None
+        self._rate_bytes = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __contains__(self, key):
+        return key in self.pending
+
+    @property
+    def free(self) -> int:
+        """
+        The number of requests that can be sent right now
+        """
+        return max(0, self.depth - len(self.pending))
+
+    def sent(self, index: int, begin: int):
+        self.pending[(index, begin)] = time.monotonic()
+        if self._rate_start is None:
+            self._rate_start = time.monotonic()
+
+    def received(self, index: int, begin: int, length: int):
+        """
+        Records the arrival of a block and adjusts the queue depth.
+        """
+        now = time.monotonic()
+        sent = self.pending.pop((index, begin), None)
+        if sent is not None:
+            sample = now - sent
+            if self.rtt is None or sample < self.rtt:
+                self.rtt = sample
+
+        self._rate_bytes += length
+        if self._rate_start is None:
+            self._rate_start = now
+        elif now - self._rate_start >= RequestPipeline.RATE_INTERVAL:
+            self.rate = self._rate_bytes / (now - self._rate_start)
+            self._rate_start = now
+            self._rate_bytes = 0
+            self._update_depth()
+
+    def expire(self):
+        """
+        Forgets requests the peer did not answer in `REQUEST_TIMEOUT`, the
+        piece manager hands the blocks out again once they expire there.
+        """
+        deadline = time.monotonic() - RequestPipeline.REQUEST_TIMEOUT
+        for key in [key for key, sent in self.pending.items()
+                    if sent < deadline]:
+            del self.pending[key]
+
+    def clear(self):
+        """
+        Drops all requests in flight, e.g. when the peer chokes us.
+        """
+        self.pending.clear()
+
+    def _update_depth(self):
+        if not self.rtt:
+            return
+        bdp = self.rate * self.rtt / REQUEST_SIZE
+        depth = math.ceil(bdp * RequestPipeline.DEPTH_FACTOR) \
+            + RequestPipeline.DEPTH_SLACK
+        self.depth = min(RequestPipeline.MAX_DEPTH,
+                         max(RequestPipeline.MIN_DEPTH, depth))
+
+
 class PeerConnection:
     """
     A peer connection used to download and upload pieces.
@@ -44,11 +140,12 @@ class PeerConnection:
 
     Once the remote peer unchoked us, we can start requesting pieces.
     The PeerConnection will continue to request pieces for as long as there are
-    pieces left to request, or until the remote peer disconnects.
+    pieces left to request, or until the remote peer disconnects. Requests are
+    pipelined, see `RequestPipeline` for how many are kept in flight.
 
     If the connection with a remote peer drops, the PeerConnection will consume
     the next available peer from off the queue and try to connect to that one
-    instead.
+    instead. How the connection went is reported back to the `PeerPool`.
     """
 
     def __init__(self, queue: Queue, info_hash,
@@ -59,7 +156,7 @@ class PeerConnection:
         Use `stop` to abort this connection and any subsequent connection
         attempts
 
-        :param queue: The async Queue containing available peers
+        :param queue: The PeerPool containing available peers
         :param info_hash: The SHA1 hash for the meta-data's info
         :param peer_id: Our peer ID used to to identify ourselves
         :param piece_manager: The manager responsible to determine which pieces
@@ -77,6 +174,12 @@ class PeerConnection:
         self.reader = None
         self.piece_manager = piece_manager
         self.on_block_cb = on_block_cb
+        self.requests = RequestPipeline()
+        self.downloaded = 0
+        # The transport refuses writes while a block is sent with sendfile,
+        # the messages to send meanwhile are written after it
+        self.in_sendfile = False
+        self.deferred = []
         self.future = asyncio.ensure_future(self._start())  # Start this worker
 
     async def _start(self):
@@ -84,6 +187,13 @@ class PeerConnection:
             peer = await self.queue.get()
             self.my_state = []
             self.peer_state = []
+            self.requests = RequestPipeline()
+            self.remote_id = None
+            self.deferred = []
+            # The bytes of blocks received and when the handshake was done,
+            # to tell the pool how fast the peer is
+            self.downloaded = 0
+            connected_at = None
             ip, port = peer
             logging.info('Got assigned peer with: {ip}'.format(ip=ip))
             try:
@@ -91,10 +201,12 @@ class PeerConnection:
                 # connection if the first one drops (i.e. second loop).
                 self.reader, self.writer = await asyncio.wait_for(
                     asyncio.open_connection(ip, port), 30)
+                connected_at = time.monotonic()
                 logging.info('Connection open to peer: {ip}'.format(ip=ip))
 
                 # It's our responsibility to initiate the handshake.
                 buffer = await self._handshake()
+                connected_at = time.monotonic()
 
                 # TODO Add support for sending data
                 # Sending BitField is optional and not needed when client does
@@ -110,12 +222,17 @@ class PeerConnection:
 
                 # Start reading responses as a stream of messages for as
                 # long as the connection is open and data is transmitted
-                async for message in PeerStreamIterator(self.reader, buffer):
+                # Blocks of Piece messages are received directly into the
+                # buffer of the piece they belong to
+                async for message in PeerStreamIterator(
+                        self.reader, buffer, self.piece_manager.block_buffer,
+                        self.piece_manager.is_placing):
                     if PeerState.Stopped in self.my_state:
                         break
                     if message is None:
-                        if PeerState.PendingRequest in self.my_state:
-                            self.my_state.remove(PeerState.PendingRequest)
+                        # Nothing received for a while, the requests in
+                        # flight are most likely lost
+                        self._clear_requests()
                     elif type(message) is BitField:
                         self.piece_manager.add_peer(self.remote_id,
                                                     message.bitfield)
@@ -125,57 +242,47 @@ class PeerConnection:
                         if PeerState.Interested in self.peer_state:
                             self.peer_state.remove(PeerState.Interested)
                     elif type(message) is Choke:
+                        # A choking peer discards all our pending requests
+                        self._clear_requests()
                         self.peer_state.append(PeerState.Choked)
                     elif type(message) is Unchoke:
                         logging.info(PeerState.Unchoke)
-                        if PeerState.PendingRequest in self.my_state:
-                            self.my_state.remove(PeerState.PendingRequest)
                         if PeerState.Choked in self.peer_state:
                             self.peer_state.remove(PeerState.Choked)
                     elif type(message) is Have:
-                        if PeerState.PendingRequest in self.my_state:
-                            self.my_state.remove(PeerState.PendingRequest)
                         self.piece_manager.update_peer(self.remote_id,
                                                        message.index)
                     elif type(message) is KeepAlive:
-                        if PeerState.PendingRequest in self.my_state:
-                            self.my_state.remove(PeerState.PendingRequest)
                         pass
                     elif type(message) is Piece:
-                        self.my_state.remove(PeerState.PendingRequest)
+                        self.requests.received(message.index,
+                                               message.begin,
+                                               len(message.block))
+                        self.downloaded += len(message.block)
                         self.on_block_cb(
                             peer_id=self.remote_id,
                             piece_index=message.index,
                             block_offset=message.begin,
                             data=message.block)
                     elif type(message) is Request:
-                        for piece in self.piece_manager.have_pieces:
-                            if piece[message.index].is_complete():
-                                data = self.piece_manager.file_manager.read(
-                                    message.index,
-                                    message.begin,
-                                    message.length)
-                                self.writer.write(
-                                    Piece(message.index,
-                                          message.begin,
-                                          data).encode())
-                                await self.writer.drain()
-                                logging.info("Send data")
+                        await self._send_block(message)
                     elif type(message) is Cancel:
                         pass
 
                     logging.info(
-                        ip + ": " + str(self.peer_state) + str(self.my_state))
+                        ip + ": " + str(self.peer_state) + str(self.my_state)
+                        + " queue {pending}/{depth}".format(
+                            pending=len(self.requests),
+                            depth=self.queue_depth))
 
-                    # Send block request to remote peer if we're interested
+                    # Send block requests to remote peer if we're interested
                     if PeerState.Choked not in self.peer_state:
                         if PeerState.Interested in self.my_state:
-                            if PeerState.PendingRequest not in self.my_state:
-                                self.my_state.append(PeerState.PendingRequest)
-                                await self._request_piece()
+                            await self._request_pieces()
 
             except ProtocolError as e:
                 logging.exception('Protocol error: ' + str(e))
+                self.queue.ban(peer)
             except (ConnectionRefusedError, TimeoutError):
                 logging.warning('Unable to connect to peer')
             except (ConnectionResetError, CancelledError):
@@ -187,17 +294,49 @@ class PeerConnection:
                 logging.exception('Undefind error: ' + str(e))
                 await self.cancel()
                 continue
+            finally:
+                # The pieces of a disconnected peer are no longer available
+                if self.remote_id is not None:
+                    self.piece_manager.remove_peer(self.remote_id)
+                    self.queue.disconnected(
+                        peer, self.downloaded,
+                        time.monotonic() - connected_at)
+                elif connected_at is None:
+                    self.queue.connect_failed(peer)
+                else:
+                    self.queue.handshake_failed(peer)
         await self.cancel()
         self.stop()
 
-    async def cancel(self, index, begin):
+    async def cancel(self):
         """
-        Sends the cancel message to the remote peer and closes the connection.
+        Closes the connection to the current remote peer.
         """
         logging.info('Closing peer {id}'.format(id=self.remote_id))
+        if self.writer is not None:
+            self.writer.close()
 
-        self.writer.write(Cancel(index, begin))
-        await self.writer.drain()
+    def send_cancel(self, index: int, begin: int, length: int):
+        """
+        Cancels a previously requested block. The message is sent along with
+        the next write to the remote peer, or once the block being sent with
+        sendfile is out.
+        """
+        if (index, begin) in self.requests:
+            del self.requests.pending[(index, begin)]
+        message = Cancel(index, begin, length).encode()
+        if self.in_sendfile:
+            self.deferred.append(message)
+        elif self.writer is not None and not self.writer.is_closing():
+            self.writer.write(message)
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        The number of block requests currently allowed in flight to the
+        connected peer.
+        """
+        return self.requests.depth
 
     def stop(self):
         """
@@ -216,9 +355,23 @@ class PeerConnection:
         if not self.future.done():
             self.future.cancel()
 
-    async def _request_piece(self):
-        block = self.piece_manager.next_request(self.remote_id)
-        if block:
+    async def _request_pieces(self):
+        """
+        Fills the request pipeline up to its current depth.
+        """
+        self.requests.expire()
+        sent = False
+        while self.requests.free:
+            block = self.piece_manager.next_request(self.remote_id)
+            if not block:
+                break
+            if (block.piece, block.offset) in self.requests:
+                # Handed out again while still in flight here, e.g. it
+                # expired at the piece manager first. It is not sent twice,
+                # so another peer must be able to get it
+                self.piece_manager.release_requests(
+                    self.remote_id, [(block.piece, block.offset)])
+                break
             message = Request(block.piece, block.offset, block.length).encode()
 
             logging.debug('Requesting block {block} for piece {piece} '
@@ -229,7 +382,59 @@ class PeerConnection:
                               peer=self.remote_id))
 
             self.writer.write(message)
+            self.requests.sent(block.piece, block.offset)
+            sent = True
+        if sent:
+            await self.writer.drain()
+
+    def _clear_requests(self):
+        """
+        Drops the requests in flight, the piece manager hands their blocks
+        out again right away.
+        """
+        self.piece_manager.release_requests(self.remote_id,
+                                            list(self.requests.pending))
+        self.requests.clear()
+
+    async def _send_block(self, request: Request):
+        """
+        Answers a request of the remote peer with the block if we have it.
+
+        The block is sent with `sendfile` when the piece manager gives its
+        file and the transport is not encrypted, so it never enters our
+        memory. Otherwise it is read, through the read cache, and written.
+        """
+        source = self.piece_manager.block_file(
+            request.index, request.begin, request.length)
+        transport = self.writer.transport
+        if source is not None and \
+                transport.get_extra_info('sslcontext') is None:
+            with source as (file, offset):
+                self.writer.write(Piece.header(request.index, request.begin,
+                                               request.length))
+                await self.writer.drain()
+                # Falls back to reading the file if the transport cannot
+                # send it, the header is already out
+                self.in_sendfile = True
+                try:
+                    await asyncio.get_running_loop().sendfile(
+                        transport, file, offset, request.length)
+                finally:
+                    self.in_sendfile = False
+                    deferred, self.deferred = self.deferred, []
+                    if deferred and not self.writer.is_closing():
+                        self.writer.write(b''.join(deferred))
+            logging.debug('Sent block {begin} of piece {index}'.format(
+                begin=request.begin, index=request.index))
+            return
+        data = await self.piece_manager.read_block(
+            request.index, request.begin, request.length)
+        if data is not None:
+            self.writer.write(Piece(request.index,
+                                    request.begin,
+                                    data).encode())
             await self.writer.drain()
+            logging.info("Send data")
 
     async def _handshake(self):
         """
@@ -241,8 +446,12 @@ class PeerConnection:
 
         buf = b''
         while len(buf) < Handshake.length:
-            buf = await asyncio.wait_for(self.reader.read(
+            data = await asyncio.wait_for(self.reader.read(
                 PeerStreamIterator.CHUNK_SIZE), 15)
+            if not data:
+                raise ConnectionResetError('Connection closed during the '
+                                           'handshake')
+            buf += data
         response = Handshake.decode(buf[:Handshake.length])
         if not response:
             raise ProtocolError('Unable receive and parse a handshake')
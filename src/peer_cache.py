@@ -0,0 +1,93 @@
+import logging
+import os
+import socket
+import struct
+import time
+
+from src.bencoding import Decoder, Encoder
+
+VERSION = 1
+# The peers saved at most, and the seconds a saved peer is trusted
+MAX_PEERS = 200
+MAX_AGE = 7 * 24 * 3600
+
+# Per peer: IP, port, throughput in bytes per second, last seen time
+IPV4_ENTRY = struct.Struct('>4sHfI')
+IPV6_ENTRY = struct.Struct('>16sHfI')
+
+
+def cache_path(work_path, info) -> str:
+    """
+    Get the path of the peer cache of a torrent, named after its info hash.
+    """
+    return os.path.join(work_path, info.hash20.hex() + '.peers')
+
+
+def save(path, info_hash: bytes, peers):
+    """
+    Writes the peer cache, replacing it atomically like the resume file.
+
+    :param peers: The PeerCandidates to save, the best first, at most
+                  `MAX_PEERS` are kept
+    """
+    ipv4 = []
+    ipv6 = []
+    for candidate in peers[:MAX_PEERS]:
+        ip, port = candidate.address
+        try:
+            packed = socket.inet_pton(socket.AF_INET, ip)
+            ipv4.append(IPV4_ENTRY.pack(packed, port, candidate.rate,
+                                        int(candidate.last_seen)))
+        except OSError:
+            try:
+                packed = socket.inet_pton(socket.AF_INET6, ip)
+            except OSError:
+                # A host name from a dictionary model response
+                continue
+            ipv6.append(IPV6_ENTRY.pack(packed, port, candidate.rate,
+                                        int(candidate.last_seen)))
+    data = Encoder({
+        b'info hash': info_hash,
+        b'peers': b''.join(ipv4),
+        b'peers6': b''.join(ipv6),
+        b'version': VERSION,
+    }).encode()
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+def load(path, info_hash: bytes) -> list:
+    """
+    Reads the peer cache.
+
+    :return: A list of ((ip, port), throughput, last seen time) of the
+             peers seen within `MAX_AGE`, empty if there is no usable cache
+    """
+    try:
+        with open(path, 'rb') as file:
+            data = Decoder(file.read()).decode()
+        if data[b'version'] != VERSION or data[b'info hash'] != info_hash:
+            logging.info('Peer cache {path} is for another torrent'
+                         .format(path=path))
+            return []
+        entries = [(socket.AF_INET, IPV4_ENTRY, data[b'peers']),
+                   (socket.AF_INET6, IPV6_ENTRY, data[b'peers6'])]
+    except FileNotFoundError:
+        return []
+    except Exception:
+        logging.exception('Invalid peer cache {path}'.format(path=path))
+        return []
+    oldest = time.time() - MAX_AGE
+    peers = []
+    for family, entry, blob in entries:
+        view = memoryview(blob)
+        view = view[:len(view) - len(view) % entry.size]
+        for ip, port, rate, last_seen in entry.iter_unpack(view):
+            if last_seen >= oldest:
+                peers.append(((socket.inet_ntop(family, ip), port), rate,
+                              last_seen))
+    return peers
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import time
+
+
+class PeerCandidate:
+    """
+    What we know about a peer address: how connecting to it went so far and
+    how fast it sent us data.
+    """
+    __slots__ = ('address', 'attempts', 'failures', 'rate', 'banned',
+                 'in_use', 'retry_at', 'last_seen')
+
+    def __init__(self, address):
+        self.address = address
+        # Connection attempts, and failed ones in a row
+        self.attempts = 0
+        self.failures = 0
+        # Bytes per second received over the last connections
+        self.rate = 0.0
+        self.banned = False
+        # Handed to a connection that has not reported back yet
+        self.in_use = False
+        # The monotonic time before which the peer is not handed out again
+        self.retry_at = 0.0
+        # The wall clock time a tracker or a connection last saw the peer
+        self.last_seen = time.time()
+
+    @property
+    def score(self) -> tuple:
+        """
+        Peers that sent us data come first, the fastest first, then the ones
+        never tried, then the others, the fewest failures first.
+        """
+        if self.rate:
+            return 2, self.rate
+        if not self.attempts:
+            return 1, self.last_seen
+        return 0, -self.failures
+
+
+class PeerPool:
+    """
+    The candidate peers the `PeerConnection` workers connect to.
+
+    Peers are de-duplicated by (ip, port) and kept across announces. Each
+    worker reports how its connection went, so `get` hands out the best
+    peer not in use: the proven ones, then the ones never tried, then the
+    ones that failed. A peer that failed is not retried for
+    `RETRY_INTERVAL` seconds, doubled after every failure in a row; after
+    `MAX_FAILURES` failures in a row, or a protocol violation, it is banned.
+    A peer we were connected to is retried after `RETRY_INTERVAL` seconds.
+
+    At most `MAX_PEERS` peers are remembered, the lowest scoring ones not in
+    use are forgotten first.
+    """
+    MAX_PEERS = 1000
+    MAX_FAILURES = 5
+    RETRY_INTERVAL = 30
+
+    def __init__(self, max_peers=None):
+        """
+        :param max_peers: The number of peers remembered at most (default
+                          `MAX_PEERS`)
+        """
+        self.max_peers = max_peers or PeerPool.MAX_PEERS
+        self.candidates = {}
+        self.changed = asyncio.Event()
+        self.connect_failures = 0
+        self.handshake_failures = 0
+        self.bans = 0
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def add(self, peers):
+        """
+        Adds the (ip, port) of peers, e.g. from a tracker response.
+        """
+        now = time.time()
+        for address in peers:
+            address = tuple(address)
+            candidate = self.candidates.get(address)
+            if candidate is None:
+                self.candidates[address] = PeerCandidate(address)
+            else:
+                candidate.last_seen = now
+        self._evict()
+        self.changed.set()
+
+    def restore(self, peers):
+        """
+        Adds peers known from a previous session, e.g. from the peer cache.
+
+        :param peers: A list of ((ip, port), throughput, last seen time)
+        """
+        for address, rate, last_seen in peers:
+            address = tuple(address)
+            if address not in self.candidates:
+                candidate = PeerCandidate(address)
+                candidate.rate = rate
+                candidate.last_seen = last_seen
+                self.candidates[address] = candidate
+        self._evict()
+        self.changed.set()
+
+    def proven(self) -> list:
+        """
+        Get the peers that sent us data and are not banned, the fastest
+        first.
+        """
+        return sorted((candidate for candidate in self.candidates.values()
+                       if candidate.rate and not candidate.banned),
+                      key=lambda candidate: candidate.rate, reverse=True)
+
+    async def get(self):
+        """
+        Waits for a peer to connect to.
+
+        :return: The (ip, port) of the peer, that must be reported back with
+                 one of `connect_failed`, `handshake_failed` or
+                 `disconnected`
+        """
+        while True:
+            now = time.monotonic()
+            best = None
+            retry_at = None
+            for candidate in self.candidates.values():
+                if candidate.banned or candidate.in_use:
+                    continue
+                if candidate.retry_at > now:
+                    if retry_at is None or candidate.retry_at < retry_at:
+                        retry_at = candidate.retry_at
+                elif best is None or candidate.score > best.score:
+                    best = candidate
+            if best is not None:
+                best.in_use = True
+                best.attempts += 1
+                return best.address
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(
+                    self.changed.wait(),
+                    None if retry_at is None else retry_at - now)
+            except asyncio.TimeoutError:
+                pass
+
+    def connect_failed(self, address):
+        self.connect_failures += 1
+        self._failed(address)
+
+    def handshake_failed(self, address):
+        self.handshake_failures += 1
+        self._failed(address)
+
+    def disconnected(self, address, downloaded: int, seconds: float):
+        """
+        Reports a connection that got through the handshake has ended.
+
+        :param downloaded: The bytes of blocks received from the peer
+        :param seconds: The time we were connected
+        """
+        candidate = self._release(address)
+        if candidate is None:
+            return
+        candidate.failures = 0
+        candidate.last_seen = time.time()
+        if seconds > 0:
+            rate = downloaded / seconds
+            candidate.rate = rate if not candidate.rate \
+                else (candidate.rate + rate) / 2
+        candidate.retry_at = time.monotonic() + PeerPool.RETRY_INTERVAL
+
+    def ban(self, address):
+        """
+        Never hands out the peer again, e.g. it broke the protocol.
+        """
+        candidate = self._release(address)
+        if candidate is not None and not candidate.banned:
+            candidate.banned = True
+            self.bans += 1
+            logging.info('Banned peer {ip}:{port}'.format(
+                ip=address[0], port=address[1]))
+
+    def _failed(self, address):
+        candidate = self._release(address)
+        if candidate is None:
+            return
+        candidate.failures += 1
+        if candidate.failures >= PeerPool.MAX_FAILURES:
+            self.ban(address)
+        else:
+            candidate.retry_at = time.monotonic() + \
+                PeerPool.RETRY_INTERVAL * 2 ** (candidate.failures - 1)
+
+    def _release(self, address):
+        candidate = self.candidates.get(tuple(address))
+        if candidate is not None:
+            candidate.in_use = False
+            self.changed.set()
+        return candidate
+
+    def _evict(self):
+        excess = len(self.candidates) - self.max_peers
+        if excess <= 0:
+            return
+        # Banned peers are forgotten first, they may come back though
+        evictable = sorted(
+            (candidate for candidate in self.candidates.values()
+             if not candidate.in_use),
+            key=lambda candidate: (not candidate.banned, candidate.score))
+        for candidate in evictable[:excess]:
+            del self.candidates[candidate.address]
+
+    def stats(self) -> str:
+        return '{peers} peers, {connect} connect failures, {handshake} ' \
+               'handshake failures, {bans} bans'.format(
+                   peers=len(self.candidates),
+                   connect=self.connect_failures,
+                   handshake=self.handshake_failures, bans=self.bans)
@@ -205,6 +205,11 @@ class Unchoke(PeerMessage):
         <len=0001><id=1>
     """
 
+    def encode(self) -> bytes:
+        return struct.pack('>Ib',
+                           1,  # Message length
+                           PeerMessage.Unchoke)
+
     def __str__(self):
         return 'Unchoke'
 
@@ -297,19 +302,29 @@ class Piece(PeerMessage):
         self.block = block
 
     def encode(self):
-        message_length = Piece.length + len(self.block)
-        return struct.pack('>IbII' + str(len(self.block)) + 's',
-                           message_length,
+        # The block may be any bytes-like object, e.g. a view of a mapped
+        # file, so it is appended rather than packed
+        return Piece.header(self.index, self.begin, len(self.block)) \
+            + self.block
+
+    @staticmethod
+    def header(index: int, begin: int, length: int) -> bytes:
+        """
+        Encodes the message up to the block, for the block to be sent
+        separately.
+        """
+        return struct.pack('>IbII',
+                           Piece.length + length,
                            PeerMessage.Piece,
-                           self.index,
-                           self.begin,
-                           self.block)
+                           index,
+                           begin)
 
     @classmethod
     def decode(cls, data: bytes):
-        length = struct.unpack('>I', data[:4])[0]
-        parts = struct.unpack('>IbII' + str(length - Piece.length) + 's', data)
-        return cls(parts[2], parts[3], parts[4])
+        length, _, index, begin = struct.unpack_from('>IbII', data)
+        # Only the block itself is copied, `data` may be a memoryview into
+        # the receive buffer
+        return cls(index, begin, bytes(data[13:length + 4]))
 
     def __str__(self):
         return 'Piece'
@@ -11,14 +11,43 @@ class PeerStreamIterator:
     the given stream reader and tries to parse valid BitTorrent messages from
     off that stream of bytes.
 
+    Incoming bytes are appended to a single reusable `bytearray` and messages
+    are framed by moving a read cursor over it, so parsing a message never
+    copies the unparsed tail of the buffer. The consumed head is dropped just
+    before the next read from the socket.
+
+    If a `placement` callback is given, the block of a Piece message is not
+    kept in the buffer at all: as soon as the Piece header is framed the
+    callback is asked for a writable memoryview for
+    `(index, begin, length)` and the payload is copied straight into it as it
+    arrives. The yielded Piece message then carries that view as its block.
+    When the callback returns None the message is parsed as usual.
+
+    The placement of a block arriving over several reads may be revoked
+    meanwhile, e.g. because the block is requested from another peer as
+    well, whose copy could complete the piece first. Before each read is
+    copied to the target the `is_placing(index, begin)` callback, if given,
+    is asked whether the target is still ours; if not the rest of the block
+    is received into a buffer of its own.
+
     If the connection is dropped, something fails the iterator will abort by
     raising the `StopAsyncIteration` error ending the calling iteration.
     """
     CHUNK_SIZE = 10 * 1024
 
-    def __init__(self, reader, initial: bytes = None):
+    def __init__(self, reader, initial: bytes = None, placement=None,
+                 is_placing=None):
         self.reader = reader
-        self.buffer = initial if initial else b''
+        self.buffer = bytearray(initial if initial else b'')
+        # Position of the first byte that is not parsed yet
+        self.offset = 0
+        self.placement = placement
+        self.is_placing = is_placing
+        # [index, begin, target view, bytes filled] of the Piece message
+        # whose block is currently being read into its target
+        self.placing = None
+        # The placement callback already declined the message at the cursor
+        self.declined = False
 
     def __aiter__(self):
         return self
@@ -28,27 +57,19 @@ class PeerStreamIterator:
         # it and return the message. Until then keep reading from stream
         while True:
             try:
-                if len(self.buffer) >= 4:
-                    message_length = struct.unpack('>I', self.buffer[0:4])[0]
-                    if message_length == 0:
-                        if len(self.buffer) > 4:
-                            self.buffer = self.buffer[4:]
-                        else:
-                            self.buffer = b''
-                        return KeepAlive()
-                    if len(self.buffer) >= message_length + 4:
-                        message = self.parse(
-                            self.buffer[:message_length + 5], message_length)
-                        if len(self.buffer) > message_length + 4:
-                            self.buffer = self.buffer[message_length + 4:]
-                        else:
-                            self.buffer = b''
-                        if message:
-                            return message
-                        raise StopAsyncIteration
-                self.buffer += await asyncio.wait_for(
-                    self.reader.read(PeerStreamIterator.CHUNK_SIZE), 15)
+                if self.placing is None:
+                    message = self._next_message()
+                    if message is not None:
+                        return message
+                if self.placing is not None:
+                    message = await self._fill_placed()
+                    if message is not None:
+                        return message
+                    continue
+                await self._fill()
 
+            except StopAsyncIteration:
+                raise
             except ConnectionResetError:
                 logging.debug('Connection closed by peer')
                 raise StopAsyncIteration
@@ -59,13 +80,121 @@ class PeerStreamIterator:
             except Exception:
                 logging.exception('Error when iterating over stream!')
                 raise StopAsyncIteration
-        raise StopAsyncIteration
+
+    def _next_message(self):
+        """
+        Frames the next complete message at the read cursor and advances the
+        cursor past it.
+
+        :return The parsed message, or None if more bytes are needed
+        """
+        available = len(self.buffer) - self.offset
+        if available < 4:
+            return None
+        message_length = struct.unpack_from('>I', self.buffer, self.offset)[0]
+        if self.placement is not None and not self.declined and \
+                message_length > Piece.length and \
+                available >= Piece.length + 4 and \
+                self.buffer[self.offset + 4] == PeerMessage.Piece:
+            index, begin = struct.unpack_from('>II', self.buffer,
+                                              self.offset + 5)
+            target = self.placement(index, begin,
+                                    message_length - Piece.length)
+            if target is not None:
+                return self._start_placement(index, begin, target)
+            self.declined = True
+        if available < message_length + 4:
+            return None
+
+        start = self.offset
+        self.offset += message_length + 4
+        self.declined = False
+        if message_length == 0:
+            return KeepAlive()
+
+        with memoryview(self.buffer) as view:
+            with view[start:self.offset] as message_view:
+                message = self.parse(message_view, message_length)
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    def _start_placement(self, index, begin, target):
+        """
+        Moves the part of the block that is already buffered into `target`.
+
+        :return The Piece message if the whole block was buffered, else None
+        """
+        start = self.offset + 4 + Piece.length
+        size = min(len(self.buffer) - start, len(target))
+        with memoryview(self.buffer) as view:
+            target[:size] = view[start:start + size]
+        self.offset = start + size
+        self.placing = [index, begin, target, size]
+        if size == len(target):
+            return self._finish_placement()
+        return None
+
+    async def _fill_placed(self):
+        """
+        Reads the next chunk from the stream, copying the bytes belonging to
+        the block being placed directly into its target. Any bytes past the
+        block are appended to the buffer.
+
+        :return The Piece message once its block is complete, else None
+        """
+        index, begin, target, filled = self.placing
+        data = await asyncio.wait_for(
+            self.reader.read(PeerStreamIterator.CHUNK_SIZE), 15)
+        if not data:
+            logging.debug('Connection closed by peer')
+            raise StopAsyncIteration
+        if self.is_placing is not None and \
+                not self.is_placing(index, begin):
+            # The target may already be verified, it must not change
+            scratch = bytearray(len(target))
+            scratch[:filled] = target[:filled]
+            target = self.placing[2] = memoryview(scratch)
+        size = min(len(target) - filled, len(data))
+        with memoryview(data) as view:
+            target[filled:filled + size] = view[:size]
+            if size < len(data):
+                del self.buffer[:self.offset]
+                self.offset = 0
+                self.buffer += view[size:]
+        self.placing[3] = filled + size
+        if filled + size == len(target):
+            return self._finish_placement()
+        return None
+
+    def _finish_placement(self):
+        index, begin, target, _ = self.placing
+        self.placing = None
+        return Piece(index, begin, target)
+
+    async def _fill(self):
+        """
+        Drops the already parsed head of the buffer and appends the next chunk
+        read from the stream.
+        """
+        if self.offset:
+            del self.buffer[:self.offset]
+            self.offset = 0
+        data = await asyncio.wait_for(
+            self.reader.read(PeerStreamIterator.CHUNK_SIZE), 15)
+        if not data:
+            logging.debug('Connection closed by peer')
+            raise StopAsyncIteration
+        self.buffer += data
 
     def parse(self, message, message_length):
         """
         Tries to parse protocol messages if there is enough bytes read in the
         buffer.
 
+        The decoders only read from `message` (a view into the buffer), any
+        payload they keep is copied out of it.
+
         :return The parsed message, or None if no message could be parsed
         """
         # Each message is structured as:
@@ -81,24 +210,24 @@ class PeerStreamIterator:
         if message_length == 0:
             return KeepAlive()
 
-        message_id = struct.unpack('>b', self.buffer[4:5])[0]
+        message_id = struct.unpack_from('>b', message, 4)[0]
 
-        if message_id is PeerMessage.BitField:
+        if message_id == PeerMessage.BitField:
             return BitField.decode(message)
-        elif message_id is PeerMessage.Interested:
+        elif message_id == PeerMessage.Interested:
             return Interested()
-        elif message_id is PeerMessage.NotInterested:
+        elif message_id == PeerMessage.NotInterested:
             return NotInterested()
-        elif message_id is PeerMessage.Choke:
+        elif message_id == PeerMessage.Choke:
             return Choke()
-        elif message_id is PeerMessage.Unchoke:
+        elif message_id == PeerMessage.Unchoke:
             return Unchoke()
-        elif message_id is PeerMessage.Have:
+        elif message_id == PeerMessage.Have:
             return Have.decode(message)
-        elif message_id is PeerMessage.Piece:
+        elif message_id == PeerMessage.Piece:
             return Piece.decode(message)
-        elif message_id is PeerMessage.Request:
+        elif message_id == PeerMessage.Request:
             return Request.decode(message)
-        elif message_id is PeerMessage.Cancel:
+        elif message_id == PeerMessage.Cancel:
             return Cancel.decode(message)
         return None
@@ -0,0 +1,190 @@
+import random
+from array import array
+
+
+class PieceSet:
+    """
+    A set of piece indices stored as a bitmap of one bit per piece.
+
+    The bits are kept in the order of the BitTorrent bitfield (the high bit
+    of the first byte is piece 0), so a million pieces take 125 KiB no matter
+    how many of them are in the set.
+    """
+    __slots__ = ('size', 'bits', 'count')
+
+    def __init__(self, size: int):
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, index):
+        return 0 <= index < self.size and \
+            bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def __iter__(self):
+        for position, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (0x80 >> bit):
+                        yield position * 8 + bit
+
+    def add(self, index: int):
+        mask = 0x80 >> (index & 7)
+        if not self.bits[index >> 3] & mask:
+            self.bits[index >> 3] |= mask
+            self.count += 1
+
+    def discard(self, index: int):
+        mask = 0x80 >> (index & 7)
+        if self.bits[index >> 3] & mask:
+            self.bits[index >> 3] &= ~mask
+            self.count -= 1
+
+    def fill(self):
+        """
+        Adds every piece index to the set.
+        """
+        self._set(self._mask())
+
+    def set_bits(self, bits: bytes):
+        """
+        Replaces the members by the ones set in a bitfield, bits past the
+        size are ignored.
+        """
+        self._set(int.from_bytes(bits, 'big') & self._mask())
+
+    def difference_update(self, other: 'PieceSet'):
+        """
+        Removes the members of another set of the same size.
+        """
+        self._set(int.from_bytes(self.bits, 'big')
+                  & ~int.from_bytes(other.bits, 'big'))
+
+    def _mask(self) -> int:
+        return ((1 << self.size) - 1) << (len(self.bits) * 8 - self.size)
+
+    def _set(self, value: int):
+        # The bitmap is handled as one big integer, so bulk updates do not
+        # loop over the pieces in Python
+        self.bits[:] = value.to_bytes(len(self.bits), 'big')
+        self.count = bin(value).count('1')
+
+
+class PiecePicker:
+    """
+    Picks the next piece to download using the rarest-first strategy.
+
+    The picker counts for every piece how many of the connected peers have
+    it. The counts are updated incrementally as peers announce their bitfield,
+    send Have messages or disconnect. Wanted pieces (the ones not started yet)
+    are kept in buckets by their count, so the rarest pieces a peer has can be
+    found without scanning all pieces, and ties are broken randomly to spread
+    peers over different pieces.
+
+    All state is kept in flat arrays of machine integers: a piece is in one
+    bucket at most, so a single array holds the position of every wanted
+    piece within its bucket and removal swaps the piece with the last one.
+    """
+    # Random members tried in a bucket before falling back to a scan
+    SAMPLES = 8
+
+    def __init__(self, pieces_number: int):
+        self.pieces_number = pieces_number
+        self.availability = array('I', bytes(4 * pieces_number))
+        # buckets[count] holds the wanted pieces that `count` peers have
+        self.buckets = [array('I')]
+        # The position of each wanted piece in its bucket, -1 if not wanted
+        self.positions = array('i', [-1]) * pieces_number
+
+    def add_wanted(self, index: int):
+        """
+        Makes the piece available for picking.
+        """
+        if self.positions[index] < 0:
+            self._add(self.availability[index], index)
+
+    def add_all_wanted(self):
+        """
+        Makes every piece available for picking.
+        """
+        if len(self.buckets) == 1 and not self.buckets[0] and \
+                not any(self.availability):
+            # Nothing is wanted and no peer has anything yet, so every
+            # piece simply goes to the first bucket in order
+            self.buckets[0] = array('I', range(self.pieces_number))
+            self.positions = array('i', range(self.pieces_number))
+            return
+        for index in range(self.pieces_number):
+            self.add_wanted(index)
+
+    def remove_wanted(self, index: int):
+        """
+        Stops the piece from being picked, e.g. once it is started.
+        """
+        if self.positions[index] >= 0:
+            self._remove(self.availability[index], index)
+
+    def peer_added(self, bitfield):
+        for index in self._indices(bitfield):
+            self._change(index, 1)
+
+    def peer_removed(self, bitfield):
+        for index in self._indices(bitfield):
+            self._change(index, -1)
+
+    def peer_has(self, index: int):
+        """
+        Reflects a Have message of a peer that did not have the piece yet.
+        """
+        if index < self.pieces_number:
+            self._change(index, 1)
+
+    def pick(self, bitfield):
+        """
+        Picks one of the rarest wanted pieces that are set in the peer's
+        bitfield.
+
+        :return: The piece index or None if the peer has no wanted piece
+        """
+        for items in self.buckets[1:]:
+            if not items:
+                continue
+            for _ in range(min(len(items), PiecePicker.SAMPLES)):
+                index = items[random.randrange(len(items))]
+                if bitfield[index]:
+                    return index
+            start = random.randrange(len(items))
+            for index in items[start:] + items[:start]:
+                if bitfield[index]:
+                    return index
+        return None
+
+    def _indices(self, bitfield):
+        return (index for index in bitfield.findall([1])
+                if index < self.pieces_number)
+
+    def _change(self, index, delta):
+        count = self.availability[index]
+        self.availability[index] = count + delta
+        if self.positions[index] >= 0:
+            self._remove(count, index)
+            self._add(count + delta, index)
+
+    def _add(self, count, index):
+        while len(self.buckets) <= count:
+            self.buckets.append(array('I'))
+        items = self.buckets[count]
+        self.positions[index] = len(items)
+        items.append(index)
+
+    def _remove(self, count, index):
+        items = self.buckets[count]
+        position = self.positions[index]
+        last = items.pop()
+        if last != index:
+            items[position] = last
+            self.positions[last] = position
+        self.positions[index] = -1
@@ -0,0 +1,115 @@
+import asyncio
+from collections import OrderedDict
+
+
+class ReadCache:
+    """
+    A least recently used cache of whole pieces, serving the blocks we
+    upload.
+
+    Peers usually request the blocks of a piece one after the other, so on a
+    miss the whole piece is read in one go, together with up to `readahead`
+    following pieces we have, and the next requests are served from memory.
+    Once the cached pieces take more than `budget` bytes the least recently
+    used ones are evicted.
+    """
+    BUDGET = 64 * 2 ** 20
+    READAHEAD = 1
+
+    def __init__(self, disk_io, piece_length, have, budget=None,
+                 readahead=None):
+        """
+        :param disk_io: The DiskIO the pieces are read through
+        :param piece_length: A function giving the length of a piece
+        :param have: The indices of the pieces that can be read
+        :param budget: The bytes of pieces kept at most (default `BUDGET`)
+        :param readahead: The number of following pieces read on a miss
+                          (default `READAHEAD`)
+        """
+        self.disk_io = disk_io
+        self.piece_length = piece_length
+        self.have = have
+        self.budget = ReadCache.BUDGET if budget is None else budget
+        self.readahead = ReadCache.READAHEAD if readahead is None \
+            else readahead
+        # The cached pieces by index, least recently used first
+        self.pieces = OrderedDict()
+        self.size = 0
+        # The reads in progress by the index of every piece they read
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def read(self, index: int, offset: int, length: int):
+        """
+        Reads a block of a piece we have.
+
+        :return: The block or None if it could not be read
+        """
+        piece = self.pieces.get(index)
+        if piece is not None:
+            self.hits += 1
+            self.pieces.move_to_end(index)
+        elif index in self.loading:
+            self.hits += 1
+            piece = (await asyncio.shield(self.loading[index])).get(index)
+        else:
+            self.misses += 1
+            piece = (await self._load(index)).get(index)
+        if piece is None or offset + length > len(piece):
+            return None
+        return piece[offset:offset + length]
+
+    async def _load(self, index):
+        run = [index]
+        while len(run) <= self.readahead and run[-1] + 1 in self.have and \
+                run[-1] + 1 not in self.pieces and \
+                run[-1] + 1 not in self.loading:
+            run.append(run[-1] + 1)
+        future = asyncio.ensure_future(self._read(run))
+        for piece_index in run:
+            self.loading[piece_index] = future
+        # Other requests may wait for the same read, it goes on if this one
+        # is cancelled
+        return await asyncio.shield(future)
+
+    async def _read(self, run):
+        """
+        Reads consecutive pieces with a single read and caches them.
+
+        :return: The pieces read by index
+        """
+        lengths = [self.piece_length(index) for index in run]
+        try:
+            data = await self.disk_io.read(run[0], 0, sum(lengths))
+        finally:
+            for index in run:
+                del self.loading[index]
+        if data is None:
+            return {}
+        pieces = {}
+        position = 0
+        with memoryview(data) as view:
+            for index, length in zip(run, lengths):
+                pieces[index] = view[position:position + length]
+                position += length
+                self._add(index, pieces[index])
+        return pieces
+
+    def _add(self, index, piece):
+        if len(piece) > self.budget:
+            return
+        self.pieces[index] = piece
+        self.size += len(piece)
+        while self.size > self.budget:
+            _, evicted = self.pieces.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def stats(self) -> str:
+        return '{hits} hits, {misses} misses, {evictions} evictions, ' \
+               '{size} bytes cached'.format(hits=self.hits,
+                                            misses=self.misses,
+                                            evictions=self.evictions,
+                                            size=self.size)
@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+def check_pieces(pieces) -> list:
+    """
+    Runs in a worker process: reads and hashes a range of consecutive
+    pieces.
+
+    :param pieces: A list of (piece index, SHA1 hash, spans) where spans is
+                   the list of (path, offset, length) the piece is stored in
+    :return: The indices of the pieces matching their hash
+    """
+    verified = []
+    files = {}
+    try:
+        for index, hash_value, spans in pieces:
+            sha1 = hashlib.sha1()
+            for path, offset, length in spans:
+                if path not in files:
+                    try:
+                        files[path] = os.open(path, os.O_RDONLY)
+                    except OSError:
+                        files[path] = None
+                if files[path] is None:
+                    break
+                data = os.pread(files[path], length, offset)
+                if len(data) != length:
+                    # Never written that far
+                    break
+                sha1.update(data)
+            else:
+                if sha1.digest() == hash_value:
+                    verified.append(index)
+    finally:
+        for fd in files.values():
+            if fd is not None:
+                os.close(fd)
+    return verified
+
+
+class Recheck:
+    """
+    Verifies the pieces already in the downloaded files against their hash
+    from the meta-info, e.g. when there is no usable resume file.
+
+    The pieces are split into ranges of consecutive pieces of about
+    `RANGE_SIZE` bytes, each range is read sequentially and hashed by a
+    worker of a process pool, so all cores are used.
+    """
+    RANGE_SIZE = 64 * 2 ** 20
+
+    def __init__(self, file_manager, hashes, workers=None):
+        """
+        :param file_manager: The file manager of the torrent
+        :param hashes: The SHA1 hash of every piece
+        :param workers: The number of worker processes (default the number
+                        of cores)
+        """
+        self.file_manager = file_manager
+        self.hashes = hashes
+        self.workers = workers or os.cpu_count() or 1
+
+    def ranges(self, pieces) -> list:
+        """
+        Splits the given piece indices into the jobs for `check_pieces`.
+        Pieces with a part in a file that is not downloaded are left out.
+        """
+        piece_length = self.file_manager.info.piece_length
+        ranges = []
+        current = []
+        size = 0
+        for index in pieces:
+            spans = self.file_manager.spans(index, 0, piece_length)
+            if any(file_index not in self.file_manager.opened
+                   for file_index, _, _ in spans):
+                continue
+            if current and (size >= Recheck.RANGE_SIZE or
+                            current[-1][0] != index - 1):
+                ranges.append(current)
+                current = []
+                size = 0
+            current.append((index, self.hashes[index],
+                            [(self.file_manager.path(file_index),
+                              file_offset, length)
+                             for file_index, file_offset, length in spans]))
+            size += piece_length
+        if current:
+            ranges.append(current)
+        return ranges
+
+    async def run(self, pieces, progress=None) -> list:
+        """
+        Checks the given pieces.
+
+        :param pieces: The indices of the pieces to check
+        :param progress: Called with the number of pieces checked and the
+                         total number to check as ranges complete
+        :return: The indices of the pieces that match their hash
+        """
+        ranges = self.ranges(pieces)
+        total = sum(len(job) for job in ranges)
+        checked = 0
+        verified = []
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            # The number of pieces of each range being checked
+            pending = {loop.run_in_executor(executor, check_pieces, job):
+                       len(job) for job in ranges}
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    checked += pending.pop(future)
+                    verified.extend(future.result())
+                if progress:
+                    progress(checked, total)
+        logging.info('Recheck verified {verified} / {total} pieces'.format(
+            verified=len(verified), total=total))
+        return sorted(verified)
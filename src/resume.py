@@ -0,0 +1,89 @@
+import logging
+import os
+
+from src.bencoding import Decoder, Encoder
+
+VERSION = 1
+
+
+def resume_path(work_path, info) -> str:
+    """
+    Get the path of the resume file, next to the download.
+    """
+    return os.path.join(work_path, info.name + '.resume')
+
+
+def file_stats(file_manager) -> list:
+    """
+    Get the size and modification time of the downloaded files.
+
+    :return: A list of [file index, size, mtime in ns] by file index, the
+             size is -1 for a missing file
+    """
+    stats = []
+    for index in sorted(file_manager.opened):
+        try:
+            stat = os.stat(file_manager.path(index))
+            stats.append([index, stat.st_size, stat.st_mtime_ns])
+        except OSError:
+            stats.append([index, -1, 0])
+    return stats
+
+
+def save(path, file_manager, pieces_number: int, have: bytes,
+         partial: {int: bytes}):
+    """
+    Writes the resume file. The file is replaced atomically, so a crash
+    leaves either the old or the new one.
+
+    :param file_manager: The opened file manager the stats are taken from
+    :param pieces_number: The number of pieces of the torrent
+    :param have: The bitfield of the verified pieces
+    :param partial: The bitfield of the retrieved blocks by piece index for
+                    the pieces whose blocks are stored in the files
+    """
+    data = Encoder({
+        b'files': file_stats(file_manager),
+        b'have': bytes(have),
+        b'partial': {str(index).encode(): bytes(blocks)
+                     for index, blocks in sorted(partial.items())},
+        b'pieces': pieces_number,
+        b'version': VERSION,
+    }).encode()
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+def load(path, file_manager, pieces_number: int):
+    """
+    Reads the resume file if it matches the downloaded files.
+
+    :return: The bitfield of the verified pieces and the partial pieces as
+             passed to `save`, or None if there is no usable resume file
+    """
+    try:
+        with open(path, 'rb') as file:
+            data = Decoder(file.read()).decode()
+        if data[b'version'] != VERSION or data[b'pieces'] != pieces_number:
+            logging.info('Resume file {path} is for another torrent'
+                         .format(path=path))
+            return None
+        if data[b'files'] != file_stats(file_manager):
+            logging.info('Files changed since {path} was written'
+                         .format(path=path))
+            return None
+        have = data[b'have']
+        partial = {int(index): blocks
+                   for index, blocks in data[b'partial'].items()}
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logging.exception('Invalid resume file {path}'.format(path=path))
+        return None
+    if len(have) != (pieces_number + 7) // 8:
+        return None
+    return have, partial
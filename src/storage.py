@@ -0,0 +1,165 @@
+import abc
+import bisect
+
+
+class Storage(abc.ABC):
+    """
+    Where the pieces of a torrent are stored, the interface the PieceManager
+    and DiskIO use.
+
+    The torrent content is the concatenation of its files, so the start
+    offset of every file within the content is precomputed once. The files
+    a range of a piece falls into are then found by bisecting those offsets.
+
+    Subclasses implement at least `read` and `write`, which may be called
+    from several I/O threads at once, or they cannot be instantiated.
+    """
+    # The stored data outlives the process, so a resume file and a recheck
+    # of the data already stored make sense
+    persistent = False
+
+    def __init__(self, info, files):
+        """
+        :param info: The torrent meta-info
+        :param files: The indices of the files to download, in the order of
+                      the meta-info
+        """
+        self.info = info
+        self.files = set(files)
+        if self.info.is_multi_file:
+            lengths = [file['length'] for file in self.info.files]
+        else:
+            lengths = [self.info.length]
+        # offsets[i] is the start of file `i` within the torrent content,
+        # the last item is the total length
+        self.offsets = [0]
+        for length in lengths:
+            self.offsets.append(self.offsets[-1] + length)
+
+    def spans(self, index: int, offset: int, length: int) -> list:
+        """
+        Get the parts of the files the given range of a piece is stored in.
+
+        :return: A list of (file index, offset within the file, length)
+        """
+        start = index * self.info.piece_length + offset
+        end = min(start + length, self.offsets[-1])
+        spans = []
+        # The last file starting at or before `start`, empty files are
+        # skipped as they share their offset with the next file
+        file_index = bisect.bisect_right(self.offsets, start) - 1
+        while start < end:
+            file_end = self.offsets[file_index + 1]
+            if file_end > start:
+                size = min(end, file_end) - start
+                spans.append((file_index,
+                              start - self.offsets[file_index], size))
+                start += size
+            file_index += 1
+        return spans
+
+    def need_piece(self, index: int) -> bool:
+        """
+        Get whether a piece has a part in a file to download.
+        """
+        return any(file_index in self.files for file_index, _, _ in
+                   self.spans(index, 0, self.info.piece_length))
+
+    def piece_buffer(self, index: int, length: int):
+        """
+        Get the writable buffer the blocks of a piece should be received
+        into, if the storage provides one.
+
+        :return: None, the PieceManager allocates the buffer
+        """
+        return None
+
+    def block_file(self, index: int, offset: int, length: int):
+        """
+        Get the file a range of a piece is stored in, to send it with
+        `sendfile`.
+
+        :return: None, the storage has no files
+        """
+        return None
+
+    def open(self):
+        pass
+
+    @abc.abstractmethod
+    def write(self, piece):
+        """
+        Stores a verified piece, the parts of files not downloaded are
+        dropped.
+        """
+
+    def write_pieces(self, pieces):
+        """
+        Stores consecutive verified pieces.
+        """
+        for piece in pieces:
+            self.write(piece)
+
+    @abc.abstractmethod
+    def read(self, index: int, offset: int, length: int):
+        """
+        Reads a range of a piece, possibly running into the next pieces.
+
+        :return: The data or None if the range is not within the torrent or
+                 touches a file that is not downloaded
+        """
+
+    def sync(self):
+        """
+        Flushes the written data to the disks.
+        """
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self) -> str:
+        return ''
+
+
+class MemoryStorage(Storage):
+    """
+    Keeps the pieces in memory, e.g. to benchmark the network and piece
+    picking without the noise of the disks or to simulate a swarm.
+
+    Every written piece is copied as a whole, including the parts of files
+    that are not downloaded, which are however never read.
+    """
+
+    def __init__(self, info, files):
+        super().__init__(info, files)
+        # The written pieces by index
+        self.pieces = {}
+
+    def write(self, piece):
+        self.pieces[piece.index] = bytes(piece.data)
+
+    def read(self, index, offset, length):
+        spans = self.spans(index, offset, length)
+        if sum(size for _, _, size in spans) != length or \
+                any(file_index not in self.files
+                    for file_index, _, _ in spans):
+            return None
+        parts = []
+        piece_length = self.info.piece_length
+        # Offsets within the torrent content
+        start = index * piece_length + offset
+        end = start + length
+        while start < end:
+            piece = self.pieces.get(start // piece_length)
+            if piece is None:
+                # Never written, like a hole in a file
+                piece = bytes(piece_length)
+            piece_offset = start % piece_length
+            size = min(end - start, len(piece) - piece_offset)
+            parts.append(piece[piece_offset:piece_offset + size])
+            start += size
+        return b''.join(parts)
+
+    def stats(self) -> str:
+        return '{pieces} pieces in memory'.format(pieces=len(self.pieces))
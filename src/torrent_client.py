@@ -1,14 +1,26 @@
 import asyncio
 import logging
 import math
+import os
 import time
 import hashlib
 from asyncio import Queue
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from bitstring import BitArray
 
 from src.tracker import Tracker
 from src.peer import PeerConnection, REQUEST_SIZE
+from src.peer_pool import PeerPool
 from src.uploader import Uploader
-from src.file_manager import FileManager
+from src.file_manager import FileManager, MmapFileManager
+from src.disk_io import DiskIO
+from src.read_cache import ReadCache
+from src.write_cache import WriteCache
+from src.piece_picker import PiecePicker, PieceSet
+from src.recheck import Recheck
+from src import peer_cache, resume
 
 
 class TorrentClient:
@@ -30,8 +42,26 @@ class TorrentClient:
     MAX_PEER_CONNECTIONS = 35
     MAX_PEER_UPLOAD_CONNECTIONS = 15
     SPEED_CALCULATE_INTERVAL = 1
+    # Seconds between two writes of the resume file
+    CHECKPOINT_INTERVAL = 60
 
-    def __init__(self, info, files, work_path):
+    def __init__(self, info, files, work_path, hash_workers=None,
+                 storage='file', recheck=False, fsync='never',
+                 allocation='compact', sendfile=False):
+        """
+        :param info: The torrent meta-info
+        :param files: Indices of the files to download
+        :param work_path: Folder for downloading files
+        :param hash_workers: The number of threads verifying pieces, see
+                             `PieceManager`
+        :param storage: Where the pieces are stored, see `PieceManager`
+        :param recheck: Verify the data already in the files when there is
+                        no usable resume file
+        :param fsync: When the written pieces are synced to the disks, see
+                      `WriteCache`
+        :param allocation: How the files are allocated, see `FileManager`
+        :param sendfile: Upload blocks with `sendfile`, see `PieceManager`
+        """
         self.tracker = Tracker(info)
         self.info = info
 
@@ -43,9 +73,11 @@ class TorrentClient:
         self.speed = 0
         # self.dht = btdht.DHT()
 
-        # The list of potential peers is the work queue, consumed by the
-        # PeerConnections
-        self.available_peers = Queue()
+        # The potential peers are the work queue, consumed by the
+        # PeerConnections, kept across announces and scored by how the
+        # connections to them went
+        self.available_peers = PeerPool()
+        self.peer_cache_path = peer_cache.cache_path(work_path, info)
         # The list of peers is the list of workers that *might* be connected
         # to a peer. Else they are waiting to consume new remote peers from
         # the `available_peers` queue. These are our workers!
@@ -57,8 +89,14 @@ class TorrentClient:
         self.uploaders = []
 
         self.listener = None
-
-        self.piece_manager = PieceManager(info, self.files, self.work_path)
+        self.checkpointer = None
+
+        self.piece_manager = PieceManager(info, self.files, self.work_path,
+                                          hash_workers, storage, fsync,
+                                          allocation, sendfile)
+        self.piece_manager.cancel_request = self._cancel_request
+        self.piece_manager.recheck_progress = self._recheck_progress
+        self.recheck = recheck
         self.abort = False
 
     async def start(self):
@@ -69,7 +107,14 @@ class TorrentClient:
         peers to communicate with. Once the torrent is fully downloaded or
         if the download is aborted this method will complete.
         """
+        if self.recheck and not self.piece_manager.resumed:
+            await self.piece_manager.recheck()
         self.listener = asyncio.ensure_future(self.listen())
+        self.checkpointer = asyncio.ensure_future(self.checkpoint())
+        # The peers of the last session are tried before the tracker
+        # answers, or when it does not
+        self.available_peers.restore(peer_cache.load(
+            self.peer_cache_path, self.info.hash20))
 
         self.peers = [PeerConnection(self.available_peers,
                                      self.tracker.info.hash20,
@@ -81,6 +126,8 @@ class TorrentClient:
 
         self.uploaders = [Uploader(
             self.uploader_queue,
+            self.tracker.info.hash20,
+            self.info.peer_id,
             self.piece_manager
         )] * self.MAX_PEER_UPLOAD_CONNECTIONS
 
@@ -99,15 +146,21 @@ class TorrentClient:
                 # logging.info("Tracker response: {resp}".format(
                 #   resp=(response if response is not None else 'None')))
 
-                if response:
+                if response.failure is None:
                     first = False
                     interval = response.interval
-                    self._empty_queue()
-                    for peer in response.peers:
-                        await self.available_peers.put(peer)
-
-            except Exception as e:
-                raise e
+                    self.available_peers.add(response.peers)
+                else:
+                    logging.warning('Tracker refused the announce: '
+                                    '{reason}'.format(
+                                        reason=response.failure))
+                    interval = self.tracker.next_retry() or interval
+            except ConnectionError as error:
+                # The peers already known, e.g. from the peer cache, keep
+                # downloading while the trackers are backed off
+                logging.warning('Announce failed: {error}'.format(
+                    error=error))
+                interval = self.tracker.next_retry() or interval
 
             await asyncio.sleep(interval)
 
@@ -132,10 +185,6 @@ class TorrentClient:
 
             # await self.stop()
 
-    def _empty_queue(self):
-        while not self.available_peers.empty():
-            self.available_peers.get_nowait()
-
     async def stop(self):
         """
         Stop the download or seeding process.
@@ -143,9 +192,38 @@ class TorrentClient:
         self.abort = True
         for peer in self.peers:
             peer.stop()
-        self.piece_manager.file_manager.close()
+        if self.checkpointer:
+            self.checkpointer.cancel()
+        await self.piece_manager.flush(shutdown=True)
+        self.piece_manager.save_resume()
+        await self.save_peers()
+        self.piece_manager.close()
+        logging.info('Peer pool ' + self.available_peers.stats())
         await self.tracker.close()
 
+    async def checkpoint(self):
+        """
+        Periodically writes the resume file and the peer cache, so a
+        restart continues where the download was.
+        """
+        while not self.abort:
+            await asyncio.sleep(self.CHECKPOINT_INTERVAL)
+            await self.piece_manager.checkpoint()
+            await self.save_peers()
+
+    async def save_peers(self):
+        """
+        Writes the peers that sent us data to the peer cache on the I/O
+        thread pool.
+        """
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.piece_manager.disk_io.executor,
+                partial(peer_cache.save, self.peer_cache_path,
+                        self.info.hash20, self.available_peers.proven()))
+        except OSError:
+            logging.exception('Failed to write the peer cache')
+
     def _on_block_retrieved(self, peer_id, piece_index, block_offset, data):
         """
         Callback function called by the `PeerConnection` when a block is
@@ -171,6 +249,19 @@ class TorrentClient:
             peer_id=peer_id, piece_index=piece_index,
             block_offset=block_offset, data=data)
 
+    def _recheck_progress(self, checked, total):
+        logging.info('Rechecked {checked} / {total} pieces'.format(
+            checked=checked, total=total))
+
+    def _cancel_request(self, peer_id, block):
+        """
+        Callback function called by the `PieceManager` when a block requested
+        from the given peer is not needed anymore.
+        """
+        for peer in self.peers:
+            if peer.remote_id == peer_id:
+                peer.send_cancel(block.piece, block.offset, block.length)
+
     async def new_connection_handle(self, reader, writer):
         self.uploader_queue.put_nowait((reader, writer))
 
@@ -193,12 +284,13 @@ class Block:
     Pending = 1
     Retrieved = 2
 
+    __slots__ = ('piece', 'offset', 'length', 'status', 'start_time')
+
     def __init__(self, piece: int, offset: int, length: int):
         self.piece = piece
         self.offset = offset
         self.length = length
         self.status = Block.Missing
-        self.data = None
         self.start_time = None
 
 
@@ -211,12 +303,37 @@ class Piece:
     data between peers a smaller unit is used - this smaller piece is refereed
     to as `Block` by the unofficial specification (the official specification
     uses piece for this one as well, which is slightly confusing).
+
+    The SHA1 of a piece is computed incrementally: whenever the blocks
+    retrieved in order from the start of the piece grow, they are fed into a
+    running hash, blocks retrieved out of order wait in the buffer until the
+    gap before them is filled.
     """
+    __slots__ = ('index', 'blocks', 'hash', 'length', 'buffer', 'in_place',
+                 'retrieved', 'missing_from', 'sha1', 'hashed', 'hashing')
 
     def __init__(self, index: int, blocks: [], hash_value):
         self.index = index
+        # The blocks in order of their offset, block `i` is at offset
+        # `i * REQUEST_SIZE`
         self.blocks = blocks
         self.hash = hash_value
+        self.length = sum(block.length for block in blocks)
+        # Received blocks are stored at their offset in this buffer, it is
+        # either provided by the storage (e.g. a view of a mapped file) or
+        # allocated when the first block arrives
+        self.buffer = None
+        # The buffer is part of the downloaded files
+        self.in_place = False
+        # The number of retrieved blocks and the position of the first block
+        # that might still be missing
+        self.retrieved = 0
+        self.missing_from = 0
+        # The running SHA1 of the first `hashed` blocks, `hashing` is set
+        # while more blocks are being fed into it
+        self.sha1 = hashlib.sha1()
+        self.hashed = 0
+        self.hashing = False
 
     def reset(self):
         """
@@ -224,32 +341,128 @@ class Piece:
         """
         for block in self.blocks:
             block.status = Block.Missing
+        self.retrieved = 0
+        self.missing_from = 0
+        self.sha1 = hashlib.sha1()
+        self.hashed = 0
+
+    def release(self, offset: int) -> bool:
+        """
+        Puts a requested block back to Missing, e.g. the peer it was
+        requested from discarded the request.
+
+        :return: True if the block was pending
+        """
+        block = self.block(offset)
+        if block is None or block.status is not Block.Pending:
+            return False
+        block.status = Block.Missing
+        self.missing_from = min(self.missing_from, offset // REQUEST_SIZE)
+        return True
 
     def next_request(self) -> Block:
         """
         Get the next Block to be requested
         """
-        missing = [b for b in self.blocks if b.status is Block.Missing]
-        if missing:
-            missing[0].status = Block.Pending
-            return missing[0]
+        if self.has_missing():
+            block = self.blocks[self.missing_from]
+            block.status = Block.Pending
+            self.missing_from += 1
+            return block
         return None
 
+    def has_missing(self) -> bool:
+        """
+        Checks if any block of this piece is neither requested nor retrieved.
+        """
+        # Blocks only become Missing again on reset or release, which move
+        # the position back themselves
+        while self.missing_from < len(self.blocks) and \
+                self.blocks[self.missing_from].status is not Block.Missing:
+            self.missing_from += 1
+        return self.missing_from < len(self.blocks)
+
+    def retrieved_bits(self) -> bytes:
+        """
+        Get a bitfield of the retrieved blocks.
+        """
+        bits = PieceSet(len(self.blocks))
+        for position, block in enumerate(self.blocks):
+            if block.status is Block.Retrieved:
+                bits.add(position)
+        return bytes(bits.bits)
+
+    def restore(self, retrieved: bytes):
+        """
+        Marks the blocks set in a bitfield from `retrieved_bits` as
+        retrieved, their data must be in the buffer already.
+        """
+        bits = PieceSet(len(self.blocks))
+        bits.set_bits(retrieved)
+        for position in bits:
+            if self.blocks[position].status is not Block.Retrieved:
+                self.blocks[position].status = Block.Retrieved
+                self.retrieved += 1
+
+    def block(self, offset: int) -> Block:
+        """
+        Get the block at the given offset or None if there is no such block.
+        """
+        index, rest = divmod(offset, REQUEST_SIZE)
+        if rest or not 0 <= index < len(self.blocks):
+            return None
+        return self.blocks[index]
+
+    def block_buffer(self, offset: int, length: int):
+        """
+        Get a writable view of the buffer where the block at `offset` is
+        stored, so the block can be received directly into it.
+
+        :return: A memoryview of `length` bytes or None if the block is
+                 unknown, already retrieved or has another length
+        """
+        block = self.block(offset)
+        if block is None or block.status is Block.Retrieved or \
+                block.length != length:
+            return None
+        return memoryview(self._allocate())[offset:offset + length]
+
     def block_received(self, offset: int, data: bytes):
         """
         Update block information that the given block is now received
 
         :param offset: The block offset (within the piece)
-        :param data: The block data
+        :param data: The block data, either bytes or a view returned by
+                     `block_buffer` that is already filled
         """
-        matches = [b for b in self.blocks if b.offset == offset]
-        block = matches[0] if matches else None
-        if block:
-            block.status = Block.Retrieved
-            block.data = data
-        else:
+        block = self.block(offset)
+        if block is None:
             logging.warning('Trying to complete a non-existing block {offset}'
                             .format(offset=offset))
+        elif len(data) != block.length:
+            logging.warning('Block {offset} has wrong length {length}'
+                            .format(offset=offset, length=len(data)))
+        else:
+            if block.status is not Block.Retrieved:
+                block.status = Block.Retrieved
+                self.retrieved += 1
+            if not self._is_placed(data):
+                self._allocate()[offset:offset + block.length] = data
+
+    def _is_placed(self, data) -> bool:
+        """
+        Checks if `data` is a view returned by `block_buffer`, i.e. it is
+        already in place.
+        """
+        if not isinstance(data, memoryview) or self.buffer is None:
+            return False
+        with memoryview(self.buffer) as buffer:
+            return data.obj is buffer.obj
+
+    def _allocate(self):
+        if self.buffer is None:
+            self.buffer = bytearray(self.length)
+        return self.buffer
 
     def is_complete(self) -> bool:
         """
@@ -257,8 +470,29 @@ class Piece:
 
         :return: True or False
         """
-        blocks = [b for b in self.blocks if b.status is not Block.Retrieved]
-        return len(blocks) is 0
+        return self.retrieved == len(self.blocks)
+
+    def hashable(self) -> (int, int):
+        """
+        Get the range of blocks that are retrieved in order right after the
+        already hashed blocks.
+
+        :return: The first and past the last block index of the range
+        """
+        end = self.hashed
+        while end < len(self.blocks) and \
+                self.blocks[end].status is Block.Retrieved:
+            end += 1
+        return self.hashed, end
+
+    def update_hash(self, sha1, start: int, end: int):
+        """
+        Feed the given range of retrieved blocks into `sha1`. The buffer is
+        read in place, so this may run on another thread.
+        """
+        first = self.blocks[start].offset
+        last = self.blocks[end - 1].offset + self.blocks[end - 1].length
+        sha1.update(memoryview(self.buffer)[first:last])
 
     def is_hash_matching(self) -> bool:
         """
@@ -267,19 +501,22 @@ class Piece:
 
         :return: True or False
         """
-        return self.hash == hashlib.sha1(self.data).digest()
+        start, end = self.hashable()
+        if start < end:
+            self.update_hash(self.sha1, start, end)
+            self.hashed = end
+        return self.hashed == len(self.blocks) and \
+            self.hash == self.sha1.digest()
 
     @property
     def data(self):
         """
-        Return the data for this piece (by concatenating all blocks in order)
+        Return the data for this piece as a view of the piece buffer
 
         NOTE: This method does not control that all blocks are valid or even
         existing!
         """
-        retrieved = sorted(self.blocks, key=lambda b: b.offset)
-        blocks_data = [b.data for b in retrieved]
-        return b''.join(blocks_data)
+        return memoryview(self._allocate())
 
 
 class PieceManager:
@@ -288,63 +525,189 @@ class PieceManager:
     pieces for the connected peers as well as the pieces we have available for
     other peers.
 
-    The strategy on which piece to request is made as simple as possible in
-    this implementation.
-    """
+    New pieces are picked rarest first (see `PiecePicker`), started pieces
+    are finished before new ones are started.
+
+    Once every remaining block is requested the manager enters endgame mode:
+    pending blocks are requested from up to `max_duplicate_requests` peers
+    at once, and when the first copy of a block arrives the other peers are
+    told to cancel their request through `cancel_request`.
+
+    Pieces are hashed incrementally as their blocks arrive in order, the
+    hashing runs on a thread pool (hashlib releases the GIL while hashing) so
+    the event loop keeps serving the peer connections.
 
-    def __init__(self, info, files, work_path):
+    Verified pieces are written to disk through a `WriteCache` that
+    coalesces adjacent pieces, and `DiskIO`, off the event loop. While
+    either of them is full no new pieces are started.
+
+    Only the pieces in flight are `Piece` objects with their blocks, they are
+    created when a piece is started. The missing and completed pieces are
+    bitmaps of piece indices (see `PieceSet`), so the memory used does not
+    grow with the size of the torrent.
+    """
+    HASH_WORKERS = min(4, os.cpu_count() or 1)
+    # The file managers by the name of their storage
+    STORAGES = {'file': FileManager,
+                'mmap': MmapFileManager}
+
+    def __init__(self, info, files, work_path, hash_workers=None,
+                 storage='file', fsync='never', allocation='compact',
+                 sendfile=False):
+        """
+        :param info: The torrent meta-info
+        :param files: Indices of the files to download
+        :param work_path: Folder for downloading files
+        :param hash_workers: The number of threads verifying pieces
+                             (default `HASH_WORKERS`)
+        :param storage: 'file' to read and write the files with system
+                        calls, 'mmap' to map them into memory, or a
+                        `Storage` object, e.g. a `MemoryStorage`, the
+                        manager opens and closes
+        :param fsync: When the written pieces are synced to the disks, see
+                      `WriteCache`
+        :param allocation: How the files are allocated, see `FileManager`
+        :param sendfile: Upload the blocks lying in a single file straight
+                         from the file to the socket, see `block_file`
+        """
         self.info = info
         self.files = files
         self.work_path = work_path
-        self.file_manager = FileManager(self.info, self.files, self.work_path)
-        self.file_manager.open()
+        if isinstance(storage, str):
+            storage = PieceManager.STORAGES[storage](
+                self.info, self.files, self.work_path, allocation)
+        self.storage = storage
+        self.storage.open()
+        self.disk_io = DiskIO(self.storage)
+        self.write_cache = WriteCache(self.disk_io, self._piece_written,
+                                      self._reopen, fsync=fsync)
         self.start_time = None
         self.peers = {}
-        self.pending_blocks = []
-        self.missing_pieces = self._init_pieces()
-        self.ongoing_pieces = []
-        self.have_pieces = []
+        # Requested blocks by (piece index, block offset), in the order they
+        # were (re-)requested and therefore the order they expire in
+        self.pending_blocks = {}
+        # The peers each pending block is requested from
+        self.requesters = {}
+        # The (piece index, block offset) of the blocks being received
+        # straight into their piece buffer
+        self.placing = set()
+        self.hashes = info.pieces
+        self.total_pieces = len(self.hashes)
+        self.picker = PiecePicker(self.total_pieces)
+        # Indices of the needed pieces that are not started yet
+        self.missing_pieces = PieceSet(self.total_pieces)
+        # Started pieces by index, and the subset of them that still have
+        # blocks not requested yet
+        self.ongoing_pieces = {}
+        self.open_pieces = {}
+        # Indices of the verified pieces
+        self.have_pieces = PieceSet(self.total_pieces)
+        self.read_cache = ReadCache(self.disk_io, self._piece_length,
+                                    self.have_pieces)
+        self.sendfile = sendfile
         self.max_pending_time = 30 * 1000  # 30 second
-        self.total_pieces = len(info.pieces)
+        # The number of peers a block is requested from in endgame mode
+        self.max_duplicate_requests = 3
+        # Bytes of blocks received more than once
+        self.bytes_wasted = 0
+
+        self.hash_executor = ThreadPoolExecutor(
+            max_workers=hash_workers or PieceManager.HASH_WORKERS)
+        # The number of hash jobs waiting for or running on the pool, the
+        # number of pieces verified and the seconds spent hashing
+        self.hash_queue_length = 0
+        self.pieces_hashed = 0
+        self.hash_time = 0
+
+        self.resume_path = resume.resume_path(self.work_path, self.info)
+        # A usable resume file was found
+        self.resumed = False
+        self._init_pieces()
 
         # self.have_pieces = self.missing_pieces[0:int(
         #    len(self.missing_pieces)*0.9)]
         # del self.missing_pieces[0:int(len(self.missing_pieces)*0.9)]
 
-    def _init_pieces(self) -> [Piece]:
+    @property
+    def file_manager(self):
         """
-        Pre-construct the list of pieces and blocks based on the number of
-        pieces and request size for this torrent.
+        The storage, by its name from when it was always a FileManager.
         """
-        pieces = []
-        total_pieces = len(self.info.pieces)
-        blocks_number = math.ceil(self.info.piece_length / REQUEST_SIZE)
+        return self.storage
 
-        for index, hash_value in enumerate(self.info.pieces):
-            # The number of blocks for each piece can be calculated using the
-            # request size as divisor for the piece length.
-            # The final piece however, will most likely have fewer blocks
-            # than 'regular' pieces, and that final block might be smaller
-            # then the other blocks.
-            if index < (total_pieces - 1):
-                blocks = [Block(index, offset * REQUEST_SIZE, REQUEST_SIZE)
-                          for offset in range(blocks_number)]
-            else:
-                last_length = self.info.length % self.info.piece_length
-                last_blocks_number = math.ceil(last_length / REQUEST_SIZE)
-                blocks = [Block(index, offset * REQUEST_SIZE, REQUEST_SIZE)
-                          for offset in range(last_blocks_number)]
-
-                if last_length % REQUEST_SIZE > 0:
-                    # Last block of the last piece might be smaller than
-                    # the ordinary request size.
-                    last_block = blocks[-1]
-                    last_block.length = last_length % REQUEST_SIZE
-                    blocks[-1] = last_block
-            piece = Piece(index, blocks, hash_value)
-            if self.file_manager.need_piece(piece):
-                pieces.append(piece)
-        return pieces
+    def _init_pieces(self):
+        """
+        Marks the pieces of the selected files as missing, except the ones
+        the resume file tells are downloaded already.
+        """
+        if not self.info.is_multi_file:
+            self.missing_pieces.fill()
+        else:
+            for index in range(self.total_pieces):
+                if self.storage.need_piece(index):
+                    self.missing_pieces.add(index)
+        self._resume()
+        if len(self.missing_pieces) == self.total_pieces:
+            self.picker.add_all_wanted()
+        else:
+            for index in self.missing_pieces:
+                self.picker.add_wanted(index)
+
+    def _resume(self):
+        """
+        Trusts the resume file written by `checkpoint` if the files did not
+        change since: its verified pieces are have, and the retrieved blocks
+        of its partial pieces are not requested again.
+        """
+        if not self.storage.persistent:
+            return
+        resumed = resume.load(self.resume_path, self.storage,
+                              self.total_pieces)
+        if resumed is None:
+            return
+        self.resumed = True
+        have, partial = resumed
+        self.have_pieces.set_bits(have)
+        self.missing_pieces.difference_update(self.have_pieces)
+        for index, retrieved in partial.items():
+            if index not in self.missing_pieces:
+                continue
+            piece = self._new_piece(index)
+            if not piece.in_place:
+                continue
+            piece.restore(retrieved)
+            self.missing_pieces.discard(index)
+            self.ongoing_pieces[index] = piece
+            if piece.has_missing():
+                self.open_pieces[index] = piece
+            self._hash_retrieved(piece)
+        logging.info('Resumed {have} / {total} pieces, {partial} partial'
+                     .format(have=len(self.have_pieces),
+                             total=self.total_pieces,
+                             partial=len(self.ongoing_pieces)))
+
+    def _new_piece(self, index: int) -> Piece:
+        """
+        Construct the piece and its blocks based on the piece length and
+        request size for this torrent.
+        """
+        # The number of blocks for each piece can be calculated using the
+        # request size as divisor for the piece length.
+        # The final piece however, will most likely have fewer blocks
+        # than 'regular' pieces, and that final block might be smaller
+        # then the other blocks.
+        length = self._piece_length(index)
+        blocks = [Block(index, offset, min(REQUEST_SIZE, length - offset))
+                  for offset in range(0, length, REQUEST_SIZE)]
+        piece = Piece(index, blocks, self.hashes[index])
+        piece.buffer = self.storage.piece_buffer(index, length)
+        piece.in_place = piece.buffer is not None
+        return piece
+
+    def _piece_length(self, index: int) -> int:
+        if index < self.total_pieces - 1:
+            return self.info.piece_length
+        return self.info.length - index * self.info.piece_length
 
     @property
     def is_complete(self):
@@ -358,6 +721,24 @@ class PieceManager:
     def bytes_downloaded_changed(self):
         pass
 
+    def recheck_progress(self, checked, total):
+        pass
+
+    def cancel_request(self, peer_id, block):
+        """
+        Called when a block requested from the given peer was retrieved from
+        another peer, the request should be cancelled.
+        """
+        pass
+
+    @property
+    def is_endgame(self) -> bool:
+        """
+        Checks whether every remaining block is requested.
+        """
+        return not self.missing_pieces and not self.open_pieces and \
+            bool(self.pending_blocks)
+
     @property
     def bytes_downloaded(self) -> int:
         """
@@ -365,9 +746,10 @@ class PieceManager:
 
         This method Only counts full, verified, pieces, not single blocks.
         """
+        last = self.total_pieces - 1
         return len(self.have_pieces) * self.info.piece_length - \
-            ((self.info.length % self.info.piece_length)
-             if self.is_complete else 0)
+            ((self.info.piece_length - self._piece_length(last))
+             if last in self.have_pieces else 0)
 
     @property
     def bytes_uploaded(self) -> int:
@@ -381,15 +763,23 @@ class PieceManager:
         """
         Adds a peer and the bitfield representing the pieces the peer has.
         """
+        self.remove_peer(peer_id)
         self.peers[peer_id] = bitfield
+        self.picker.peer_added(bitfield)
 
     def update_peer(self, peer_id, index: int):
         """
         Updates the information about which pieces a peer has (reflects a Have
         message).
         """
-        if peer_id in self.peers:
-            self.peers[peer_id][index] = 1
+        if peer_id not in self.peers:
+            # The peer did not send a bitfield, so it had no pieces
+            self.peers[peer_id] = BitArray(
+                bytes(math.ceil(self.total_pieces / 8)))
+        bitfield = self.peers[peer_id]
+        if index < len(bitfield) and not bitfield[index]:
+            bitfield[index] = 1
+            self.picker.peer_has(index)
 
     def remove_peer(self, peer_id):
         """
@@ -397,7 +787,9 @@ class PieceManager:
         is dropped)
         """
         if peer_id in self.peers:
-            del self.peers[peer_id]
+            self.picker.peer_removed(self.peers.pop(peer_id))
+            for requesters in self.requesters.values():
+                requesters.discard(peer_id)
 
     def next_request(self, peer_id) -> Block:
         """
@@ -406,40 +798,77 @@ class PieceManager:
         If there are no more blocks left to retrieve or if this peer does not
         have any of the missing pieces None is returned
         """
-        # The algorithm implemented for which piece to retrieve is a simple
-        # one. This should preferably be replaced with an implementation of
-        # "rarest-piece-first" algorithm instead.
-        #
-        # The algorithm tries to download the pieces in sequence and will try
-        # to finish started pieces before starting with new pieces.
+        # The algorithm tries to finish started pieces before starting with
+        # new pieces, new pieces are picked rarest first.
         #
         # 1. Check any pending blocks to see if any request should be reissued
         #    due to timeout
         # 2. Check the ongoing pieces to get the next block to request
-        # 3. Check if this peer have any of the missing pieces not yet started
+        # 3. Pick the rarest of the missing pieces this peer have
+        # 4. In endgame mode, request a pending block once more
         if peer_id not in self.peers:
             logging.warning("Peer not in piece manager")
-            # return None
-            if len(self.missing_pieces) != 0:
-                piece = self.missing_pieces.pop(0)
-                return piece.next_request()
             return None
 
-        if len(self.missing_pieces) < TorrentClient.MAX_PEER_CONNECTIONS:
-            block = self._next_missing(peer_id)
-            if not block:
-                block = self._expired_requests(peer_id)
-                if not block:
-                    block = self._next_ongoing(peer_id)
-            return block
-
         block = self._expired_requests(peer_id)
         if not block:
             block = self._next_ongoing(peer_id)
             if not block:
                 block = self._next_missing(peer_id)
+                if not block and self.is_endgame:
+                    block = self._next_endgame(peer_id)
         return block
 
+    def release_requests(self, peer_id, requests):
+        """
+        Puts the blocks requested from the peer back to be requested again,
+        unless they are requested from other peers as well. Must be called
+        for requests the peer will not answer, e.g. it choked us, so the
+        blocks do not wait for the request timeout.
+
+        :param requests: The (piece index, block offset) of the requests
+        """
+        for key in requests:
+            requesters = self.requesters.get(key)
+            if requesters is None or peer_id not in requesters:
+                continue
+            requesters.discard(peer_id)
+            # A late answer must not be received into the piece buffer
+            # anymore, another peer may get the block now
+            self.placing.discard(key)
+            if requesters:
+                continue
+            del self.requesters[key]
+            self.pending_blocks.pop(key, None)
+            piece = self.ongoing_pieces.get(key[0])
+            if piece is not None and piece.release(key[1]):
+                self.open_pieces[piece.index] = piece
+
+    def block_buffer(self, piece_index, block_offset, length):
+        """
+        Placement callback for `PeerStreamIterator`: get the writable view
+        of the ongoing piece buffer where the given block should be received,
+        or None if the block is not expected.
+        """
+        piece = self.ongoing_pieces.get(piece_index)
+        if piece is None:
+            return None
+        if len(self.requesters.get((piece_index, block_offset), ())) > 1:
+            # Several peers may send this block at the same time, it must
+            # not be written to the piece buffer while being received
+            return None
+        target = piece.block_buffer(block_offset, length)
+        if target is not None:
+            self.placing.add((piece_index, block_offset))
+        return target
+
+    def is_placing(self, piece_index, block_offset) -> bool:
+        """
+        Checks if the view `block_buffer` returned for a block may still be
+        written to, see `PeerStreamIterator`.
+        """
+        return (piece_index, block_offset) in self.placing
+
     def block_received(self, peer_id, piece_index, block_offset, data):
         """
         This method must be called when a block has successfully been retrieved
@@ -457,36 +886,228 @@ class PieceManager:
 
         self.bytes_downloaded_changed()
         # Remove from pending requests
-        for index, request in enumerate(self.pending_blocks):
-            if request.piece == piece_index and \
-                    request.offset == block_offset:
-                del self.pending_blocks[index]
-                break
+        key = (piece_index, block_offset)
+        block = self.pending_blocks.pop(key, None)
+        self.placing.discard(key)
+        requesters = self.requesters.pop(key, ())
 
-        pieces = [p for p in self.ongoing_pieces if p.index == piece_index]
-        piece = pieces[0] if pieces else None
+        piece = self.ongoing_pieces.get(piece_index)
         if piece:
-            piece.block_received(block_offset, data)
-            if piece.is_complete():
-                if piece.is_hash_matching():
-                    self.file_manager.write(piece)
-                    self.ongoing_pieces.remove(piece)
-                    self.have_pieces.append(piece)
-                    complete = (self.total_pieces
-                                - len(self.missing_pieces)
-                                - len(self.ongoing_pieces))
-                    logging.info(
-                        '{complete} / {total} pieces downloaded {per:.3f} %'
-                        .format(complete=complete,
-                                total=self.total_pieces,
-                                per=(complete / self.total_pieces) * 100))
-                else:
-                    logging.info('Discarding corrupt piece {index}'
-                                 .format(index=piece.index))
-                    piece.reset()
+            received = piece.block(block_offset)
+            if received and received.status is Block.Retrieved:
+                self.bytes_wasted += len(data)
+            else:
+                piece.block_received(block_offset, data)
+                self._hash_retrieved(piece)
         else:
+            self.bytes_wasted += len(data)
             logging.warning('Trying to update piece that is not ongoing!')
 
+        # Only once the block is recorded, a failing cancel must not leave
+        # it pending but no longer requested
+        for requester in requesters:
+            if requester != peer_id:
+                try:
+                    self.cancel_request(requester, block)
+                except Exception:
+                    logging.exception('Failed to cancel block {offset} of '
+                                      'piece {index}'.format(
+                                          offset=block_offset,
+                                          index=piece_index))
+
+    def _hash_retrieved(self, piece):
+        """
+        Feeds the blocks retrieved in order into the running SHA1 of the
+        piece on the hash thread pool, one job per piece at a time. Once all
+        blocks are fed the digest is checked. Without a running loop the
+        blocks are hashed right away.
+        """
+        if piece.hashing:
+            # The job in flight will pick up the new blocks when done
+            return
+        start, end = piece.hashable()
+        if start == end:
+            if piece.hashed == len(piece.blocks):
+                self._piece_verified(piece, piece.hash == piece.sha1.digest())
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._hashed(piece, piece.sha1, end,
+                         self._hash(piece, piece.sha1, start, end))
+            return
+        piece.hashing = True
+        self.hash_queue_length += 1
+        future = loop.run_in_executor(self.hash_executor, self._hash,
+                                      piece, piece.sha1, start, end)
+        future.add_done_callback(
+            partial(self._hash_job_done, piece, piece.sha1, end))
+
+    def _hash_job_done(self, piece, sha1, end, future):
+        self.hash_queue_length -= 1
+        piece.hashing = False
+        self._hashed(piece, sha1, end, future.result())
+
+    def _hashed(self, piece, sha1, end, hash_time):
+        self.hash_time += hash_time
+        # The piece might have been reset while its blocks were hashed
+        if piece.sha1 is sha1:
+            piece.hashed = end
+        if self.ongoing_pieces.get(piece.index) is piece:
+            self._hash_retrieved(piece)
+
+    @staticmethod
+    def _hash(piece, sha1, start, end):
+        """
+        Runs on the hash thread pool.
+
+        :return: The seconds spent hashing
+        """
+        begin = time.perf_counter()
+        piece.update_hash(sha1, start, end)
+        return time.perf_counter() - begin
+
+    def _piece_verified(self, piece, matching):
+        """
+        Writes a verified piece to disk and marks it as have, or resets it
+        when the hash did not match.
+        """
+        self.pieces_hashed += 1
+        if not matching:
+            logging.info('Discarding corrupt piece {index}'
+                         .format(index=piece.index))
+            self._reopen(piece)
+            return
+
+        # No more blocks are placed into the piece while it is written. It
+        # may still be open if blocks arrived that were never requested
+        del self.ongoing_pieces[piece.index]
+        self.open_pieces.pop(piece.index, None)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.storage.write(piece)
+            self._piece_written(piece)
+            return
+        self.write_cache.add(piece)
+
+    def _piece_written(self, piece):
+        # The piece is on disk, its buffer is not needed anymore
+        piece.buffer = None
+        self.have_pieces.add(piece.index)
+        complete = (self.total_pieces
+                    - len(self.missing_pieces)
+                    - len(self.ongoing_pieces))
+        logging.info(
+            '{complete} / {total} pieces downloaded {per:.3f} %'
+            .format(complete=complete,
+                    total=self.total_pieces,
+                    per=(complete / self.total_pieces) * 100))
+
+    def _reopen(self, piece):
+        """
+        Puts all blocks of the piece back to be requested again.
+        """
+        piece.reset()
+        self.ongoing_pieces[piece.index] = piece
+        self.open_pieces[piece.index] = piece
+
+    async def recheck(self, workers=None):
+        """
+        Verifies the missing pieces against the data already in the files
+        (see `Recheck`), the matching ones become have. Must run before any
+        piece is started. The progress is reported to `recheck_progress`.
+
+        :param workers: The number of worker processes
+        """
+        if not self.storage.persistent:
+            return
+        checker = Recheck(self.storage, self.hashes, workers)
+        verified = await checker.run(list(self.missing_pieces),
+                                     self.recheck_progress)
+        for index in verified:
+            self.missing_pieces.discard(index)
+            self.picker.remove_wanted(index)
+            self.have_pieces.add(index)
+        self.save_resume()
+
+    async def read_block(self, index: int, offset: int, length: int):
+        """
+        Reads a block of a verified piece to upload it.
+
+        :return: The block or None if we do not have it
+        """
+        if index not in self.have_pieces:
+            return None
+        return await self.read_cache.read(index, offset, length)
+
+    def block_file(self, index: int, offset: int, length: int):
+        """
+        Get the file a block of a verified piece is stored in, to upload it
+        with `sendfile` instead of `read_block`.
+
+        :return: A context manager giving the file and the offset of the
+                 block, see `FileManager.block_file`, or None if sendfile
+                 is not enabled, we do not have the block or it spans
+                 several files
+        """
+        if not self.sendfile or index not in self.have_pieces:
+            return None
+        return self.storage.block_file(index, offset, length)
+
+    def _resume_data(self):
+        # Only the blocks stored in the files survive a restart
+        partial = {index: piece.retrieved_bits()
+                   for index, piece in self.ongoing_pieces.items()
+                   if piece.in_place and piece.retrieved}
+        return (self.resume_path, self.storage, self.total_pieces,
+                bytes(self.have_pieces.bits), partial)
+
+    def save_resume(self):
+        """
+        Writes the resume file.
+        """
+        if not self.storage.persistent:
+            return
+        try:
+            resume.save(*self._resume_data())
+        except OSError:
+            logging.exception('Failed to write the resume file')
+
+    async def checkpoint(self):
+        """
+        Writes the resume file on the I/O thread pool.
+        """
+        if not self.storage.persistent:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.disk_io.executor, partial(resume.save,
+                                               *self._resume_data()))
+        except OSError:
+            logging.exception('Failed to write the resume file')
+
+    async def flush(self, shutdown=False):
+        """
+        Writes the verified pieces buffered and waits until they are
+        written.
+
+        :param shutdown: Sync the files if the fsync policy says so
+        """
+        await self.write_cache.flush(shutdown)
+
+    def close(self):
+        """
+        Stops the hash and I/O thread pools and closes the downloaded files.
+        """
+        self.hash_executor.shutdown(wait=True)
+        self.disk_io.close()
+        logging.info('Disk I/O ' + self.disk_io.stats())
+        logging.info('Write cache ' + self.write_cache.stats())
+        logging.info('Read cache ' + self.read_cache.stats())
+        logging.info('Storage ' + self.storage.stats())
+
     def _expired_requests(self, peer_id) -> Block:
         """
         Go through previously requested blocks, if any one have been in the
@@ -496,64 +1117,100 @@ class PieceManager:
         If no pending blocks exist, None is returned
         """
         current = int(round(time.time() * 1000))
-        for request in self.pending_blocks:
+        for key, request in self.pending_blocks.items():
+            if request.start_time + self.max_pending_time >= current:
+                # All following requests are even younger
+                return None
             # Check Bitfield
             if self.peers[peer_id][request.piece]:
-                if request.start_time + self.max_pending_time < current:
-                    logging.info('Re-requesting block {block} for '
-                                 'piece {piece}'.format(
-                                     block=request.offset,
-                                     piece=request.piece))
-                    # Reset expiration timer
-                    request.start_time = current
-                    return request
-        return None
+                break
+        else:
+            return None
 
-    def _next_endgame(self, perr_id) -> Block:
-        pass
+        logging.info('Re-requesting block {block} for piece {piece}'.format(
+            block=request.offset, piece=request.piece))
+        # Reset expiration timer and move the request to the end
+        del self.pending_blocks[key]
+        request.start_time = current
+        self.pending_blocks[key] = request
+        self.requesters.setdefault(key, set()).add(peer_id)
+        # The block may now be completed by this peer while the first one
+        # is still receiving it into the piece buffer
+        self.placing.discard(key)
+        return request
+
+    def _next_endgame(self, peer_id) -> Block:
+        """
+        Go through the pending blocks, oldest first, and return one the peer
+        has and did not get a request for yet, as long as it is not requested
+        from `max_duplicate_requests` peers already.
+        """
+        bitfield = self.peers[peer_id]
+        for key, block in self.pending_blocks.items():
+            requesters = self.requesters.setdefault(key, set())
+            if len(requesters) < self.max_duplicate_requests and \
+                    peer_id not in requesters and bitfield[block.piece]:
+                logging.debug('Endgame request for block {block} of piece '
+                              '{piece}'.format(block=block.offset,
+                                               piece=block.piece))
+                requesters.add(peer_id)
+                self.placing.discard(key)
+                return block
+        return None
 
     def _next_ongoing(self, peer_id) -> Block:
         """
-        Go through the ongoing pieces and return the next block to be
-        requested or None if no block is left to be requested.
+        Go through the ongoing pieces that have blocks left to request and
+        return the next block to be requested or None if no block is left to
+        be requested.
         """
-        for piece in self.ongoing_pieces:
+        bitfield = self.peers[peer_id]
+        # Requesting may close the piece
+        for piece in list(self.open_pieces.values()):
             # Check Bitfield
-            if self.peers[peer_id][piece.index]:
-                # Is there any blocks left to request in this piece?
-                block = piece.next_request()
+            if bitfield[piece.index]:
+                block = self._request(peer_id, piece)
                 if block:
-                    block.start_time = int(round(time.time() * 1000))
-                    self.pending_blocks.append(block)
                     return block
         return None
 
     def _next_missing(self, peer_id) -> Block:
         """
-        Go through the missing pieces and return the next block to request
-        or None if no block is left to be requested.
+        Pick the rarest missing piece the peer has and return its first block
+        to request or None if no block is left to be requested.
 
         This will change the state of the piece from missing to ongoing - thus
         the next call to this function will not continue with the blocks for
         that piece, rather get the next missing piece.
         """
+        if self.disk_io.is_backlogged or self.write_cache.is_full:
+            # Let the disk catch up before more pieces are held in memory
+            return None
+        index = self.picker.pick(self.peers[peer_id])
+        if index is None:
+            return None
+        # Move this piece from missing to ongoing
+        self.missing_pieces.discard(index)
+        self.picker.remove_wanted(index)
+        piece = self._new_piece(index)
+        self.ongoing_pieces[index] = piece
+        self.open_pieces[index] = piece
+        # The missing pieces does not have any previously requested
+        # blocks (then it is ongoing).
+        return self._request(peer_id, piece)
+
+    def _request(self, peer_id, piece) -> Block:
+        """
+        Marks the next missing block of an open piece as pending.
 
-        if len(self.ongoing_pieces) > 20:
-            pieces = [piece.blocks for piece in self.ongoing_pieces]
-            blocks = []
-            for block in pieces:
-                blocks.extend(block)
-            for block in blocks:
-                if block.status == block.Pending:
-                    return block
-
-        for index, piece in enumerate(self.missing_pieces):
-            # Check Bitfield
-            if self.peers[peer_id][piece.index]:
-                # Move this piece from missing to ongoing
-                piece = self.missing_pieces.pop(index)
-                self.ongoing_pieces.append(piece)
-                # The missing pieces does not have any previously requested
-                # blocks (then it is ongoing).
-                return piece.next_request()
-        return None
+        :return: The block or None if the blocks left were all retrieved
+                 without being requested, e.g. sent unsolicited
+        """
+        block = piece.next_request()
+        if not piece.has_missing():
+            self.open_pieces.pop(piece.index, None)
+        if block:
+            block.start_time = int(round(time.time() * 1000))
+            self.pending_blocks[(block.piece, block.offset)] = block
+            self.requesters[(block.piece, block.offset)] = {peer_id}
+        return block
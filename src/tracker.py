@@ -1,10 +1,14 @@
 import aiohttp
+import asyncio
 import logging
+import random
 import socket
-from struct import unpack
+import struct
+import time
 import urllib.parse
 
 from src import bencoding
+from src.udp_tracker import UdpTracker
 
 
 class TrackerResponse:
@@ -16,8 +20,33 @@ class TrackerResponse:
     property).
     """
 
-    def __init__(self, response: dict):
+    def __init__(self, response: dict, peers: list = None):
+        """
+        :param response: The decoded response
+        :param peers: The peers if already decoded, see `merge`
+        """
         self.response = response
+        self._peers = peers
+
+    @classmethod
+    def merge(cls, responses):
+        """
+        Merges the successful responses of several trackers: the interval is
+        the one of the first response, the peers are de-duplicated.
+        """
+        if len(responses) == 1:
+            return responses[0]
+        peers = []
+        seen = set()
+        for response in responses:
+            for peer in response.peers:
+                if peer not in seen:
+                    seen.add(peer)
+                    peers.append(peer)
+        return cls({b'interval': responses[0].interval,
+                    b'complete': max(r.complete for r in responses),
+                    b'incomplete': max(r.incomplete for r in responses)},
+                   peers)
 
     @property
     def failure(self):
@@ -55,30 +84,15 @@ class TrackerResponse:
     @property
     def peers(self):
         """
-        A list of tuples for each peer structured as (ip, port)
+        A list of tuples for each peer structured as (ip, port), the IPv4
+        peers first then the IPv6 ones. Decoded once on first access.
         """
-        # The BitTorrent specification specifies two types of responses. One
-        # where the peers field is a list of dictionaries and one where all
-        # the peers are encoded in a single string
-        print(self.response)
-
-        if b'peers' not in self.response:
-            return list()
-        peers = self.response[b'peers']
-        if type(peers) == list:
-            # TODO Implement support for dictionary peer list
-            logging.debug('Dictionary model peers are returned by tracker')
-            raise NotImplementedError()
-        else:
-            logging.debug('Binary model peers are returned by tracker')
-
-            # Split the string in pieces of length 6 bytes, where the first
-            # 4 characters is the IP the last 2 is the TCP port.
-            peers = [peers[i:i + 6] for i in range(0, len(peers), 6)]
-
-            # Convert the encoded address to a list of tuples
-            return [(socket.inet_ntoa(p[:4]), _decode_port(p[4:]))
-                    for p in peers]
+        if self._peers is None:
+            self._peers = decode_peers(self.response.get(b'peers', b''))
+            if b'peers6' in self.response:
+                self._peers += decode_compact_peers(
+                    self.response[b'peers6'], socket.AF_INET6)
+        return self._peers
 
     def __str__(self):
         try:
@@ -96,14 +110,39 @@ class TrackerResponse:
 
 class Tracker:
     """
-    Represents the connection to a tracker for a given Torrent that is either
-    under download or seeding state.
+    Represents the connection to the trackers for a given Torrent that is
+    either under download or seeding state.
+
+    The trackers are grouped in the tiers of the meta-info (BEP 12). An
+    announce goes to all trackers of the first tier at once. The first
+    tracker to respond moves to the front of its tier, the peers of the
+    trackers responding within `MERGE_TIMEOUT` seconds after it are merged.
+    The next tier is only tried when no tracker of a tier responds within
+    `TIMEOUT` seconds.
+
+    A tracker that fails is left out of the announces for `BACKOFF` seconds,
+    doubled after every failure in a row up to `MAX_BACKOFF`.
+
+    The announce URL scheme tells the protocol: udp:// trackers are
+    announced to with a `UdpTracker`, the others over HTTP.
     """
+    TIMEOUT = 30
+    MERGE_TIMEOUT = 2
+    BACKOFF = 60
+    MAX_BACKOFF = 3600
 
     def __init__(self, info):
         self.info = info
-        self.session = aiohttp.ClientSession(
-            connector=aiohttp.TCPConnector(ssl=False))
+        self.tiers = [list(tier) for tier in info.announce_tiers]
+        for tier in self.tiers:
+            random.shuffle(tier)
+        self.session = None
+        self.udp = {}
+        # The failures in a row and when to retry by tracker URL
+        self.failures = {}
+        self.retry_at = {}
+        # The seconds the first announce took to get peers
+        self.time_to_first_peer = None
 
     # @staticmethod
     # async def connect_dht():
@@ -117,13 +156,17 @@ class Tracker:
                       uploaded: int = 0,
                       downloaded: int = 0):
         """
-        Makes the announce call to the tracker to update with our statistics
-        as well as get a list of available peers to connect to.
+        Makes the announce call to the trackers to update with our
+        statistics as well as get a list of available peers to connect to.
         If the call was successful, the list of peers will be updated as a
         result of calling this function.
         :param first: Whether or not this is the first announce call
         :param uploaded: The total number of bytes uploaded
         :param downloaded: The total number of bytes downloaded
+        :return: The responses of the first tier that responded merged, or
+                 a failed response if every tracker refused the announce
+        :raise ConnectionError: No tracker responded, see `next_retry` for
+                                when to announce again
         """
         params = {
             'info_hash': self.info.hash20,
@@ -136,7 +179,107 @@ class Tracker:
         if first:
             params['event'] = 'started'
 
-        url = self.info.announce + '?' + urllib.parse.urlencode(params)
+        start = time.monotonic()
+        failed = None
+        for tier in self.tiers:
+            now = time.monotonic()
+            urls = [url for url in tier if self.retry_at.get(url, 0) <= now]
+            responses, failure = await self._announce_tier(tier, urls,
+                                                           params)
+            if responses:
+                if self.time_to_first_peer is None:
+                    self.time_to_first_peer = time.monotonic() - start
+                return TrackerResponse.merge(responses)
+            failed = failure or failed
+        if failed is not None:
+            return failed
+        raise ConnectionError('Unable to connect to tracker')
+
+    async def _announce_tier(self, tier, urls, params):
+        """
+        Announces to the given trackers of a tier at once.
+
+        :return: The successful responses, the first one first, and the
+                 last failed response
+        """
+        tasks = {asyncio.ensure_future(self._announce(url, params)): url
+                 for url in urls}
+        responses = []
+        failed = None
+        timeout = Tracker.TIMEOUT
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks, timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    url = tasks.pop(task)
+                    response = None if task.exception() else task.result()
+                    if response is None or response.failure is not None:
+                        self._failed(url)
+                        failed = response or failed
+                        continue
+                    self.failures.pop(url, None)
+                    self.retry_at.pop(url, None)
+                    if not responses:
+                        # Promote the fastest tracker to the front of the
+                        # tier, and only wait a little for the others
+                        tier.remove(url)
+                        tier.insert(0, url)
+                        timeout = Tracker.MERGE_TIMEOUT
+                    responses.append(response)
+        finally:
+            for task in tasks:
+                task.cancel()
+        if not responses:
+            for url in tasks.values():
+                self._failed(url)
+        return responses, failed
+
+    def next_retry(self) -> float:
+        """
+        Get the seconds until a tracker is not backed off anymore, 0 if one
+        is not backed off already.
+        """
+        now = time.monotonic()
+        return max(0, min((self.retry_at.get(url, 0) - now
+                           for tier in self.tiers for url in tier),
+                          default=0))
+
+    def _failed(self, url):
+        self.failures[url] = self.failures.get(url, 0) + 1
+        backoff = min(Tracker.MAX_BACKOFF,
+                      Tracker.BACKOFF * 2 ** (self.failures[url] - 1))
+        self.retry_at[url] = time.monotonic() + backoff
+        logging.info('Tracker {url} failed, retrying in {backoff} s'
+                     .format(url=url, backoff=backoff))
+
+    async def _announce(self, url, params):
+        """
+        Makes the announce call to a single tracker.
+        """
+        if urllib.parse.urlsplit(url).scheme == 'udp':
+            logging.info('Connecting to tracker at: ' + url)
+            if url not in self.udp:
+                self.udp[url] = UdpTracker(url)
+            peer_id = params['peer_id']
+            if isinstance(peer_id, str):
+                peer_id = peer_id.encode('utf-8')
+            try:
+                return TrackerResponse(await self.udp[url].announce(
+                    params['info_hash'], peer_id, params['port'],
+                    params['uploaded'], params['downloaded'],
+                    params['left'], params.get('event')))
+            except Exception as e:
+                logging.error(e)
+                raise e
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(ssl=False))
+        url = url + '?' + urllib.parse.urlencode(params)
         logging.info('Connecting to tracker at: ' + url)
 
         try:
@@ -148,10 +291,12 @@ class Tracker:
         except Exception as e:
             logging.error(e)
             raise e
-        return None
 
     async def close(self):
-        await self.session.close()
+        if self.session is not None:
+            await self.session.close()
+        for tracker in self.udp.values():
+            tracker.close()
 
     def _construct_tracker_parameters(self):
         """
@@ -169,9 +314,41 @@ class Tracker:
             'compact': 1}
 
 
-def _decode_port(port):
+def decode_peers(peers) -> list:
+    """
+    Decodes the peers field of a tracker response to a list of (ip, port).
+
+    The BitTorrent specification specifies two types of responses. One
+    where the peers field is a list of dictionaries and one where all the
+    peers are encoded in a single string.
+    """
+    if isinstance(peers, list):
+        logging.debug('Dictionary model peers are returned by tracker')
+        decoded = []
+        for peer in peers:
+            try:
+                decoded.append((peer[b'ip'].decode('utf-8'),
+                                int(peer[b'port'])))
+            except (KeyError, TypeError, ValueError, AttributeError):
+                logging.debug('Invalid peer {peer}'.format(peer=peer))
+        return decoded
+    logging.debug('Binary model peers are returned by tracker')
+    return decode_compact_peers(peers, socket.AF_INET)
+
+
+def decode_compact_peers(data: bytes, family) -> list:
     """
-    Converts a 32-bit packed binary port number to int
+    Decodes compact peers in one pass: 4 (IPv4) or 16 (IPv6) bytes of IP
+    then 2 bytes of port, big-endian, per peer. A trailing partial entry is
+    ignored.
     """
-    # Convert from C style big-endian encoded as unsigned short
-    return unpack(">H", port)[0]
+    size = 4 if family == socket.AF_INET else 16
+    view = memoryview(data)
+    view = view[:len(view) - len(view) % (size + 2)]
+    if family == socket.AF_INET:
+        ntoa = socket.inet_ntoa
+        return [(ntoa(ip), port)
+                for ip, port in struct.iter_unpack('>4sH', view)]
+    ntop = socket.inet_ntop
+    return [(ntop(family, ip), port)
+            for ip, port in struct.iter_unpack('>16sH', view)]
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import random
+import socket
+import struct
+import time
+import urllib.parse
+
+# The magic constant identifying the connect request
+PROTOCOL_ID = 0x41727101980
+
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_ERROR = 3
+
+EVENTS = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+
+class UdpTrackerProtocol(asyncio.DatagramProtocol):
+    """
+    Hands the datagrams received to the request waiting for them, matched
+    by transaction ID.
+    """
+
+    def __init__(self):
+        self.waiting = {}
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8:
+            return
+        action, transaction_id = struct.unpack_from('>II', data)
+        future = self.waiting.get(transaction_id)
+        if future is not None and not future.done():
+            future.set_result((action, data))
+
+    def error_received(self, exc):
+        logging.debug('UDP tracker error: {error}'.format(error=exc))
+
+
+class UdpTracker:
+    """
+    A client of the UDP tracker protocol (BEP 15).
+
+    An announce takes two round trips of one datagram each: a connect
+    request giving a connection ID, then the announce itself. The connection
+    ID is kept for `CONNECTION_ID_TTL` seconds, so the next announces take
+    a single round trip.
+
+    A request not answered within `TIMEOUT` * 2 ^ n seconds is sent again,
+    n going from 0 up to `MAX_RETRIES`. A connection ID expiring meanwhile
+    is requested again first.
+    """
+    TIMEOUT = 15
+    MAX_RETRIES = 8
+    CONNECTION_ID_TTL = 60
+
+    def __init__(self, url, timeout=None, max_retries=None):
+        """
+        :param url: The udp:// announce URL
+        :param timeout: The seconds before the first retransmission (default
+                        `TIMEOUT`)
+        :param max_retries: The number of retransmissions (default
+                            `MAX_RETRIES`)
+        """
+        parts = urllib.parse.urlsplit(url)
+        self.address = (parts.hostname, parts.port)
+        self.timeout = timeout or UdpTracker.TIMEOUT
+        self.max_retries = UdpTracker.MAX_RETRIES if max_retries is None \
+            else max_retries
+        self.transport = None
+        self.protocol = None
+        self.connection_id = None
+        self.connected_at = 0
+        # The number of requests sent again and of connect requests
+        self.retransmissions = 0
+        self.connects = 0
+
+    async def announce(self, info_hash: bytes, peer_id: bytes, port: int,
+                       uploaded: int, downloaded: int, left: int,
+                       event: str = None, key: int = 0,
+                       num_want: int = -1) -> dict:
+        """
+        Announces us to the tracker.
+
+        :param event: None, 'started', 'completed' or 'stopped'
+        :return: The response in the form of a decoded HTTP tracker
+                 response: interval, complete, incomplete and the compact
+                 peers (`peers6` for a tracker reached over IPv6), or the
+                 failure reason
+        """
+        await self._open()
+
+        def request(transaction_id):
+            return struct.pack('>QII20s20sQQQIIIiH', self.connection_id,
+                               ACTION_ANNOUNCE, transaction_id, info_hash,
+                               peer_id, downloaded, left, uploaded,
+                               EVENTS[event], 0, key, num_want, port)
+
+        action, data = await self._request(request, connect=False)
+        if action == ACTION_ERROR:
+            return {b'failure reason': data[8:]}
+        if action != ACTION_ANNOUNCE or len(data) < 20:
+            raise ConnectionError('Invalid announce response')
+        interval, incomplete, complete = struct.unpack_from('>III', data, 8)
+        family = self.transport.get_extra_info('socket').family
+        return {b'interval': interval,
+                b'incomplete': incomplete,
+                b'complete': complete,
+                b'peers6' if family == socket.AF_INET6 else b'peers':
+                    bytes(data[20:])}
+
+    async def _open(self):
+        if self.transport is None:
+            self.transport, self.protocol = \
+                await asyncio.get_running_loop().create_datagram_endpoint(
+                    UdpTrackerProtocol, remote_addr=self.address)
+
+    async def _connect(self):
+        """
+        Gets a connection ID unless the one we have is still valid.
+        """
+        if self.connection_id is not None and \
+                time.monotonic() - self.connected_at < \
+                UdpTracker.CONNECTION_ID_TTL:
+            return
+        self.connects += 1
+
+        def request(transaction_id):
+            return struct.pack('>QII', PROTOCOL_ID, ACTION_CONNECT,
+                               transaction_id)
+
+        action, data = await self._request(request, connect=True)
+        if action == ACTION_ERROR:
+            raise ConnectionError('Tracker refused to connect: {reason}'
+                                  .format(reason=bytes(data[8:])))
+        if action != ACTION_CONNECT or len(data) < 16:
+            raise ConnectionError('Invalid connect response')
+        self.connection_id, = struct.unpack_from('>Q', data, 8)
+        self.connected_at = time.monotonic()
+
+    async def _request(self, request, connect):
+        """
+        Sends a request until it is answered, with the BEP 15 backoff.
+
+        :param request: Builds the request from a transaction ID
+        :param connect: This is the connect request, else a connection ID
+                        is needed first
+        :return: The action and the datagram of the response
+        """
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            if not connect:
+                await self._connect()
+            if attempt:
+                self.retransmissions += 1
+            transaction_id = random.getrandbits(32)
+            future = loop.create_future()
+            self.protocol.waiting[transaction_id] = future
+            try:
+                self.transport.sendto(request(transaction_id))
+                return await asyncio.wait_for(future,
+                                              self.timeout * 2 ** attempt)
+            except asyncio.TimeoutError:
+                logging.debug('UDP tracker {host}:{port} did not answer'
+                              .format(host=self.address[0],
+                                      port=self.address[1]))
+            finally:
+                del self.protocol.waiting[transaction_id]
+        raise ConnectionError('Unable to connect to tracker')
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
@@ -12,8 +12,10 @@ class ProtocolError(BaseException):
 
 
 class Uploader:
-    def __init__(self, queue, piece_manager):
+    def __init__(self, queue, info_hash, peer_id, piece_manager):
         self.queue = queue
+        self.info_hash = info_hash
+        self.peer_id = peer_id
         self.piece_manager = piece_manager
         self.reader = None
         self.writer = None
@@ -44,55 +46,53 @@ class Uploader:
                     if message is None:
                         if PeerState.PendingRequest in self.my_state:
                             self.my_state.remove(PeerState.PendingRequest)
-                    elif isinstance(message) is BitField:
+                    elif type(message) is BitField:
                         self.piece_manager.add_peer(self.remote_id,
                                                     message.bitfield)
-                    elif isinstance(message) is Interested:
+                    elif type(message) is Interested:
                         self.peer_state.append(PeerState.Interested)
                         self.writer.write(Unchoke().encode())
                         await self.writer.drain()
                         if PeerState.Choked in self.my_state:
                             self.my_state.remove(PeerState.Choked)
-                    elif isinstance(message) is NotInterested:
+                    elif type(message) is NotInterested:
                         if PeerState.Interested in self.peer_state:
                             self.peer_state.remove(PeerState.Interested)
-                    elif isinstance(message) is Choke:
+                    elif type(message) is Choke:
                         self.peer_state.append(PeerState.Choked)
-                    elif isinstance(message) is Unchoke:
+                    elif type(message) is Unchoke:
                         logging.info(PeerState.Unchoke)
                         if PeerState.PendingRequest in self.my_state:
                             self.my_state.remove(PeerState.PendingRequest)
                         if PeerState.Choked in self.peer_state:
                             self.peer_state.remove(PeerState.Choked)
-                    elif isinstance(message) is Have:
+                    elif type(message) is Have:
                         if PeerState.PendingRequest in self.my_state:
                             self.my_state.remove(PeerState.PendingRequest)
                         self.piece_manager.update_peer(self.remote_id,
                                                        message.index)
-                    elif isinstance(message) is KeepAlive:
+                    elif type(message) is KeepAlive:
                         if PeerState.PendingRequest in self.my_state:
                             self.my_state.remove(PeerState.PendingRequest)
                         pass
-                    elif isinstance(message) is Piece:
+                    elif type(message) is Piece:
                         self.my_state.remove(PeerState.PendingRequest)
                         self.on_block_cb(
                             peer_id=self.remote_id,
                             piece_index=message.index,
                             block_offset=message.begin,
                             data=message.block)
-                    elif isinstance(message) is Request:
-                        for piece in self.piece_manager.have_pieces:
-                            if piece[message.index].is_complete():
-                                data = self.piece_manager.file_manager.read(
-                                    message.index, message.begin,
-                                    message.length)
-                                self.writer.write(
-                                    Piece(message.index,
-                                          message.begin,
-                                          data).encode())
-                                await self.writer.drain()
-                                logging.info("Send data")
-                    elif isinstance(message) is Cancel:
+                    elif type(message) is Request:
+                        data = await self.piece_manager.read_block(
+                            message.index, message.begin, message.length)
+                        if data is not None:
+                            self.writer.write(
+                                Piece(message.index,
+                                      message.begin,
+                                      data).encode())
+                            await self.writer.drain()
+                            logging.info("Send data")
+                    elif type(message) is Cancel:
                         pass
 
             except ProtocolError as error:
@@ -103,17 +103,23 @@ class Uploader:
                 logging.warning('Connection closed')
             except StopAsyncIteration as error:
                 logging.exception(error)
-                await self.close()
             except Exception as error:
                 logging.exception('Undefind error: '
-                                  + str(error) + str(message))
-                await self.close()
+                                  + str(error))
+            finally:
+                # The connection is over, the next one is taken from the
+                # queue
+                self.close()
 
     async def _handshake(self):
         buf = b''
         while len(buf) < Handshake.length:
-            buf = await asyncio.wait_for(self.reader.read(
+            data = await asyncio.wait_for(self.reader.read(
                 PeerStreamIterator.CHUNK_SIZE), 60)
+            if not data:
+                raise ConnectionResetError('Connection closed during the '
+                                           'handshake')
+            buf += data
 
         response = Handshake.decode(buf[:Handshake.length])
         if not response:
@@ -130,7 +136,8 @@ class Uploader:
         self.writer.write(Handshake(self.info_hash, self.peer_id).encode())
         await self.writer.drain()
 
-        return buf
+        # The bytes read past the handshake are the start of the next message
+        return buf[Handshake.length:]
 
     def close(self):
         if self.writer is not None:
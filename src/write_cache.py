@@ -0,0 +1,152 @@
+import asyncio
+import logging
+
+
+class WriteCache:
+    """
+    Buffers verified pieces and writes them back in runs of adjacent pieces.
+
+    Pieces are verified in the random order the rarest-first picking
+    produces. Instead of writing each one on its own, they are kept until
+    `flush_size` bytes are buffered or the oldest one waited for
+    `flush_interval` seconds. Then all buffered pieces are sorted, and every
+    run of consecutive pieces is written with one vectored write per file.
+
+    The memory of the buffered pieces and the ones being written is capped
+    by `max_size`: while `is_full` is set no new pieces should be started.
+
+    The fsync policy is one of:
+        - 'never': leave it to the operating system
+        - 'flush': sync the files after every flush
+        - 'close': sync the files when the cache is flushed on shutdown
+    A piece is reported written only once synced according to the policy,
+    the pieces of a flush whose sync fails are reported failed.
+    """
+    FLUSH_SIZE = 16 * 2 ** 20
+    MAX_SIZE = 64 * 2 ** 20
+    FLUSH_INTERVAL = 5
+    FSYNC_POLICIES = ('never', 'flush', 'close')
+
+    def __init__(self, disk_io, on_written, on_failed, flush_size=None,
+                 max_size=None, flush_interval=None, fsync='never'):
+        """
+        :param disk_io: The DiskIO the pieces are written through
+        :param on_written: Called with every piece once it is written
+        :param on_failed: Called with every piece that could not be written
+        :param flush_size: The bytes buffered that start a flush (default
+                           `FLUSH_SIZE`)
+        :param max_size: The bytes buffered and being written at most
+                         (default `MAX_SIZE`)
+        :param flush_interval: The seconds a piece is buffered at most
+                               (default `FLUSH_INTERVAL`)
+        :param fsync: The fsync policy
+        """
+        if fsync not in WriteCache.FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy {fsync}'.format(
+                fsync=fsync))
+        self.disk_io = disk_io
+        self.on_written = on_written
+        self.on_failed = on_failed
+        self.flush_size = flush_size or WriteCache.FLUSH_SIZE
+        self.max_size = max_size or WriteCache.MAX_SIZE
+        self.flush_interval = flush_interval or WriteCache.FLUSH_INTERVAL
+        self.fsync = fsync
+        # The buffered pieces by index and their total length
+        self.pieces = {}
+        self.size = 0
+        # The total length of the pieces being written
+        self.writing = 0
+        self.timer = None
+        self.tasks = set()
+        # The number of writes and pieces written, to tell how well the
+        # pieces are coalesced
+        self.writes = 0
+        self.pieces_written = 0
+
+    @property
+    def is_full(self) -> bool:
+        return self.size + self.writing >= self.max_size
+
+    def add(self, piece):
+        """
+        Buffers a verified piece, must be called from the event loop.
+        """
+        self.pieces[piece.index] = piece
+        self.size += piece.length
+        if self.size >= self.flush_size:
+            self._start_flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.flush_interval, self._start_flush)
+
+    async def flush(self, shutdown=False):
+        """
+        Writes all buffered pieces and waits for the writes in progress.
+
+        :param shutdown: The files are synced if the policy is 'close'
+        """
+        self._start_flush()
+        while self.tasks:
+            await asyncio.wait(set(self.tasks))
+        if shutdown and self.fsync == 'close':
+            await self.disk_io.sync()
+
+    def _start_flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pieces:
+            return
+        pieces = [self.pieces[index] for index in sorted(self.pieces)]
+        self.pieces = {}
+        self.writing += self.size
+        self.size = 0
+        task = asyncio.ensure_future(self._write(pieces))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _write(self, pieces):
+        written = []
+        for run in self._runs(pieces):
+            try:
+                await self.disk_io.write(run)
+            except OSError:
+                logging.exception('Failed to write pieces {first} to {last}'
+                                  .format(first=run[0].index,
+                                          last=run[-1].index))
+                for piece in run:
+                    self.on_failed(piece)
+            else:
+                self.writes += 1
+                self.pieces_written += len(run)
+                written.extend(run)
+            finally:
+                self.writing -= sum(piece.length for piece in run)
+        if written and self.fsync == 'flush':
+            try:
+                await self.disk_io.sync()
+            except OSError:
+                logging.exception('Failed to sync the files')
+                # The written data may not have reached the disks
+                for piece in written:
+                    self.on_failed(piece)
+                return
+        for piece in written:
+            self.on_written(piece)
+
+    @staticmethod
+    def _runs(pieces):
+        """
+        Splits pieces sorted by index into runs of consecutive pieces.
+        """
+        run = [pieces[0]]
+        for piece in pieces[1:]:
+            if piece.index != run[-1].index + 1:
+                yield run
+                run = []
+            run.append(piece)
+        yield run
+
+    def stats(self) -> str:
+        return '{pieces} pieces in {writes} writes'.format(
+            pieces=self.pieces_written, writes=self.writes)
@@ -0,0 +1,8 @@
+class FakePiece:
+    """
+    A verified piece as the storages write it.
+    """
+
+    def __init__(self, index, data):
+        self.index = index
+        self.data = memoryview(data)
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+import unittest
+
+from src.disk_io import DiskIO, LatencyHistogram
+
+
+class BlockingFileManager:
+    """
+    Records the I/O calls, writes wait until `release` is set.
+    """
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.written = []
+        self.closed = False
+
+    def write_pieces(self, pieces):
+        self.release.wait()
+        self.written.extend(pieces)
+
+    def read(self, index, offset, length):
+        return bytes([index]) * length
+
+    def close(self):
+        self.closed = True
+
+
+class LatencyHistogramTests(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for _ in range(99):
+            histogram.add(0.0001)
+        histogram.add(0.5)
+        self.assertEqual(100, histogram.count)
+        self.assertEqual(0.5, histogram.max)
+        self.assertEqual(128e-6, histogram.percentile(50))
+        self.assertEqual(128e-6, histogram.percentile(99))
+        self.assertAlmostEqual(0.524288, histogram.percentile(100))
+        self.assertEqual(0, LatencyHistogram().percentile(50))
+
+
+class DiskIOTests(unittest.TestCase):
+    def setUp(self):
+        self.file_manager = BlockingFileManager()
+        self.disk_io = DiskIO(self.file_manager, max_queued=2)
+        self.addCleanup(self.disk_io.close)
+        self.addCleanup(self.file_manager.release.set)
+
+    def test_read(self):
+        data = asyncio.new_event_loop().run_until_complete(
+            self.disk_io.read(3, 0, 4))
+        self.assertEqual(b'\x03' * 4, data)
+        self.assertEqual(1, self.disk_io.histograms['read'].count)
+
+    def test_backpressure(self):
+        async def write():
+            writes = [asyncio.ensure_future(self.disk_io.write([piece]))
+                      for piece in range(3)]
+            await asyncio.sleep(0.01)
+            self.assertTrue(self.disk_io.is_backlogged)
+            self.assertEqual(3, self.disk_io.queued)
+            self.file_manager.release.set()
+            await asyncio.gather(*writes)
+            self.assertFalse(self.disk_io.is_backlogged)
+
+        asyncio.new_event_loop().run_until_complete(write())
+        # The workers may finish the released writes in any order
+        self.assertEqual([0, 1, 2], sorted(self.file_manager.written))
+        self.assertEqual(3, self.disk_io.histograms['write'].count)
+        self.assertEqual(3, self.disk_io.histograms['wait'].count)
+
+    def test_close(self):
+        self.disk_io.close()
+        self.assertTrue(self.file_manager.closed)
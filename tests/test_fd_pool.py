@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+
+from src.fd_pool import FdPool
+
+
+class FdPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.work_path = tempfile.TemporaryDirectory()
+        self.addCleanup(self.work_path.cleanup)
+        self.pool = FdPool(max_open=2)
+        self.addCleanup(self.close)
+        self.paths = [os.path.join(self.work_path.name, str(i))
+                      for i in range(3)]
+
+    def close(self):
+        for path in self.paths:
+            self.pool.close(path)
+
+    def test_opens_lazily_and_reuses(self):
+        with self.pool.use(self.paths[0]) as fd:
+            os.write(fd, b'abc')
+        self.assertTrue(os.path.exists(self.paths[0]))
+        self.assertFalse(os.path.exists(self.paths[1]))
+        with self.pool.use(self.paths[0]) as fd:
+            self.assertEqual(b'abc', os.pread(fd, 3, 0))
+        self.assertEqual((1, 1, 0),
+                         (self.pool.hits, self.pool.misses,
+                          self.pool.reopens))
+        self.assertEqual(0.5, self.pool.hit_rate)
+
+    def test_evicts_least_recently_used(self):
+        for path in self.paths[:2]:
+            with self.pool.use(path):
+                pass
+        with self.pool.use(self.paths[0]):
+            pass
+        with self.pool.use(self.paths[2]):
+            pass
+        self.assertEqual([self.paths[0], self.paths[2]],
+                         list(self.pool.fds))
+        with self.pool.use(self.paths[1]):
+            pass
+        self.assertEqual(1, self.pool.reopens)
+
+    def test_pinned_are_not_closed(self):
+        with self.pool.use(self.paths[0]) as first, \
+                self.pool.use(self.paths[1]), \
+                self.pool.use(self.paths[2]):
+            self.assertEqual(3, len(self.pool.fds))
+            os.fstat(first)
+        # The last one is released first while the others are still pinned
+        self.assertEqual([self.paths[0], self.paths[1]],
+                         list(self.pool.fds))
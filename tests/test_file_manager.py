@@ -0,0 +1,169 @@
+import os
+import tempfile
+import unittest
+
+from src.fd_pool import FdPool
+from src.file_manager import FileManager, MmapFileManager
+from tests import FakePiece
+
+
+class FakeMultiFileInfo:
+    """
+    A multi file torrent of 4 byte pieces over files of the given lengths.
+    """
+    is_multi_file = True
+    name = 'fake'
+    piece_length = 4
+
+    def __init__(self, lengths):
+        self.files = [{'length': length, 'path': ['dir', str(i)]}
+                      for i, length in enumerate(lengths)]
+        self.length = sum(lengths)
+
+
+class FileManagerTests(unittest.TestCase):
+    def setUp(self):
+        self.work_path = tempfile.TemporaryDirectory()
+        self.addCleanup(self.work_path.cleanup)
+        # Content: 0 1 2 | 3 4 5 6 7 8 | (empty) | 9
+        self.info = FakeMultiFileInfo([3, 6, 0, 1])
+
+    def open(self, files, allocation='compact'):
+        file_manager = FileManager(self.info, files, self.work_path.name,
+                                   allocation)
+        file_manager.open()
+        self.addCleanup(file_manager.close)
+        return file_manager
+
+    def test_spans(self):
+        file_manager = FileManager(self.info, [0, 1, 2, 3], '')
+        self.assertEqual([(0, 0, 3), (1, 0, 1)], file_manager.spans(0, 0, 4))
+        self.assertEqual([(1, 1, 4)], file_manager.spans(1, 0, 4))
+        self.assertEqual([(1, 5, 1), (3, 0, 1)], file_manager.spans(2, 0, 4))
+        self.assertEqual([(1, 3, 2)], file_manager.spans(1, 2, 2))
+
+    def test_need_piece(self):
+        file_manager = FileManager(self.info, [3], '')
+        self.assertEqual([False, False, True],
+                         [file_manager.need_piece(index)
+                          for index in range(3)])
+
+    def test_write_and_read(self):
+        file_manager = self.open([0, 1, 2, 3])
+        content = bytes(range(10))
+        for index in range(3):
+            file_manager.write(FakePiece(index, content[index * 4:
+                                                        index * 4 + 4]))
+        self.assertEqual(content[2:9], file_manager.read(0, 2, 7))
+        self.assertEqual(content[8:], file_manager.read(2, 0, 2))
+        with open(os.path.join(self.work_path.name, 'dir', '1'), 'rb') as f:
+            self.assertEqual(content[3:9], f.read())
+        self.assertEqual(0, os.path.getsize(
+            os.path.join(self.work_path.name, 'dir', '2')))
+
+    def test_write_consecutive_pieces(self):
+        file_manager = self.open([0, 1, 2, 3])
+        content = bytes(range(10))
+        file_manager.write_pieces([FakePiece(1, content[4:8]),
+                                   FakePiece(2, content[8:])])
+        file_manager.write_pieces([FakePiece(0, content[:4])])
+        file_manager.sync()
+        self.assertEqual(content, file_manager.read(0, 0, 10))
+
+    def test_files_not_selected(self):
+        file_manager = self.open([1])
+        file_manager.write(FakePiece(0, b'abcd'))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.work_path.name, 'dir', '0')))
+        self.assertEqual(b'd', file_manager.read(0, 3, 1))
+        self.assertIsNone(file_manager.read(0, 2, 2))
+
+    def test_bounded_descriptors(self):
+        pool = FdPool(max_open=1)
+        file_manager = FileManager(self.info, [0, 1, 3],
+                                   self.work_path.name, fd_pool=pool)
+        file_manager.open()
+        self.addCleanup(file_manager.close)
+        self.assertEqual(0, len(pool.fds))
+        content = bytes(range(10))
+        file_manager.write_pieces([FakePiece(index, content[index * 4:
+                                                            index * 4 + 4])
+                                   for index in range(3)])
+        file_manager.sync()
+        self.assertEqual(1, len(pool.fds))
+        self.assertEqual(content, file_manager.read(0, 0, 10))
+        self.assertGreater(pool.reopens, 0)
+        file_manager.close()
+        self.assertEqual(0, len(pool.fds))
+
+    def test_block_file(self):
+        file_manager = self.open([0, 1, 3])
+        file_manager.write_pieces([FakePiece(0, bytes(range(4))),
+                                   FakePiece(1, bytes(range(4, 8)))])
+        with file_manager.block_file(1, 1, 3) as (file, offset):
+            self.assertEqual(2, offset)
+            self.assertEqual(b'\x05\x06\x07', os.pread(file.fileno(), 3,
+                                                       offset))
+        self.assertIsNone(file_manager.block_file(0, 0, 4))
+        self.assertIsNone(file_manager.block_file(2, 2, 4))
+        self.assertIsNone(self.open([1]).block_file(2, 1, 1))
+
+    def sizes(self):
+        return [os.path.getsize(os.path.join(self.work_path.name, 'dir',
+                                             str(i)))
+                if os.path.exists(os.path.join(self.work_path.name, 'dir',
+                                               str(i))) else None
+                for i in range(4)]
+
+    def test_compact_allocation(self):
+        self.open([0, 1, 3])
+        self.assertEqual([0, 0, None, 0], self.sizes())
+
+    def test_sparse_allocation(self):
+        file_manager = self.open([1, 3], 'sparse')
+        self.assertEqual([None, 6, None, 1], self.sizes())
+        file_manager.write(FakePiece(2, bytes(range(8, 12))))
+        self.assertEqual(bytes(4) + b'\x08', file_manager.read(1, 0, 5))
+
+    def test_full_allocation(self):
+        self.open([0, 2], 'full')
+        self.assertEqual([3, None, 0, None], self.sizes())
+
+    def test_allocation_keeps_existing_files(self):
+        file_manager = self.open([1], 'sparse')
+        file_manager.write(FakePiece(1, b'abcd'))
+        file_manager.close()
+        self.open([1], 'full')
+        with open(os.path.join(self.work_path.name, 'dir', '1'), 'rb') as f:
+            self.assertEqual(b'\x00abcd\x00', f.read())
+
+    def test_unknown_allocation(self):
+        with self.assertRaises(ValueError):
+            FileManager(self.info, [0], '', 'preallocate')
+
+
+class MmapFileManagerTests(unittest.TestCase):
+    def setUp(self):
+        work_path = tempfile.TemporaryDirectory()
+        self.addCleanup(work_path.cleanup)
+        self.info = FakeMultiFileInfo([3, 6, 0, 1])
+        self.file_manager = MmapFileManager(self.info, [0, 1, 2, 3],
+                                            work_path.name)
+        self.file_manager.open()
+        self.addCleanup(self.file_manager.close)
+
+    def test_piece_buffer_within_one_file(self):
+        self.assertIsNone(self.file_manager.piece_buffer(0, 4))
+        buffer = self.file_manager.piece_buffer(1, 4)
+        buffer[:] = b'abcd'
+        # Writing a piece received into the mapping changes nothing
+        self.file_manager.write(FakePiece(1, buffer))
+        self.assertEqual(b'bc', self.file_manager.read(1, 1, 2))
+        self.assertIsInstance(self.file_manager.read(1, 1, 2), memoryview)
+
+    def test_write_and_read_across_files(self):
+        self.file_manager.write(FakePiece(0, bytearray(b'wxyz')))
+        self.file_manager.write(FakePiece(2, bytearray(b'12')))
+        self.assertEqual(b'wxyz', self.file_manager.read(0, 0, 4))
+        self.assertEqual(b'z\x00', bytes(self.file_manager.read(0, 3, 2)))
+        self.assertEqual(b'12', bytes(self.file_manager.read(2, 0, 2)))
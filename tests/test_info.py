@@ -38,3 +38,7 @@ class UbuntuTorrentTests(unittest.TestCase):
 
     def test_pieces(self):
         self.assertEqual(1624, len(self.t.pieces))
+        self.assertEqual(self.t.pieces[1623], self.t.pieces[-1])
+        self.assertEqual(20, len(self.t.pieces[1623]))
+        with self.assertRaises(IndexError):
+            self.t.pieces[1624]
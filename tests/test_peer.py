@@ -1,11 +1,16 @@
 import asyncio
+import tempfile
 import unittest
 from asyncio import Queue
+from unittest import mock
 
-from src.torrent_client import PieceManager
+from src.fd_pool import FdPool
+from src.file_manager import FileManager
+from src.peer_protocol import Cancel, Piece, Request
+from src.torrent_client import Block, PieceManager
 from src.tracker import Tracker, TrackerResponse
 from src.info import Info
-from src.peer import PeerConnection
+from src.peer import PeerConnection, RequestPipeline, REQUEST_SIZE
 
 
 class PeerTests(unittest.TestCase):
@@ -42,3 +47,244 @@ class PeerTests(unittest.TestCase):
         await asyncio.sleep(5)
 
         print(peer_connection.my_state)
+
+
+class RequestPipelineTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch('src.peer.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_free_slots(self):
+        pipeline = RequestPipeline()
+        for begin in range(3):
+            pipeline.sent(0, begin * REQUEST_SIZE)
+        self.assertEqual(3, len(pipeline))
+        self.assertEqual(RequestPipeline.INITIAL_DEPTH - 3, pipeline.free)
+        self.assertIn((0, REQUEST_SIZE), pipeline)
+
+        pipeline.received(0, REQUEST_SIZE, REQUEST_SIZE)
+        self.assertNotIn((0, REQUEST_SIZE), pipeline)
+        self.assertEqual(RequestPipeline.INITIAL_DEPTH - 2, pipeline.free)
+
+    def test_depth_follows_bandwidth_delay_product(self):
+        pipeline = RequestPipeline()
+        # 100 ms round trip, 64 blocks per second
+        for i in range(128):
+            pipeline.sent(1, i * REQUEST_SIZE)
+            self.now += 0.1
+            pipeline.received(1, i * REQUEST_SIZE, REQUEST_SIZE)
+            self.now -= 0.1 - 1 / 64
+        self.assertAlmostEqual(0.1, pipeline.rtt)
+        self.assertAlmostEqual(64 * REQUEST_SIZE, pipeline.rate,
+                               delta=REQUEST_SIZE)
+        # 6.4 blocks in flight fill the link, plus headroom
+        self.assertEqual(12, pipeline.depth)
+
+    def test_depth_shrinks_when_rate_drops(self):
+        pipeline = RequestPipeline()
+        pipeline.depth = 100
+        for i in range(4):
+            pipeline.sent(1, i * REQUEST_SIZE)
+            self.now += 0.2
+            pipeline.received(1, i * REQUEST_SIZE, REQUEST_SIZE)
+            self.now += 0.8
+        # One block per second over a 200 ms round trip
+        self.assertEqual(3, pipeline.depth)
+
+    def test_expire(self):
+        pipeline = RequestPipeline()
+        pipeline.sent(0, 0)
+        self.now += RequestPipeline.REQUEST_TIMEOUT + 1
+        pipeline.sent(0, REQUEST_SIZE)
+        pipeline.expire()
+        self.assertEqual([(0, REQUEST_SIZE)], list(pipeline.pending))
+
+
+class ScriptedPieceManager:
+    """
+    Hands out the given blocks in order and records the released requests.
+    """
+
+    def __init__(self, blocks):
+        self.blocks = list(blocks)
+        self.released = []
+
+    def next_request(self, peer_id):
+        return self.blocks.pop(0) if self.blocks else None
+
+    def release_requests(self, peer_id, requests):
+        self.released.extend(requests)
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data.extend(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class RequestPiecesTests(unittest.TestCase):
+    def request(self, piece_manager, after=None):
+        """
+        Fills the pipeline of a connection to peer b'a'.
+
+        :param after: Called with the connection once the pipeline is full
+        :return: The bytes sent to the peer
+        """
+        writer = FakeWriter()
+
+        async def request():
+            peer = PeerConnection(Queue(), b'', b'', piece_manager)
+            peer.remote_id = b'a'
+            peer.writer = writer
+            await peer._request_pieces()
+            if after is not None:
+                after(peer)
+            peer.stop()
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(request())
+        finally:
+            loop.close()
+        return bytes(writer.data)
+
+    def test_duplicate_block_released(self):
+        blocks = [Block(0, 0, REQUEST_SIZE), Block(0, 0, REQUEST_SIZE)]
+        piece_manager = ScriptedPieceManager(blocks)
+        self.assertEqual(Request(0, 0, REQUEST_SIZE).encode(),
+                         self.request(piece_manager))
+        self.assertEqual([(0, 0)], piece_manager.released)
+
+    def test_cleared_requests_released(self):
+        blocks = [Block(0, offset, REQUEST_SIZE)
+                  for offset in (0, REQUEST_SIZE)]
+        piece_manager = ScriptedPieceManager(blocks)
+        pending = []
+
+        def clear(peer):
+            pending.extend(peer.requests.pending)
+            peer._clear_requests()
+            self.assertEqual(0, len(peer.requests))
+
+        self.request(piece_manager, clear)
+        self.assertEqual([(0, 0), (0, REQUEST_SIZE)], pending)
+        self.assertEqual(pending, piece_manager.released)
+
+
+class SingleFileInfo:
+    is_multi_file = False
+    name = 'content'
+    piece_length = 8
+
+    def __init__(self, length):
+        self.length = length
+
+
+class UploadPieceManager:
+    """
+    Serves the blocks of a single file torrent of 8 byte pieces, and counts
+    the blocks read into memory.
+    """
+
+    def __init__(self, work_path, content, sendfile=True):
+        self.content = content
+        self.sendfile = sendfile
+        self.reads = 0
+        self.file_manager = FileManager(SingleFileInfo(len(content)), [0],
+                                        work_path, fd_pool=FdPool())
+        self.file_manager.open()
+        with open(self.file_manager.path(0), 'wb') as file:
+            file.write(content)
+
+    def block_file(self, index, offset, length):
+        if not self.sendfile:
+            return None
+        return self.file_manager.block_file(index, offset, length)
+
+    async def read_block(self, index, offset, length):
+        self.reads += 1
+        return self.file_manager.read(index, offset, length)
+
+
+class SendBlockTests(unittest.TestCase):
+    def setUp(self):
+        self.work_path = tempfile.TemporaryDirectory()
+        self.addCleanup(self.work_path.cleanup)
+        self.content = bytes(range(16))
+
+    def send(self, piece_manager, request, cancel=None):
+        """
+        Answers the request over a loopback connection.
+
+        :param cancel: The (index, begin, length) of a block to cancel while
+                       the block is sent with sendfile
+        :return: The bytes the remote peer received
+        """
+        async def exchange():
+            received = bytearray()
+            done = asyncio.get_running_loop().create_future()
+
+            async def remote(reader, writer):
+                received.extend(await reader.read())
+                writer.close()
+                done.set_result(None)
+
+            server = await asyncio.start_server(remote, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            peer = PeerConnection(Queue(), b'', b'', piece_manager)
+            peer.writer = writer
+            sending = asyncio.ensure_future(peer._send_block(request))
+            if cancel is not None:
+                while not peer.in_sendfile:
+                    self.assertFalse(sending.done())
+                    await asyncio.sleep(0)
+                peer.send_cancel(*cancel)
+            await sending
+            peer.stop()
+            await done
+            server.close()
+            await server.wait_closed()
+            return bytes(received)
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(exchange())
+        finally:
+            loop.close()
+            piece_manager.file_manager.close()
+
+    def test_sendfile(self):
+        piece_manager = UploadPieceManager(self.work_path.name, self.content)
+        self.assertEqual(Piece(1, 2, self.content[10:14]).encode(),
+                         self.send(piece_manager, Request(1, 2, 4)))
+        self.assertEqual(0, piece_manager.reads)
+
+    def test_cancel_while_in_sendfile(self):
+        piece_manager = UploadPieceManager(self.work_path.name, self.content)
+        self.assertEqual(Piece(1, 2, self.content[10:14]).encode() +
+                         Cancel(0, 0, 4).encode(),
+                         self.send(piece_manager, Request(1, 2, 4),
+                                   cancel=(0, 0, 4)))
+
+    def test_buffered(self):
+        piece_manager = UploadPieceManager(self.work_path.name, self.content,
+                                           sendfile=False)
+        self.assertEqual(Piece(0, 4, self.content[4:8]).encode(),
+                         self.send(piece_manager, Request(0, 4, 4)))
+        self.assertEqual(1, piece_manager.reads)
+
+    def test_block_out_of_range(self):
+        piece_manager = UploadPieceManager(self.work_path.name, self.content)
+        self.assertEqual(b'', self.send(piece_manager, Request(1, 4, 8)))
+        self.assertEqual(1, piece_manager.reads)
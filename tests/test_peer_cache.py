@@ -0,0 +1,69 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+from src import peer_cache
+from src.peer_pool import PeerCandidate, PeerPool
+
+INFO_HASH = bytes(range(20))
+
+
+def candidate(ip, port, rate, last_seen=None):
+    peer = PeerCandidate((ip, port))
+    peer.rate = rate
+    if last_seen is not None:
+        peer.last_seen = last_seen
+    return peer
+
+
+class PeerCacheTests(unittest.TestCase):
+    def setUp(self):
+        work_path = tempfile.TemporaryDirectory()
+        self.addCleanup(work_path.cleanup)
+        self.path = os.path.join(work_path.name, INFO_HASH.hex() + '.peers')
+
+    def test_round_trip(self):
+        now = int(time.time())
+        peer_cache.save(self.path, INFO_HASH, [
+            candidate('10.0.0.1', 6881, 4096.0, now),
+            candidate('2001:db8::1', 51413, 512.0, now),
+            candidate('peer.example.com', 6881, 1.0)])
+        self.assertEqual([(('10.0.0.1', 6881), 4096.0, now),
+                          (('2001:db8::1', 51413), 512.0, now)],
+                         peer_cache.load(self.path, INFO_HASH))
+        self.assertLess(os.path.getsize(self.path), 120)
+
+    def test_unusable_caches(self):
+        self.assertEqual([], peer_cache.load(self.path, INFO_HASH))
+        peer_cache.save(self.path, INFO_HASH, [
+            candidate('10.0.0.1', 6881, 1.0)])
+        self.assertEqual([], peer_cache.load(self.path, bytes(20)))
+        with open(self.path, 'wb') as file:
+            file.write(b'garbage')
+        self.assertEqual([], peer_cache.load(self.path, INFO_HASH))
+
+    def test_old_peers_are_dropped(self):
+        old = time.time() - peer_cache.MAX_AGE - 60
+        peer_cache.save(self.path, INFO_HASH, [
+            candidate('10.0.0.1', 6881, 1.0, old),
+            candidate('10.0.0.2', 6881, 1.0)])
+        self.assertEqual([('10.0.0.2', 6881)],
+                         [address for address, _, _ in
+                          peer_cache.load(self.path, INFO_HASH)])
+
+    def test_restored_peers_are_tried_first(self):
+        pool = PeerPool()
+        pool.add([('10.0.0.1', 6881), ('10.0.0.2', 6881)])
+        pool.candidates[('10.0.0.2', 6881)].rate = 10.0
+        peer_cache.save(self.path, INFO_HASH, pool.proven())
+
+        restarted = PeerPool()
+        restarted.add([('10.0.0.3', 6881)])
+        restarted.restore(peer_cache.load(self.path, INFO_HASH))
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual([('10.0.0.2', 6881), ('10.0.0.3', 6881)],
+                         [loop.run_until_complete(restarted.get())
+                          for _ in range(2)])
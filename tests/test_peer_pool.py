@@ -0,0 +1,96 @@
+import asyncio
+import time
+import unittest
+
+from src.peer_pool import PeerPool
+
+A = ('10.0.0.1', 6881)
+B = ('10.0.0.2', 6881)
+C = ('10.0.0.3', 6881)
+
+
+class PeerPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.pool = PeerPool()
+
+    def get(self, timeout=0.05):
+        """
+        :return: The next peer handed out, or None if there is none
+        """
+        try:
+            return self.loop.run_until_complete(
+                asyncio.wait_for(self.pool.get(), timeout))
+        except asyncio.TimeoutError:
+            return None
+
+    def test_deduplicates(self):
+        self.pool.add([A, B])
+        self.pool.add([list(B), A, C])
+        self.assertEqual(3, len(self.pool))
+
+    def test_peer_in_use_is_not_handed_out_again(self):
+        self.pool.add([A])
+        self.assertEqual(A, self.get())
+        self.pool.add([A])
+        self.assertIsNone(self.get())
+
+    def test_proven_then_untried_then_failed(self):
+        self.pool.add([A, B, C])
+        first, second, third = self.get(), self.get(), self.get()
+        self.pool.connect_failed(first)
+        self.pool.disconnected(second, 1000, 1)
+        self.pool.disconnected(third, 4000, 1)
+        self.pool.add([('10.0.0.4', 6881)])
+        for candidate in self.pool.candidates.values():
+            candidate.retry_at = 0
+        self.assertEqual([third, second, ('10.0.0.4', 6881), first],
+                         [self.get() for _ in range(4)])
+
+    def test_failed_peers_back_off(self):
+        self.pool.add([A])
+        self.pool.handshake_failed(self.get())
+        self.assertIsNone(self.get())
+        candidate = self.pool.candidates[A]
+        self.assertEqual(1, candidate.failures)
+        candidate.retry_at = 0
+        self.pool.connect_failed(self.get())
+        self.assertEqual(2, candidate.failures)
+        self.assertGreater(candidate.retry_at - time.monotonic(),
+                           PeerPool.RETRY_INTERVAL * 1.5)
+
+    def test_banned_after_failures(self):
+        self.pool.add([A])
+        for _ in range(PeerPool.MAX_FAILURES):
+            self.pool.candidates[A].retry_at = 0
+            self.pool.connect_failed(self.get())
+        self.assertTrue(self.pool.candidates[A].banned)
+        self.pool.candidates[A].retry_at = 0
+        self.assertIsNone(self.get())
+        self.assertEqual(1, self.pool.bans)
+
+    def test_protocol_violation_bans(self):
+        self.pool.add([A, B])
+        peer = self.get()
+        self.pool.ban(peer)
+        self.pool.handshake_failed(peer)
+        self.assertEqual(({A, B} - {peer}).pop(), self.get())
+        self.assertIsNone(self.get())
+
+    def test_bounded(self):
+        pool = PeerPool(max_peers=2)
+        pool.add([A, B])
+        pool.connect_failed(self.loop.run_until_complete(pool.get()))
+        pool.add([C])
+        self.assertEqual(2, len(pool))
+        self.assertIn(C, pool.candidates)
+
+    def test_get_waits_for_peers(self):
+        async def add_later():
+            await asyncio.sleep(0.01)
+            self.pool.add([A])
+
+        get = asyncio.ensure_future(self.pool.get(), loop=self.loop)
+        self.loop.run_until_complete(add_later())
+        self.assertEqual(A, self.loop.run_until_complete(get))
@@ -19,8 +19,7 @@ class Reader:
 class PeerTests(unittest.TestCase):
     def async_test(f):
         def wrapper(*args, **kwargs):
-            coro = asyncio.coroutine(f)
-            future = coro(*args, **kwargs)
+            future = f(*args, **kwargs)
             loop = asyncio.get_event_loop()
             loop.run_until_complete(future)
 
@@ -136,3 +135,90 @@ class PeerTests(unittest.TestCase):
             if result is not None:
                 break
         self.assertIsInstance(result, Request)
+
+    @async_test
+    async def test_messages_in_one_read(self):
+        reader = Reader([b'\x00\x00\x00\x01\x01'
+                         b'\x00\x00\x00\x00'
+                         b'\x00\x00\x00\x05\x04\x00\x00\x00\x04'])
+        messages = []
+        async for message in PeerStreamIterator(reader, b''):
+            messages.append(message)
+        self.assertEqual([Unchoke, KeepAlive, Have],
+                         [type(message) for message in messages])
+        self.assertEqual(4, messages[2].index)
+
+    @async_test
+    async def test_piece_split_over_reads(self):
+        block = bytes(range(256)) * 64
+        data = Piece(3, 2 ** 14, block).encode() * 2
+        reader = Reader([data[i:i + 1000] for i in range(7, len(data), 1000)])
+        messages = []
+        async for message in PeerStreamIterator(reader, data[:7]):
+            messages.append(message)
+        self.assertEqual(2, len(messages))
+        for message in messages:
+            self.assertIsInstance(message, Piece)
+            self.assertEqual(3, message.index)
+            self.assertEqual(2 ** 14, message.begin)
+            self.assertEqual(block, message.block)
+
+    @async_test
+    async def test_piece_placement(self):
+        block = bytes(range(256)) * 64
+        data = Piece(3, 2 ** 14, block).encode() + b'\x00\x00\x00\x01\x01'
+        reader = Reader([data[i:i + 1000] for i in range(20, len(data), 1000)])
+        piece_buffer = bytearray(2 ** 15)
+        placed = []
+
+        def placement(index, begin, length):
+            placed.append((index, begin, length))
+            return memoryview(piece_buffer)[begin:begin + length]
+
+        messages = []
+        async for message in PeerStreamIterator(reader, data[:20], placement):
+            messages.append(message)
+        self.assertEqual([(3, 2 ** 14, 2 ** 14)], placed)
+        self.assertEqual([Piece, Unchoke],
+                         [type(message) for message in messages])
+        self.assertIs(piece_buffer, messages[0].block.obj)
+        self.assertEqual(block, piece_buffer[2 ** 14:])
+
+    @async_test
+    async def test_piece_placement_revoked(self):
+        block = bytes(range(256)) * 64
+        data = Piece(3, 0, block).encode()
+        reader = Reader([data[i:i + 1000] for i in range(20, len(data), 1000)])
+        piece_buffer = bytearray(2 ** 14)
+        placing = [True]
+
+        def placement(index, begin, length):
+            return memoryview(piece_buffer)[begin:begin + length]
+
+        def is_placing(index, begin):
+            # Revoked once the first read is placed
+            result = placing[0]
+            placing[0] = False
+            return result
+
+        messages = []
+        async for message in PeerStreamIterator(reader, data[:20], placement,
+                                                is_placing):
+            messages.append(message)
+        self.assertEqual(1, len(messages))
+        self.assertIsNot(piece_buffer, messages[0].block.obj)
+        self.assertEqual(block, messages[0].block)
+        # Only the bytes placed before the revocation reached the buffer
+        self.assertEqual(block[:1007], piece_buffer[:1007])
+        self.assertEqual(bytes(2 ** 14 - 1007), piece_buffer[1007:])
+
+    @async_test
+    async def test_piece_placement_declined(self):
+        data = Piece(0, 0, b'ok').encode()
+        reader = Reader([data[6:]])
+        messages = []
+        async for message in PeerStreamIterator(reader, data[:6],
+                                                lambda *args: None):
+            messages.append(message)
+        self.assertEqual(1, len(messages))
+        self.assertEqual(b'ok', messages[0].block)
@@ -0,0 +1,101 @@
+import random
+import unittest
+
+from bitstring import BitArray
+
+from src.piece_picker import PiecePicker, PieceSet
+
+
+class PieceSetTests(unittest.TestCase):
+    def test_add_discard(self):
+        pieces = PieceSet(10)
+        for index in (0, 3, 9, 3):
+            pieces.add(index)
+        pieces.discard(3)
+        pieces.discard(5)
+        self.assertEqual(2, len(pieces))
+        self.assertIn(9, pieces)
+        self.assertNotIn(3, pieces)
+        self.assertNotIn(10, pieces)
+        self.assertEqual([0, 9], list(pieces))
+        self.assertEqual(b'\x80\x40', bytes(pieces.bits))
+
+    def test_fill(self):
+        pieces = PieceSet(10)
+        pieces.fill()
+        self.assertEqual(10, len(pieces))
+        self.assertEqual(list(range(10)), list(pieces))
+        self.assertEqual(b'\xff\xc0', bytes(pieces.bits))
+
+    def test_bulk_updates(self):
+        pieces = PieceSet(10)
+        pieces.set_bits(b'\xf0\xff')
+        self.assertEqual([0, 1, 2, 3, 8, 9], list(pieces))
+        other = PieceSet(10)
+        other.add(1)
+        other.add(9)
+        pieces.difference_update(other)
+        self.assertEqual(4, len(pieces))
+        self.assertEqual([0, 2, 3, 8], list(pieces))
+
+
+class PiecePickerTests(unittest.TestCase):
+    def setUp(self):
+        random.seed(0)
+        self.picker = PiecePicker(8)
+        for index in range(8):
+            self.picker.add_wanted(index)
+
+    def test_availability(self):
+        self.picker.peer_added(BitArray('0b11110000'))
+        self.picker.peer_added(BitArray('0b11000000'))
+        self.picker.peer_has(7)
+        self.assertEqual([2, 2, 1, 1, 0, 0, 0, 1],
+                         list(self.picker.availability))
+
+        self.picker.peer_removed(BitArray('0b11000000'))
+        self.assertEqual([1, 1, 1, 1, 0, 0, 0, 1],
+                         list(self.picker.availability))
+
+    def test_pick_rarest(self):
+        seed = BitArray('0b11111111')
+        self.picker.peer_added(seed)
+        self.picker.peer_added(BitArray('0b11111100'))
+        self.picker.peer_added(BitArray('0b11111110'))
+        self.assertEqual(7, self.picker.pick(seed))
+
+        self.picker.remove_wanted(7)
+        self.assertEqual(6, self.picker.pick(seed))
+
+    def test_pick_only_pieces_of_peer(self):
+        self.picker.peer_added(BitArray('0b10000000'))
+        self.picker.peer_added(BitArray('0b01000000'))
+        self.picker.peer_added(BitArray('0b01000000'))
+        self.assertEqual(0, self.picker.pick(BitArray('0b10000000')))
+        self.assertEqual(1, self.picker.pick(BitArray('0b01000000')))
+        self.assertIsNone(self.picker.pick(BitArray('0b00100000')))
+
+    def test_random_tie_breaking(self):
+        seed = BitArray('0b11111111')
+        self.picker.peer_added(seed)
+        picked = {self.picker.pick(seed) for _ in range(100)}
+        self.assertGreater(len(picked), 4)
+
+    def test_add_all_wanted(self):
+        picker = PiecePicker(8)
+        picker.add_all_wanted()
+        picker.remove_wanted(3)
+        picker.peer_added(BitArray('0b00110000'))
+        self.assertEqual(2, picker.pick(BitArray('0b00110000')))
+
+        self.picker.remove_wanted(2)
+        self.picker.peer_added(BitArray('0b00100000'))
+        self.picker.add_all_wanted()
+        self.assertEqual(2, self.picker.pick(BitArray('0b00100000')))
+
+    def test_not_wanted_pieces_keep_availability(self):
+        self.picker.remove_wanted(2)
+        self.picker.peer_added(BitArray('0b00100000'))
+        self.assertIsNone(self.picker.pick(BitArray('0b00100000')))
+        self.picker.add_wanted(2)
+        self.assertEqual(2, self.picker.pick(BitArray('0b00100000')))
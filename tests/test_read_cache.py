@@ -0,0 +1,72 @@
+import asyncio
+import unittest
+
+from src.piece_picker import PieceSet
+from src.read_cache import ReadCache
+
+PIECE_LENGTH = 8
+
+
+class FakeDiskIO:
+    """
+    Pieces of 8 bytes all set to their index, counting the reads.
+    """
+
+    def __init__(self):
+        self.reads = []
+
+    async def read(self, index, offset, length):
+        self.reads.append((index, offset, length))
+        await asyncio.sleep(0)
+        start = index * PIECE_LENGTH + offset
+        return bytearray(position // PIECE_LENGTH
+                         for position in range(start, start + length))
+
+
+class ReadCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.disk_io = FakeDiskIO()
+        self.have = PieceSet(8)
+        self.have.fill()
+        self.have.discard(6)
+        self.cache = ReadCache(self.disk_io, lambda index: PIECE_LENGTH,
+                               self.have, budget=4 * PIECE_LENGTH,
+                               readahead=2)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def read(self, index, offset=0, length=4):
+        return self.loop.run_until_complete(
+            self.cache.read(index, offset, length))
+
+    def test_blocks_served_from_memory(self):
+        self.assertEqual(b'\x00' * 4, self.read(0))
+        self.assertEqual(b'\x00' * 4, self.read(0, 4))
+        # Read ahead with the first piece
+        self.assertEqual(b'\x02' * 4, self.read(2))
+        self.assertEqual([(0, 0, 3 * PIECE_LENGTH)], self.disk_io.reads)
+        self.assertEqual((2, 1), (self.cache.hits, self.cache.misses))
+        self.assertIsNone(self.read(0, 6, 4))
+
+    def test_readahead_stops_at_missing_piece(self):
+        self.read(5)
+        self.assertEqual([(5, 0, PIECE_LENGTH)], self.disk_io.reads)
+
+    def test_eviction(self):
+        self.read(0)
+        self.read(3)
+        self.read(0)
+        # Pieces 0 to 5 were read, then 0 again with 1, the oldest pieces
+        # made room for them
+        self.assertEqual([4, 5, 0, 1], list(self.cache.pieces))
+        self.assertEqual(4, self.cache.evictions)
+        self.assertEqual(4 * PIECE_LENGTH, self.cache.size)
+
+    def test_concurrent_misses_read_once(self):
+        async def read():
+            return await asyncio.gather(self.cache.read(7, 0, 4),
+                                        self.cache.read(7, 4, 4))
+
+        blocks = self.loop.run_until_complete(read())
+        self.assertEqual([b'\x07' * 4] * 2, blocks)
+        self.assertEqual(1, len(self.disk_io.reads))
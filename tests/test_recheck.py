@@ -0,0 +1,32 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+from src.recheck import check_pieces
+
+
+class CheckPiecesTests(unittest.TestCase):
+    def setUp(self):
+        work_path = tempfile.TemporaryDirectory()
+        self.addCleanup(work_path.cleanup)
+        self.first = os.path.join(work_path.name, 'first')
+        self.second = os.path.join(work_path.name, 'second')
+        self.missing = os.path.join(work_path.name, 'missing')
+        with open(self.first, 'wb') as f:
+            f.write(b'abcdef')
+        with open(self.second, 'wb') as f:
+            f.write(b'gh')
+
+    def test_check_pieces(self):
+        pieces = [
+            (0, hashlib.sha1(b'abcd').digest(), [(self.first, 0, 4)]),
+            # Spans two files
+            (1, hashlib.sha1(b'efgh').digest(),
+             [(self.first, 4, 2), (self.second, 0, 2)]),
+            (2, hashlib.sha1(b'xxxx').digest(), [(self.first, 0, 4)]),
+            # Past the end of the file
+            (3, hashlib.sha1(b'gh\0\0').digest(), [(self.second, 0, 4)]),
+            (4, hashlib.sha1(b'').digest(), [(self.missing, 0, 4)]),
+        ]
+        self.assertEqual([0, 1], check_pieces(pieces))
@@ -0,0 +1,57 @@
+import unittest
+
+from src.storage import MemoryStorage, Storage
+from tests import FakePiece
+
+
+class FakeInfo:
+    """
+    A torrent of 4 byte pieces over files of 3, 6 and 1 bytes.
+    """
+    is_multi_file = True
+    piece_length = 4
+    files = [{'length': 3, 'path': ['0']},
+             {'length': 6, 'path': ['1']},
+             {'length': 1, 'path': ['2']}]
+    length = 10
+
+
+class MemoryStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.storage = MemoryStorage(FakeInfo(), [1, 2])
+        self.storage.open()
+        self.addCleanup(self.storage.close)
+
+    def test_need_piece(self):
+        self.assertEqual([True, True, True],
+                         [self.storage.need_piece(index)
+                          for index in range(3)])
+        self.assertFalse(MemoryStorage(FakeInfo(), [2]).need_piece(0))
+
+    def test_write_and_read(self):
+        content = bytearray(range(10))
+        self.storage.write_pieces([FakePiece(1, content[4:8]),
+                                   FakePiece(2, content[8:])])
+        # The written buffers may be reused
+        content[4:] = bytes(6)
+        self.assertEqual(bytes(range(5, 10)), self.storage.read(1, 1, 5))
+        self.assertEqual(b'\x08\x09', self.storage.read(2, 0, 2))
+
+    def test_missing_pieces_read_as_zeros(self):
+        self.storage.write(FakePiece(2, b'\x08\x09'))
+        self.assertEqual(b'\x00\x00\x08', self.storage.read(1, 2, 3))
+
+    def test_out_of_range_or_not_downloaded(self):
+        self.assertIsNone(self.storage.read(0, 0, 4))
+        self.assertIsNone(self.storage.read(2, 0, 4))
+        self.assertIsNone(self.storage.block_file(1, 0, 4))
+
+
+class StorageTests(unittest.TestCase):
+    def test_backend_without_read_cannot_be_created(self):
+        class WriteOnlyStorage(Storage):
+            def write(self, piece):
+                pass
+
+        with self.assertRaises(TypeError):
+            WriteOnlyStorage(FakeInfo(), [0])
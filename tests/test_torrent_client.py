@@ -0,0 +1,458 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from bitstring import BitArray
+
+from src import peer_cache
+from src.peer_pool import PeerCandidate
+from src.storage import MemoryStorage
+from src.torrent_client import Block, Piece, PieceManager, REQUEST_SIZE, \
+    TorrentClient
+
+
+class FakeInfo:
+    """
+    A single file torrent of `pieces_number` pieces of two blocks each, with
+    all bytes of piece `i` set to `i`.
+    """
+    is_multi_file = False
+    name = 'fake'
+    piece_length = 2 * REQUEST_SIZE
+
+    def __init__(self, pieces_number):
+        self.length = pieces_number * self.piece_length
+        self.pieces = [hashlib.sha1(self.data(index)).digest()
+                       for index in range(pieces_number)]
+
+    def data(self, index):
+        return bytes([index]) * self.piece_length
+
+
+def make_piece(blocks_number=4, data=None):
+    data = data if data is not None else bytes(blocks_number * REQUEST_SIZE)
+    blocks = [Block(0, offset * REQUEST_SIZE, REQUEST_SIZE)
+              for offset in range(blocks_number)]
+    return Piece(0, blocks, hashlib.sha1(data).digest())
+
+
+class PieceTests(unittest.TestCase):
+    def test_next_request_in_order(self):
+        piece = make_piece()
+        offsets = [piece.next_request().offset for _ in range(4)]
+        self.assertEqual([0, REQUEST_SIZE, 2 * REQUEST_SIZE,
+                          3 * REQUEST_SIZE], offsets)
+        self.assertIsNone(piece.next_request())
+        self.assertFalse(piece.has_missing())
+
+    def test_next_request_skips_retrieved(self):
+        piece = make_piece()
+        piece.block_received(0, bytes(REQUEST_SIZE))
+        piece.block_received(REQUEST_SIZE, bytes(REQUEST_SIZE))
+        self.assertEqual(2 * REQUEST_SIZE, piece.next_request().offset)
+
+    def test_block_lookup(self):
+        piece = make_piece()
+        self.assertEqual(REQUEST_SIZE, piece.block(REQUEST_SIZE).offset)
+        self.assertIsNone(piece.block(1))
+        self.assertIsNone(piece.block(4 * REQUEST_SIZE))
+
+    def test_complete_and_hash(self):
+        data = bytes(range(256)) * 256
+        piece = make_piece(data=data)
+        for offset in reversed(range(0, len(data), REQUEST_SIZE)):
+            self.assertFalse(piece.is_complete())
+            piece.block_received(offset, data[offset:offset + REQUEST_SIZE])
+        # A duplicate block does not count twice
+        piece.block_received(0, data[:REQUEST_SIZE])
+        self.assertEqual(4, piece.retrieved)
+        self.assertTrue(piece.is_complete())
+        self.assertTrue(piece.is_hash_matching())
+        self.assertEqual(data, piece.data)
+
+    def test_hashable_blocks_in_order(self):
+        piece = make_piece()
+        piece.block_received(REQUEST_SIZE, bytes(REQUEST_SIZE))
+        self.assertEqual((0, 0), piece.hashable())
+        piece.block_received(0, bytes(REQUEST_SIZE))
+        self.assertEqual((0, 2), piece.hashable())
+        piece.update_hash(piece.sha1, 0, 2)
+        piece.hashed = 2
+        piece.block_received(3 * REQUEST_SIZE, bytes(REQUEST_SIZE))
+        self.assertEqual((2, 2), piece.hashable())
+
+    def test_reset(self):
+        piece = make_piece()
+        while piece.next_request():
+            pass
+        piece.block_received(0, bytes(REQUEST_SIZE))
+        piece.reset()
+        self.assertEqual(0, piece.retrieved)
+        self.assertEqual(0, piece.next_request().offset)
+
+    def test_wrong_block_length_is_rejected(self):
+        piece = make_piece()
+        piece.block_received(0, b'short')
+        self.assertEqual(0, piece.retrieved)
+        self.assertEqual(4 * REQUEST_SIZE, len(piece.data))
+
+
+class PieceManagerTests(unittest.TestCase):
+    def setUp(self):
+        self.info = FakeInfo(2)
+        work_path = tempfile.TemporaryDirectory()
+        self.addCleanup(work_path.cleanup)
+        self.piece_manager = PieceManager(self.info, [0],
+                                          work_path.name + '/')
+        self.addCleanup(self.piece_manager.close)
+        self.cancelled = []
+        self.piece_manager.cancel_request = \
+            lambda peer_id, block: self.cancelled.append(
+                (peer_id, block.piece, block.offset))
+        for peer_id in (b'a', b'b', b'c', b'd'):
+            self.piece_manager.add_peer(peer_id, BitArray(b'\xc0'))
+
+    def receive(self, peer_id, block):
+        data = self.info.data(block.piece)[:block.length]
+        self.piece_manager.block_received(peer_id, block.piece,
+                                          block.offset, data)
+
+    def test_pieces_created_when_started(self):
+        self.assertEqual(2, len(self.piece_manager.missing_pieces))
+        self.assertEqual({}, self.piece_manager.ongoing_pieces)
+        block = self.piece_manager.next_request(b'a')
+        piece = self.piece_manager.ongoing_pieces[block.piece]
+        self.assertEqual(self.info.pieces[block.piece], piece.hash)
+        self.assertEqual(2, len(piece.blocks))
+        self.assertNotIn(block.piece, self.piece_manager.missing_pieces)
+
+    def test_endgame_duplicates_and_cancel(self):
+        blocks = [self.piece_manager.next_request(b'a') for _ in range(4)]
+        self.assertTrue(self.piece_manager.is_endgame)
+
+        # Each pending block goes to two more peers at most
+        duplicates = [self.piece_manager.next_request(peer_id)
+                      for peer_id in (b'b', b'b', b'c')]
+        self.assertEqual(blocks[:2], duplicates[:2])
+        self.assertIs(blocks[0], duplicates[2])
+        self.piece_manager.next_request(b'c')
+        self.assertIs(blocks[2], self.piece_manager.next_request(b'd'))
+
+        self.receive(b'b', blocks[0])
+        self.assertEqual([(b'a', blocks[0].piece, 0),
+                          (b'c', blocks[0].piece, 0)],
+                         sorted(self.cancelled))
+
+        # The slower copy is not needed anymore
+        self.receive(b'a', blocks[0])
+        self.assertEqual(REQUEST_SIZE, self.piece_manager.bytes_wasted)
+
+    def test_unsolicited_block_completes_open_piece(self):
+        first = self.piece_manager.next_request(b'a')
+        # The other block of the piece arrives without being requested
+        self.receive(b'b', Block(first.piece, REQUEST_SIZE, REQUEST_SIZE))
+        self.receive(b'a', first)
+        self.assertEqual([first.piece], list(self.piece_manager.have_pieces))
+        self.assertEqual({}, self.piece_manager.open_pieces)
+        block = self.piece_manager.next_request(b'a')
+        self.assertNotEqual(first.piece, block.piece)
+
+    def test_released_requests_are_handed_out_again(self):
+        first, second, _, _ = [self.piece_manager.next_request(b'a')
+                               for _ in range(4)]
+        # An endgame duplicate
+        self.assertIs(first, self.piece_manager.next_request(b'b'))
+        self.piece_manager.release_requests(
+            b'a', [(first.piece, first.offset),
+                   (second.piece, second.offset)])
+        # Still requested from b
+        self.assertEqual({b'b'}, self.piece_manager.requesters[
+            (first.piece, first.offset)])
+        self.assertNotIn((second.piece, second.offset),
+                         self.piece_manager.pending_blocks)
+        self.assertIs(Block.Missing, second.status)
+        self.assertFalse(self.piece_manager.is_endgame)
+        self.assertIs(second, self.piece_manager.next_request(b'c'))
+
+    def test_failing_cancel_still_completes_pieces(self):
+        def cancel_request(peer_id, block):
+            raise RuntimeError('unable to write; sendfile is in progress')
+
+        self.piece_manager.cancel_request = cancel_request
+        blocks = [self.piece_manager.next_request(b'a') for _ in range(4)]
+        for block in blocks:
+            self.assertIs(block, self.piece_manager.next_request(b'b'))
+        with self.assertLogs(level='ERROR'):
+            for block in blocks:
+                self.receive(b'b', block)
+        self.assertEqual(2, len(self.piece_manager.have_pieces))
+
+    def test_placement_revoked_by_duplicate_request(self):
+        blocks = [self.piece_manager.next_request(b'a') for _ in range(4)]
+        block = blocks[0]
+        target = self.piece_manager.block_buffer(block.piece, block.offset,
+                                                 block.length)
+        self.assertIsNotNone(target)
+        self.assertTrue(self.piece_manager.is_placing(block.piece,
+                                                      block.offset))
+        self.assertEqual(block, self.piece_manager.next_request(b'b'))
+        self.assertFalse(self.piece_manager.is_placing(block.piece,
+                                                       block.offset))
+        # The duplicate is not received into the piece buffer either
+        self.assertIsNone(self.piece_manager.block_buffer(
+            block.piece, block.offset, block.length))
+
+    def test_endgame_completes_pieces(self):
+        blocks = [self.piece_manager.next_request(b'a') for _ in range(4)]
+        duplicates = [self.piece_manager.next_request(b'b')
+                      for _ in range(4)]
+        for block in duplicates:
+            self.receive(b'b', block)
+        self.assertEqual(2, len(self.piece_manager.have_pieces))
+        self.assertFalse(self.piece_manager.is_endgame)
+        self.assertEqual(4, len(self.cancelled))
+        for block in blocks:
+            self.receive(b'a', block)
+        self.assertEqual(4 * REQUEST_SIZE, self.piece_manager.bytes_wasted)
+
+    def test_hash_on_thread_pool(self):
+        async def download():
+            for _ in range(2):
+                self.receive(b'a', self.piece_manager.next_request(b'a'))
+            self.assertEqual(1, self.piece_manager.hash_queue_length)
+            self.assertEqual(0, len(self.piece_manager.have_pieces))
+            while self.piece_manager.hash_queue_length:
+                await asyncio.sleep(0.01)
+            await self.piece_manager.flush()
+
+        asyncio.new_event_loop().run_until_complete(download())
+        self.assertEqual(1, len(self.piece_manager.have_pieces))
+        self.assertEqual(1, self.piece_manager.pieces_hashed)
+        self.assertGreater(self.piece_manager.hash_time, 0)
+
+    def test_corrupt_piece_is_reset(self):
+        for _ in range(2):
+            block = self.piece_manager.next_request(b'a')
+            self.piece_manager.block_received(b'a', block.piece, block.offset,
+                                              b'\xff' * block.length)
+        piece = self.piece_manager.ongoing_pieces[block.piece]
+        self.assertEqual(0, piece.retrieved)
+        self.assertIn(block.piece, self.piece_manager.open_pieces)
+        self.assertEqual(0, len(self.piece_manager.have_pieces))
+
+    def test_blocks_hashed_as_they_arrive(self):
+        first = self.piece_manager.next_request(b'a')
+        second = self.piece_manager.next_request(b'a')
+        piece = self.piece_manager.ongoing_pieces[first.piece]
+        self.receive(b'a', second)
+        self.assertEqual(0, piece.hashed)
+        self.receive(b'a', first)
+        self.assertEqual(1, self.piece_manager.pieces_hashed)
+        self.assertEqual([piece.index],
+                         list(self.piece_manager.have_pieces))
+
+    def test_block_file_only_with_sendfile(self):
+        for _ in range(2):
+            self.receive(b'a', self.piece_manager.next_request(b'a'))
+        index = list(self.piece_manager.have_pieces)[0]
+        self.assertIsNone(self.piece_manager.block_file(index, 0, 4))
+        self.piece_manager.sendfile = True
+        self.assertIsNone(self.piece_manager.block_file(1 - index, 0, 4))
+        with self.piece_manager.block_file(index, 4, 4) as (file, offset):
+            self.assertEqual(self.info.data(index)[4:8],
+                             os.pread(file.fileno(), 4, offset))
+
+
+class MmapPieceManagerTests(unittest.TestCase):
+    def test_blocks_received_into_mapping(self):
+        info = FakeInfo(2)
+        work_path = tempfile.TemporaryDirectory()
+        self.addCleanup(work_path.cleanup)
+        piece_manager = PieceManager(info, [0], work_path.name + '/',
+                                     storage='mmap')
+        piece_manager.add_peer(b'a', BitArray(b'\xc0'))
+        for _ in range(2):
+            block = piece_manager.next_request(b'a')
+            target = piece_manager.block_buffer(block.piece, block.offset,
+                                                block.length)
+            target[:] = info.data(block.piece)[:block.length]
+            piece_manager.block_received(b'a', block.piece, block.offset,
+                                         target)
+        piece_manager.close()
+        self.assertEqual([block.piece], list(piece_manager.have_pieces))
+        with open(work_path.name + '/' + info.name, 'rb') as f:
+            f.seek(block.piece * info.piece_length)
+            self.assertEqual(info.data(block.piece),
+                             f.read(info.piece_length))
+
+
+class MemoryPieceManagerTests(unittest.TestCase):
+    def test_download_in_memory(self):
+        info = FakeInfo(2)
+        storage = MemoryStorage(info, [0])
+        work_path = tempfile.TemporaryDirectory()
+        self.addCleanup(work_path.cleanup)
+        piece_manager = PieceManager(info, [0], work_path.name + '/',
+                                     storage=storage)
+        self.assertIs(storage, piece_manager.file_manager)
+        piece_manager.add_peer(b'a', BitArray(b'\xc0'))
+        while True:
+            block = piece_manager.next_request(b'a')
+            if block is None:
+                break
+            piece_manager.block_received(
+                b'a', block.piece, block.offset,
+                info.data(block.piece)[:block.length])
+        piece_manager.save_resume()
+        piece_manager.close()
+        self.assertEqual(2, len(piece_manager.have_pieces))
+        self.assertEqual(info.data(1), storage.read(1, 0, info.piece_length))
+        self.assertEqual([], os.listdir(work_path.name))
+
+
+class ClientInfo(FakeInfo):
+    """
+    A torrent whose only tracker refuses connections.
+    """
+    hash20 = bytes(range(20))
+    peer_id = '-PC0001-000000000000'
+    announce = 'http://127.0.0.1:1/announce'
+    announce_tiers = [[announce]]
+
+
+class TorrentClientTests(unittest.TestCase):
+    def test_cached_peers_used_while_tracker_is_down(self):
+        info = ClientInfo(2)
+        work_path = tempfile.TemporaryDirectory()
+        self.addCleanup(work_path.cleanup)
+
+        async def start():
+            connected = asyncio.get_running_loop().create_future()
+
+            def accept(reader, writer):
+                writer.close()
+                if not connected.done():
+                    connected.set_result(None)
+
+            server = await asyncio.start_server(accept, '127.0.0.1', 0)
+            peer = PeerCandidate(
+                ('127.0.0.1', server.sockets[0].getsockname()[1]))
+            peer.rate = 1024.0
+            peer_cache.save(peer_cache.cache_path(work_path.name, info),
+                            info.hash20, [peer])
+
+            client = TorrentClient(info, [0], work_path.name,
+                                   storage=MemoryStorage(info, [0]))
+            running = asyncio.ensure_future(client.start())
+            await asyncio.wait_for(connected, 5)
+            while not client.tracker.failures:
+                self.assertFalse(running.done())
+                await asyncio.sleep(0.01)
+            # The failed announce did not end the client
+            await asyncio.sleep(0.01)
+            self.assertFalse(running.done())
+            running.cancel()
+            await client.stop()
+            server.close()
+            await server.wait_closed()
+
+        saved_from = []
+        save = peer_cache.save
+
+        def save_in_thread(*args):
+            saved_from.append(threading.current_thread())
+            save(*args)
+
+        with mock.patch.object(TorrentClient, 'listen', mock.AsyncMock()), \
+                mock.patch.object(peer_cache, 'save', save_in_thread):
+            asyncio.run(start())
+        # The test saved the cache first, the client on stop, off the event
+        # loop
+        self.assertEqual(2, len(saved_from))
+        self.assertIsNot(threading.main_thread(), saved_from[1])
+        self.assertEqual(1, len(peer_cache.load(
+            peer_cache.cache_path(work_path.name, info), info.hash20)))
+
+
+class ResumeTests(unittest.TestCase):
+    def setUp(self):
+        self.info = FakeInfo(2)
+        work_path = tempfile.TemporaryDirectory()
+        self.addCleanup(work_path.cleanup)
+        self.work_path = work_path.name + '/'
+
+    def piece_manager(self, storage='file'):
+        piece_manager = PieceManager(self.info, [0], self.work_path,
+                                     storage=storage)
+        self.addCleanup(piece_manager.close)
+        piece_manager.add_peer(b'a', BitArray(b'\xc0'))
+        return piece_manager
+
+    def receive(self, piece_manager, blocks_number):
+        for _ in range(blocks_number):
+            block = piece_manager.next_request(b'a')
+            target = piece_manager.block_buffer(block.piece, block.offset,
+                                                block.length)
+            target[:] = self.info.data(block.piece)[:block.length]
+            piece_manager.block_received(b'a', block.piece, block.offset,
+                                         target)
+        return block
+
+    def test_verified_pieces_are_resumed(self):
+        piece_manager = self.piece_manager()
+        block = self.receive(piece_manager, 2)
+        piece_manager.save_resume()
+        piece_manager.close()
+
+        piece_manager = self.piece_manager()
+        self.assertEqual([block.piece], list(piece_manager.have_pieces))
+        self.assertEqual([1 - block.piece],
+                         list(piece_manager.missing_pieces))
+
+    def test_changed_files_are_not_trusted(self):
+        piece_manager = self.piece_manager()
+        self.receive(piece_manager, 2)
+        piece_manager.save_resume()
+        piece_manager.close()
+        os.utime(self.work_path + self.info.name, ns=(0, 0))
+
+        piece_manager = self.piece_manager()
+        self.assertEqual(0, len(piece_manager.have_pieces))
+        self.assertEqual(2, len(piece_manager.missing_pieces))
+
+    def test_partial_pieces_in_place_are_resumed(self):
+        piece_manager = self.piece_manager('mmap')
+        block = self.receive(piece_manager, 1)
+        piece_manager.save_resume()
+        piece_manager.close()
+
+        piece_manager = self.piece_manager('mmap')
+        piece = piece_manager.ongoing_pieces[block.piece]
+        self.assertEqual(1, piece.retrieved)
+        self.receive(piece_manager, 1)
+        self.assertEqual([block.piece], list(piece_manager.have_pieces))
+
+
+class RecheckTests(unittest.TestCase):
+    def test_pieces_on_disk_become_have(self):
+        info = FakeInfo(3)
+        work_path = tempfile.TemporaryDirectory()
+        self.addCleanup(work_path.cleanup)
+        with open(work_path.name + '/' + info.name, 'wb') as f:
+            f.write(info.data(0) + bytes(info.piece_length) + info.data(2))
+        piece_manager = PieceManager(info, [0], work_path.name + '/')
+        self.addCleanup(piece_manager.close)
+        progress = []
+        piece_manager.recheck_progress = \
+            lambda checked, total: progress.append((checked, total))
+
+        asyncio.new_event_loop().run_until_complete(
+            piece_manager.recheck(workers=2))
+        self.assertEqual([0, 2], list(piece_manager.have_pieces))
+        self.assertEqual([1], list(piece_manager.missing_pieces))
+        self.assertEqual((3, 3), progress[-1])
+        self.assertTrue(os.path.exists(piece_manager.resume_path))
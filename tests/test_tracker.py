@@ -1,5 +1,9 @@
 import asyncio
+import socket
+import struct
+import time
 import unittest
+from unittest import mock
 
 from src.tracker import Tracker, TrackerResponse
 from src.info import Info
@@ -32,3 +36,131 @@ class TrackerTests(unittest.TestCase):
         await tracker.close()
         self.assertFalse(result.failure is None)
         print(result)
+
+
+class TiersInfo:
+    hash20 = bytes(20)
+    peer_id = '-PC0001-000000000000'
+    length = 100
+
+    def __init__(self, tiers):
+        self.announce_tiers = tiers
+
+
+class ScriptedTracker(Tracker):
+    """
+    Answers the announce to every URL after the given delay with the given
+    peers, or fails it if there are none.
+    """
+
+    def __init__(self, tiers, script):
+        super().__init__(TiersInfo(tiers))
+        # Keep the tiers in order
+        self.tiers = [list(tier) for tier in tiers]
+        self.script = script
+        self.announced = []
+
+    async def _announce(self, url, params):
+        self.announced.append(url)
+        delay, peers = self.script[url]
+        await asyncio.sleep(delay)
+        if peers is None:
+            raise ConnectionError(url)
+        if isinstance(peers, str):
+            return TrackerResponse({b'failure reason': peers.encode()})
+        return TrackerResponse({b'interval': 100 + len(url),
+                                b'peers': b''.join(
+                                    socket.inet_aton('10.0.0.' + str(peer)) +
+                                    struct.pack('>H', 6881)
+                                    for peer in peers)})
+
+
+class TrackerTiersTests(unittest.TestCase):
+    def connect(self, tracker):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(tracker.connect(True))
+        finally:
+            loop.close()
+
+    def test_tier_announced_concurrently_and_merged(self):
+        tracker = ScriptedTracker([['slow', 'fast']],
+                                  {'slow': (0.05, [1, 2]),
+                                   'fast': (0.01, [2, 3])})
+        start = time.monotonic()
+        response = self.connect(tracker)
+        self.assertLess(time.monotonic() - start, 0.09)
+        self.assertEqual([('10.0.0.2', 6881), ('10.0.0.3', 6881),
+                          ('10.0.0.1', 6881)], response.peers)
+        # The interval of the fastest tracker, which is promoted
+        self.assertEqual(104, response.interval)
+        self.assertEqual([['fast', 'slow']], tracker.tiers)
+        self.assertIsNotNone(tracker.time_to_first_peer)
+
+    def test_slow_trackers_are_not_waited_for(self):
+        tracker = ScriptedTracker([['slow', 'fast']],
+                                  {'slow': (10, [1]), 'fast': (0, [2])})
+        with mock.patch.object(Tracker, 'MERGE_TIMEOUT', 0.01):
+            response = self.connect(tracker)
+        self.assertEqual([('10.0.0.2', 6881)], response.peers)
+        self.assertEqual({}, tracker.failures)
+
+    def test_failover_and_backoff(self):
+        tracker = ScriptedTracker([['down'], ['up']],
+                                  {'down': (0, None), 'up': (0, [1])})
+        response = self.connect(tracker)
+        self.assertEqual([('10.0.0.1', 6881)], response.peers)
+        self.assertEqual(1, tracker.failures['down'])
+        retry_at = tracker.retry_at['down']
+        self.assertAlmostEqual(time.monotonic() + Tracker.BACKOFF, retry_at,
+                               delta=1)
+        # Left out while backing off
+        self.connect(tracker)
+        self.assertEqual(['down', 'up', 'up'], tracker.announced)
+        # The backoff doubles
+        tracker.retry_at['down'] = 0
+        self.connect(tracker)
+        self.assertEqual(2, tracker.failures['down'])
+        self.assertAlmostEqual(time.monotonic() + 2 * Tracker.BACKOFF,
+                               tracker.retry_at['down'], delta=1)
+
+    def test_all_trackers_fail(self):
+        tracker = ScriptedTracker([['a'], ['b']],
+                                  {'a': (0, None), 'b': (0, 'not found')})
+        self.assertEqual('not found', self.connect(tracker).failure)
+        self.assertAlmostEqual(Tracker.BACKOFF, tracker.next_retry(),
+                               delta=1)
+        with self.assertRaises(ConnectionError):
+            self.connect(tracker)
+        tracker.retry_at['b'] = 0
+        self.assertEqual(0, tracker.next_retry())
+
+
+class TrackerResponseTests(unittest.TestCase):
+    def test_compact_peers(self):
+        peers = socket.inet_aton('1.2.3.4') + struct.pack('>H', 6881) + \
+            socket.inet_aton('5.6.7.8') + struct.pack('>H', 80) + b'\x01'
+        response = TrackerResponse({b'peers': peers})
+        self.assertEqual([('1.2.3.4', 6881), ('5.6.7.8', 80)],
+                         response.peers)
+        self.assertIs(response.peers, response.peers)
+
+    def test_compact_ipv6_peers(self):
+        peers6 = socket.inet_pton(socket.AF_INET6, '2001:db8::1') + \
+            struct.pack('>H', 6881)
+        response = TrackerResponse({
+            b'peers': socket.inet_aton('1.2.3.4') + struct.pack('>H', 1),
+            b'peers6': peers6})
+        self.assertEqual([('1.2.3.4', 1), ('2001:db8::1', 6881)],
+                         response.peers)
+
+    def test_dictionary_peers(self):
+        response = TrackerResponse({b'peers': [
+            {b'peer id': b'a' * 20, b'ip': b'1.2.3.4', b'port': 6881},
+            {b'ip': b'2001:db8::1', b'port': 80},
+            {b'ip': b'example.com'}]})
+        self.assertEqual([('1.2.3.4', 6881), ('2001:db8::1', 80)],
+                         response.peers)
+
+    def test_no_peers(self):
+        self.assertEqual([], TrackerResponse({}).peers)
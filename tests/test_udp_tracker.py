@@ -0,0 +1,155 @@
+import asyncio
+import socket
+import struct
+import unittest
+
+from src.tracker import Tracker
+from src.udp_tracker import UdpTracker, PROTOCOL_ID
+
+
+class FakeUdpTracker(asyncio.DatagramProtocol):
+    """
+    Answers connect and announce requests with two peers, after dropping
+    the first `drop` requests.
+    """
+    PEERS = socket.inet_aton('10.0.0.1') + struct.pack('>H', 6881) + \
+        socket.inet_aton('10.0.0.2') + struct.pack('>H', 6882)
+
+    def __init__(self, drop=0, error=None):
+        self.drop = drop
+        self.error = error
+        self.connection_id = 0x1234
+        self.requests = []
+        self.announces = []
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.requests.append(data)
+        if self.drop:
+            self.drop -= 1
+            return
+        connection_id, action, transaction_id = struct.unpack_from('>QII',
+                                                                   data)
+        if action == 0:
+            assert connection_id == PROTOCOL_ID
+            self.transport.sendto(struct.pack(
+                '>IIQ', 0, transaction_id, self.connection_id), addr)
+        elif connection_id != self.connection_id:
+            return
+        elif self.error:
+            self.transport.sendto(struct.pack('>II', 3, transaction_id) +
+                                  self.error, addr)
+        else:
+            self.announces.append(struct.unpack_from(
+                '>20s20sQQQIIIiH', data, 16))
+            self.transport.sendto(struct.pack(
+                '>IIIII', 1, transaction_id, 1800, 3, 7) + self.PEERS, addr)
+
+
+class FakeInfo:
+    hash20 = bytes(range(20))
+    peer_id = '-PC0001-000000000000'
+    length = 100
+
+    def __init__(self, announce):
+        self.announce = announce
+        self.announce_tiers = [[announce]]
+
+
+class UdpTrackerTests(unittest.TestCase):
+    def run_with_tracker(self, test, **kwargs):
+        async def run():
+            server, protocol = \
+                await asyncio.get_running_loop().create_datagram_endpoint(
+                    lambda: FakeUdpTracker(**kwargs),
+                    local_addr=('127.0.0.1', 0))
+            port = server.get_extra_info('sockname')[1]
+            try:
+                await test(protocol, 'udp://127.0.0.1:{port}/announce'
+                           .format(port=port))
+            finally:
+                server.close()
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def announce(self, tracker):
+        return tracker.announce(FakeInfo.hash20, b'p' * 20, 6889, 1, 2, 3,
+                                'started')
+
+    def test_announce(self):
+        async def test(server, url):
+            tracker = UdpTracker(url)
+            response = await self.announce(tracker)
+            tracker.close()
+            self.assertEqual(1800, response[b'interval'])
+            self.assertEqual(3, response[b'incomplete'])
+            self.assertEqual(7, response[b'complete'])
+            self.assertEqual(FakeUdpTracker.PEERS, response[b'peers'])
+            self.assertEqual([(FakeInfo.hash20, b'p' * 20, 2, 3, 1, 2, 0, 0,
+                               -1, 6889)], server.announces)
+
+        self.run_with_tracker(test)
+
+    def test_connection_id_is_cached(self):
+        async def test(server, url):
+            tracker = UdpTracker(url)
+            await self.announce(tracker)
+            await self.announce(tracker)
+            self.assertEqual(1, tracker.connects)
+            tracker.connected_at -= UdpTracker.CONNECTION_ID_TTL
+            await self.announce(tracker)
+            tracker.close()
+            self.assertEqual(2, tracker.connects)
+            self.assertEqual(5, len(server.requests))
+
+        self.run_with_tracker(test)
+
+    def test_retransmission(self):
+        async def test(server, url):
+            tracker = UdpTracker(url, timeout=0.01)
+            response = await self.announce(tracker)
+            tracker.close()
+            self.assertEqual(1800, response[b'interval'])
+            self.assertEqual(2, tracker.retransmissions)
+            self.assertEqual(4, len(server.requests))
+
+        self.run_with_tracker(test, drop=2)
+
+    def test_no_response(self):
+        async def test(server, url):
+            tracker = UdpTracker(url, timeout=0.01, max_retries=2)
+            with self.assertRaises(ConnectionError):
+                await self.announce(tracker)
+            tracker.close()
+            # Waited 0.01, 0.02 then 0.04 seconds
+            self.assertEqual(3, len(server.requests))
+
+        self.run_with_tracker(test, drop=100)
+
+    def test_error(self):
+        async def test(server, url):
+            tracker = Tracker(FakeInfo(url))
+            response = await tracker.connect(True, 0, 0)
+            await tracker.close()
+            self.assertEqual('torrent not registered', response.failure)
+
+        self.run_with_tracker(test, error=b'torrent not registered')
+
+    def test_tracker_dispatches_by_scheme(self):
+        async def test(server, url):
+            tracker = Tracker(FakeInfo(url))
+            response = await tracker.connect(True, 0, 0)
+            await tracker.close()
+            self.assertIsNone(response.failure)
+            self.assertEqual([('10.0.0.1', 6881), ('10.0.0.2', 6882)],
+                             response.peers)
+            self.assertIsNone(tracker.session)
+
+        self.run_with_tracker(test)
@@ -0,0 +1,64 @@
+import asyncio
+import unittest
+
+from src.peer_protocol import Handshake, Interested, Piece, Request, Unchoke
+from src.uploader import Uploader
+
+INFO_HASH = bytes(range(20))
+
+
+class FakePieceManager:
+    """
+    Has piece 0 only, whose bytes are all 7.
+    """
+
+    def __init__(self):
+        self.reads = []
+
+    async def read_block(self, index, offset, length):
+        self.reads.append((index, offset, length))
+        return bytes([7]) * length if index == 0 else None
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        self.data.extend(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class UploaderTests(unittest.TestCase):
+    def test_requests_served(self):
+        piece_manager = FakePieceManager()
+        writer = FakeWriter()
+        messages = [Interested(), Request(1, 0, 4), Request(0, 4, 4)]
+
+        async def upload():
+            queue = asyncio.Queue()
+            reader = asyncio.StreamReader()
+            # The messages arrive with the handshake
+            reader.feed_data(Handshake(INFO_HASH, b'b' * 20).encode() +
+                             b''.join(message.encode()
+                                      for message in messages))
+            reader.feed_eof()
+            queue.put_nowait((reader, writer))
+            uploader = Uploader(queue, INFO_HASH, b'a' * 20, piece_manager)
+            task = asyncio.ensure_future(uploader.start())
+            while not writer.closed:
+                await asyncio.sleep(0)
+            task.cancel()
+
+        asyncio.run(upload())
+        self.assertEqual([(1, 0, 4), (0, 4, 4)], piece_manager.reads)
+        self.assertEqual(Handshake(INFO_HASH, b'a' * 20).encode() +
+                         Unchoke().encode() +
+                         Piece(0, 4, bytes([7]) * 4).encode(),
+                         bytes(writer.data))
@@ -0,0 +1,128 @@
+import asyncio
+import unittest
+
+from src.write_cache import WriteCache
+
+
+class FakePiece:
+    length = 4
+
+    def __init__(self, index):
+        self.index = index
+
+
+class FakeDiskIO:
+    def __init__(self, failing=(), failing_sync=False):
+        self.failing = failing
+        self.failing_sync = failing_sync
+        self.writes = []
+        self.syncs = 0
+
+    async def write(self, pieces):
+        await asyncio.sleep(0)
+        indices = [piece.index for piece in pieces]
+        if set(indices) & set(self.failing):
+            raise OSError('disk full')
+        self.writes.append(indices)
+
+    async def sync(self):
+        self.syncs += 1
+        if self.failing_sync:
+            raise OSError('I/O error')
+
+
+class WriteCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.written = []
+        self.failed = []
+
+    def cache(self, disk_io, **kwargs):
+        return WriteCache(disk_io,
+                          lambda piece: self.written.append(piece.index),
+                          lambda piece: self.failed.append(piece.index),
+                          **kwargs)
+
+    def test_adjacent_pieces_coalesced(self):
+        disk_io = FakeDiskIO()
+        cache = self.cache(disk_io, flush_size=24)
+
+        async def add():
+            for index in (5, 1, 2, 7, 6):
+                cache.add(FakePiece(index))
+            self.assertEqual(20, cache.size)
+            self.assertEqual([], disk_io.writes)
+            cache.add(FakePiece(0))
+            await cache.flush()
+
+        self.loop.run_until_complete(add())
+        self.assertEqual([[0, 1, 2], [5, 6, 7]], disk_io.writes)
+        self.assertEqual([0, 1, 2, 5, 6, 7], self.written)
+        self.assertEqual(0, disk_io.syncs)
+
+    def test_flush_after_interval(self):
+        disk_io = FakeDiskIO()
+        cache = self.cache(disk_io, flush_interval=0.01)
+
+        async def add():
+            cache.add(FakePiece(3))
+            await asyncio.sleep(0.05)
+
+        self.loop.run_until_complete(add())
+        self.assertEqual([[3]], disk_io.writes)
+
+    def test_memory_cap(self):
+        cache = self.cache(FakeDiskIO(), max_size=8)
+
+        async def add():
+            cache.add(FakePiece(0))
+            self.assertFalse(cache.is_full)
+            cache.add(FakePiece(4))
+            self.assertTrue(cache.is_full)
+            await cache.flush()
+            self.assertFalse(cache.is_full)
+
+        self.loop.run_until_complete(add())
+
+    def test_fsync_policies(self):
+        for fsync, syncs in (('flush', 2), ('close', 1)):
+            disk_io = FakeDiskIO()
+            cache = self.cache(disk_io, fsync=fsync)
+
+            async def add():
+                cache.add(FakePiece(0))
+                await cache.flush()
+                cache.add(FakePiece(1))
+                await cache.flush(shutdown=True)
+
+            self.loop.run_until_complete(add())
+            self.assertEqual(syncs, disk_io.syncs)
+        with self.assertRaises(ValueError):
+            self.cache(FakeDiskIO(), fsync='always')
+
+    def test_failed_writes(self):
+        cache = self.cache(FakeDiskIO(failing=[1]))
+
+        async def add():
+            for index in (0, 1, 3):
+                cache.add(FakePiece(index))
+            await cache.flush()
+
+        self.loop.run_until_complete(add())
+        self.assertEqual([0, 1], self.failed)
+        self.assertEqual([3], self.written)
+        self.assertEqual(0, cache.writing)
+
+    def test_failed_sync(self):
+        cache = self.cache(FakeDiskIO(failing=[1], failing_sync=True),
+                           fsync='flush')
+
+        async def add():
+            for index in (0, 1, 3):
+                cache.add(FakePiece(index))
+            await cache.flush()
+
+        self.loop.run_until_complete(add())
+        self.assertEqual([0, 1, 3], sorted(self.failed))
+        self.assertEqual([], self.written)